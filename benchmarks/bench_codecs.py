@@ -0,0 +1,96 @@
+# Benchmark of the tif codecs for the tile writer. A synthetic 16-bit mosaic
+# (smooth illumination, bright cells and camera noise) is encoded with each
+# setting; reported are the encoding throughput (MB/s of raw pixel data) and
+# the compression ratio (raw size / file size). Settings, whose codec is not
+# available (e.g. 'imagecodecs' not installed), are skipped.
+# Usage:
+#   python bench_codecs.py [--tiles 8] [--size 2048] [--repeat 3]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from czi2codex.tile_pipeline import (encode_tiff, tiff_write_kwargs,
+                                     check_tiff_codec)
+
+# (name, compression, level, predictor, tile)
+SETTINGS = [
+    ('none', 'none', None, False, None),
+    ('zlib-1', 'zlib', 1, False, None),
+    ('zlib-6 (default)', 'zlib', None, False, None),
+    ('zlib-9', 'zlib', 9, False, None),
+    ('zlib-1 + predictor', 'zlib', 1, True, None),
+    ('zlib-6 + predictor', 'zlib', None, True, None),
+    ('zlib-6 tiled 256', 'zlib', None, False, (256, 256)),
+    ('zstd-1', 'zstd', 1, False, None),
+    ('zstd-3', 'zstd', 3, False, None),
+    ('zstd-3 + predictor', 'zstd', 3, True, None),
+    ('zstd-3 tiled 256', 'zstd', 3, False, (256, 256)),
+    ('lzw', 'lzw', None, False, None),
+    ('lzw + predictor', 'lzw', None, True, None),
+    ('lz4', 'lz4', None, False, None),
+    ('lzma', 'lzma', None, False, None),
+]
+
+
+def synthetic_tiles(num_tiles: int, size: int, seed: int = 0):
+    """16-bit fluorescence-like tiles: background with vignetting, gaussian
+    blobs (cells) and poisson/read noise."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size] / size - 0.5
+    vignetting = 1.0 - 0.6 * (xx ** 2 + yy ** 2)
+    tiles = []
+    for _ in range(num_tiles):
+        img = 400.0 * vignetting
+        cells = np.zeros((size, size))
+        n_cells = size * size // 2000
+        cy = rng.integers(0, size, n_cells)
+        cx = rng.integers(0, size, n_cells)
+        cells[cy, cx] = rng.uniform(500, 8000, n_cells)
+        # blur the point sources with a separable box filter (cheap blobs)
+        kernel = np.ones(9) / 9
+        for axis in (0, 1):
+            cells = np.apply_along_axis(np.convolve, axis, cells, kernel,
+                                        mode='same')
+        img = img + cells * 40
+        img = rng.poisson(np.clip(img, 0, None)) + rng.normal(0, 5, img.shape)
+        tiles.append(np.clip(img, 0, 65535).astype(np.uint16))
+    return tiles
+
+
+def run_setting(tiles, repeat: int, **write_kwargs):
+    raw_bytes = sum(t.nbytes for t in tiles)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoded_bytes = sum(len(encode_tiff(t, **write_kwargs))
+                            for t in tiles)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return raw_bytes / 2**20 / best, raw_bytes / encoded_bytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of tif codecs on '
+                                                 'a synthetic 16-bit mosaic.')
+    parser.add_argument("--tiles", type=int, default=8)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tiles = synthetic_tiles(args.tiles, args.size)
+    print(f'{args.tiles} tiles of {args.size}x{args.size} uint16 '
+          f'({sum(t.nbytes for t in tiles) / 2**20:.0f} MB)')
+    print(f'{"setting":<22} {"MB/s":>9} {"ratio":>7}')
+    for name, compression, level, predictor, tile in SETTINGS:
+        write_kwargs = tiff_write_kwargs(compression, level, predictor, tile)
+        try:
+            check_tiff_codec(**write_kwargs)
+        except ValueError:
+            print(f'{name:<22} {"n/a":>9} {"":>7}  (codec not available)')
+            continue
+        mb_per_s, ratio = run_setting(tiles, args.repeat, **write_kwargs)
+        print(f'{name:<22} {mb_per_s:9.1f} {ratio:7.2f}')
@@ -0,0 +1,93 @@
+# Benchmark of the startup time of the command line interface (cli.py): each
+# command is started repeatedly in a new python process, the median and the
+# minimum wall time are printed, next to the bare interpreter. Light commands
+# ('czi2codex options', the help) only import the modules they need and
+# should start within tens of milliseconds; the conversion commands import
+# numpy, tifffile and lxml. With --importtime the slowest imports of each
+# command are listed (python -X importtime).
+# Usage:
+#   python bench_import.py [--repeat 10] [--importtime]
+import argparse
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def commands(directory: str):
+    """(name, python arguments) of the measured commands."""
+    cli = ['-m', 'czi2codex']
+    return [('python (interpreter only)', ['-c', 'pass']),
+            ('import czi2codex', ['-c', 'import czi2codex']),
+            ('czi2codex --help', cli + ['--help']),
+            ('czi2codex options DIR', cli + ['options', directory]),
+            ('czi2codex convert --help', cli + ['convert', '--help']),
+            ('czi2codex inspect --help', cli + ['inspect', '--help']),
+            ('import czi2codex.czi2tif_codex',
+             ['-c', 'import czi2codex.czi2tif_codex'])]
+
+
+def run(args: list, env: dict, importtime: bool = False):
+    """Runs python with args, returns the wall time (s) and stderr."""
+    command = [sys.executable] + (['-X', 'importtime'] if importtime
+                                  else []) + args
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall_time = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception(f'{" ".join(command)} failed:\n{result.stderr}')
+    return wall_time, result.stderr
+
+
+def slowest_imports(stderr: str, top: int = 5):
+    """Top-level packages with the largest cumulative import time (ms)."""
+    cumulative = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)',
+                         line)
+        # only packages imported by the command itself (no indentation)
+        if match and not match.group(2):
+            cumulative[match.group(3)] = int(match.group(1)) / 1000
+    return sorted(cumulative.items(), key=lambda item: -item[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the startup '
+                                                 'time of the czi2codex '
+                                                 'command line interface.')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='number of runs of each command')
+    parser.add_argument('--importtime', action='store_true',
+                        help='list the slowest imports of each command')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    directory = tempfile.mkdtemp(prefix='czi2codex_bench_')
+    try:
+        print(f'{"command":<34} {"median":>9} {"min":>9}')
+        for name, command in commands(directory):
+            # the first run fills the caches (file system, .pyc files)
+            run(command, env)
+            times = [run(command, env)[0] for _ in range(args.repeat)]
+            print(f'{name:<34} {statistics.median(times) * 1e3:7.1f} ms '
+                  f'{min(times) * 1e3:7.1f} ms')
+            if args.importtime:
+                _, stderr = run(command, env, importtime=True)
+                for module, ms in slowest_imports(stderr):
+                    print(f'    {module:<34} {ms:7.1f} ms')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
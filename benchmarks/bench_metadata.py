@@ -0,0 +1,68 @@
+# Microbenchmark of the metadata extraction: the precompiled XPath extractor
+# (metadata_extractor.extract_metadata) against the previous path, which
+# serialized the whole lxml tree and converted it to a dictionary with
+# xmltodict. A synthetic czi metadata document is padded with acquisition
+# settings of the size found in real czi files (several MB).
+# Usage:
+#   python bench_metadata.py [--mb 4] [--channels 4] [--repeat 5]
+import argparse
+import os
+import sys
+import time
+from lxml import etree
+import xmltodict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from czi2codex.metadata_extractor import extract_metadata
+from czi2codex.czi2tif_codex import exposure_times_from_meta
+from czi2codex.synthetic_czi import synthetic_metadata
+
+
+def xmltodict_path(meta):
+    """previous path: serialize, convert to dict, read the fields"""
+    d = xmltodict.parse(etree.tostring(meta))
+    exposure = exposure_times_from_meta(d)
+    d_meta = d['ImageDocument']['Metadata']
+    d_obj = d_meta['Information']['Instrument']['Objectives']['Objective']
+    return exposure, float(d_obj['NominalMagnification'])
+
+
+def extractor_path(meta):
+    md = extract_metadata(meta)
+    return exposure_times_from_meta(md), md.magnification
+
+
+def best_time(func, meta, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(meta)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the czi '
+                                                 'metadata extraction.')
+    parser.add_argument('--mb', type=float, default=4,
+                        help='size of the metadata document (MB)')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    meta = etree.fromstring(synthetic_metadata(C=args.channels,
+                                               size_mb=args.mb))
+    size_mb = len(etree.tostring(meta)) / 2**20
+    if xmltodict_path(meta) != extractor_path(meta):
+        raise Exception('the extracted fields differ')
+    t_old = best_time(xmltodict_path, meta, args.repeat)
+    t_new = best_time(extractor_path, meta, args.repeat)
+    print(f'metadata document: {size_mb:.1f} MB, {args.channels} channels')
+    print(f'{"xmltodict (tostring + parse)":<32} {t_old * 1e3:10.2f} ms')
+    print(f'{"extract_metadata (XPath)":<32} {t_new * 1e3:10.2f} ms')
+    print(f'{"speedup":<32} {t_old / t_new:10.1f} x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Benchmark of the complete conversion (czi2codex_all: tifs, exposure times
+# and experiment.json) on synthetic czi files (czi2codex/synthetic_czi.py), so
+# that no microscope data and no aicspylibczi are needed. A synthetic
+# experiment with the given number of cycles, tiles, channels, Z-planes and
+# tile size is generated in a temporary directory and converted; the
+# throughput (subblocks/s, MB/s of decoded pixels), the stage times of the run
+# report and the peak memory of the main process and of the worker processes
+# are printed.
+# Usage:
+#   python bench_pipeline.py [--cycles 3] [--tiles 4x3] [--channels 4] [--z 5]
+#                            [--size 1024] [--workers 2] [--metadata-mb 4]
+#                            [--option 1_output_backend=zarr] [--keep DIR]
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from czi2codex.memory_budget import peak_rss_mb
+from czi2codex.run_czi2codex import czi2codex_all
+from czi2codex.run_report import REPORT_FILENAME
+from czi2codex.synthetic_czi import write_synthetic_experiment
+
+
+def run_benchmark(directory: str, args):
+    columns, rows = (int(n) for n in args.tiles.lower().split('x'))
+    options_path = write_synthetic_experiment(
+        directory, args.cycles, S=args.scenes, C=args.channels, Z=args.z,
+        columns=columns, rows=rows, Y=args.size, X=args.size,
+        overlap=args.overlap, jitter=args.jitter,
+        metadata_mb=args.metadata_mb)
+    with open(options_path, 'r') as f:
+        options = yaml.safe_load(f)
+    for option in args.option:
+        key, value = option.split('=', 1)
+        options[key] = yaml.safe_load(value)
+    with open(options_path, 'w') as f:
+        yaml.dump(options, f)
+
+    start = time.perf_counter()
+    czi2codex_all(options_path, workers=args.workers)
+    wall_time = time.perf_counter() - start
+
+    with open(os.path.join(options['1_outdir'], REPORT_FILENAME), 'r') as f:
+        report = json.load(f)
+    return wall_time, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the complete '
+                                                 'conversion on synthetic czi '
+                                                 'files.')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--scenes', type=int, default=1,
+                        help='number of scenes (regions) per czi file')
+    parser.add_argument('--tiles', type=str, default='4x3',
+                        help='tile grid per scene: columns x rows')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--z', type=int, default=5)
+    parser.add_argument('--size', type=int, default=1024,
+                        help='tile width and height (pixels)')
+    parser.add_argument('--overlap', type=float, default=0.1)
+    parser.add_argument('--jitter', type=int, default=3,
+                        help='random deviation of the tile positions '
+                             '(pixels)')
+    parser.add_argument('--metadata-mb', type=float, default=4,
+                        help='size of the metadata xml (MB)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: "1_workers:")')
+    parser.add_argument('--option', action='append', default=[],
+                        help='options.yaml entry key=value (repeatable), '
+                             'e.g. 1_output_backend=zarr')
+    parser.add_argument('--keep', type=str, default=None,
+                        help='generate and convert in this directory and '
+                             'keep it (default: temporary directory)')
+    args = parser.parse_args()
+
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        wall_time, report = run_benchmark(args.keep, args)
+    else:
+        directory = tempfile.mkdtemp(prefix='czi2codex_bench_')
+        try:
+            wall_time, report = run_benchmark(directory, args)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    counters = report['totals']['counters']
+    subblocks = counters.get('subblocks_read', 0)
+    decoded_mb = counters.get('bytes_decoded', 0) / 2**20
+    written_mb = counters.get('bytes_written', 0) / 2**20
+    print('.......................................')
+    print(f'{args.cycles} cycles x {args.scenes} scenes x {args.tiles} tiles '
+          f'x {args.channels} channels x {args.z} Z-planes, tiles '
+          f'{args.size}x{args.size}')
+    print(f'{"wall time":<24} {wall_time:10.2f} s')
+    print(f'{"subblocks":<24} {subblocks:10d}  '
+          f'({subblocks / wall_time:.1f} /s)')
+    print(f'{"decoded":<24} {decoded_mb:10.1f} MB '
+          f'({decoded_mb / wall_time:.1f} MB/s)')
+    print(f'{"written":<24} {written_mb:10.1f} MB')
+    for stage, seconds in sorted(report['totals']['stages_s'].items()):
+        print(f'{"  " + stage:<24} {seconds:10.2f} s')
+    for name, children in (('peak memory (main)', False),
+                           ('peak memory (workers)', True)):
+        rss = peak_rss_mb(children)
+        print(f'{name:<24} ' + ('unknown' if rss is None else
+                                f'{rss:10.1f} MB'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Benchmark of the per-tile overhead in czi_to_tiffs, which is not spent on
+# decoding pixels: tile rect checks and subblock metadata.
+#   before: read_subblock_rect (1 + C*Z times per tile) and
+#           read_subblock_metadata (C*Z times per tile)
+#   after:  one read of the subblock directory per file
+# Usage:
+#   python bench_tile_overhead.py /dir/to/czifiles/file.czi [--repeat 3]
+import argparse
+import os
+import sys
+import time
+from itertools import product
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from aicspylibczi import CziFile
+from czi2codex.czi_directory import read_subblock_directory, tile_rects
+
+
+def overhead_before(czi, C, Z, M):
+    for m in range(M):
+        tilepos = czi.read_subblock_rect(S=0, T=0, C=0, Z=0, M=m)
+        for (c, z) in product(range(C), range(Z)):
+            if czi.read_subblock_rect(S=0, T=0, C=c, Z=z, M=m) != tilepos:
+                raise Exception('inconsistent tile rect')
+            czi.read_subblock_metadata(unified_xml=True, S=0, T=0, C=c, Z=z,
+                                       M=m)
+
+
+def overhead_after(czi_path, C, Z, M):
+    tile_rects(read_subblock_directory(czi_path), C, Z, M)
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the per-tile '
+                                                 'metadata overhead.')
+    parser.add_argument("czi_path", help="Path to a czi file.", type=str)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    czi = CziFile(args.czi_path)
+    S, T, C, Z, M, Y, X = czi.size
+    n_subblocks = C * Z * M
+    t_before = best_of(args.repeat, overhead_before, czi, C, Z, M)
+    t_after = best_of(args.repeat, overhead_after, args.czi_path, C, Z, M)
+
+    print(f'{args.czi_path}: M={M} tiles, C={C}, Z={Z} '
+          f'({n_subblocks} subblocks)')
+    print(f'before: {t_before:8.3f} s total, '
+          f'{t_before / n_subblocks * 1e6:10.1f} us per subblock')
+    print(f'after:  {t_after:8.3f} s total, '
+          f'{t_after / n_subblocks * 1e6:10.1f} us per subblock')
+    print(f'speedup: {t_before / max(t_after, 1e-9):.1f}x')
@@ -1,33 +1,50 @@
-# # -*- coding: utf-8 -*-
-# __version__ = '0.1.0-dev'
-#
-# """
-# This file contains the initialization.
-# """
-# import os
-# import glob
-# import numpy as np
-# from czi2tif_codex import czi_to_tiffs
-# from generate_metadata_json import (meta_to_json, generate_std_options_file)
-# import argparse
-# import yaml
-# import xmltodict
-# from aicspylibczi import CziFile
-# import json
-# import lxml
-# from lxml import etree
-# from typing import Union
-# import shutil
-# from datetime import datetime
-# import tifffile
-# import warnings
-# from xml.etree import ElementTree
-# from itertools import product
-#
-from . import czi2tif_codex
-from . import run_generate_std_options_file
-from . import generate_metadata_json
-from . import run_czi2codex
-from .generate_metadata_json import meta_to_json
-from .run_generate_std_options_file import generate_std_options_file
-from .czi2tif_codex import czi_to_tiffs
+# -*- coding: utf-8 -*-
+"""
+czi2codex: conversion of czi files to the CODEX format.
+
+The submodules are imported lazily, on first access of one of the names
+below (e.g. czi2codex.czi_to_tiffs imports czi2tif_codex with numpy,
+tifffile and lxml), such that light commands of the command line interface
+(cli.py, e.g. 'czi2codex options') start without the heavy dependencies.
+"""
+import importlib
+
+__version__ = '0.1.0'
+
+# public name -> submodule, in which it is defined
+_LAZY_NAMES = {
+    'czi_to_tiffs': 'czi2tif_codex',
+    'meta_to_json': 'generate_metadata_json',
+    'generate_std_options_file': 'run_generate_std_options_file',
+    'czi2codex_all': 'run_czi2codex',
+    'experiment_json': 'generate_metadata_json',
+    'inspect_run': 'run_inspect',
+}
+
+_SUBMODULES = ('auto_tune', 'cli', 'czi2tif_codex', 'czi_cache',
+               'czi_directory', 'flat_field', 'generate_metadata_json',
+               'job_queue', 'memory_budget', 'metadata_extractor',
+               'output_backends', 'overview', 'run_batch', 'run_czi2codex',
+               'run_generate_std_options_file', 'run_inspect',
+               'run_manifest', 'run_report', 'selection',
+               'sequential_reader', 'synthetic_czi', 'tile_overlap',
+               'tile_pipeline', 'watch_folder', 'z_projection')
+
+__all__ = sorted(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        module = importlib.import_module('.' + _LAZY_NAMES[name], __name__)
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute '
+                             f'{name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES) | set(_SUBMODULES))
@@ -0,0 +1,5 @@
+# python -m czi2codex COMMAND ..., the same as the installed command
+# 'czi2codex' (cli.py)
+from .cli import main
+
+main()
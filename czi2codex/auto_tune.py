@@ -0,0 +1,246 @@
+# auto-tuning of the concurrency of the conversion (1_auto_tune): the number
+# of worker processes, encoder threads and the depths of the read and write
+# queues of the tile pipeline are chosen from the measured time per subblock
+# of its stages, instead of being tuned by hand for each storage target.
+#   - before the conversion, the first subblocks of the first cycle are
+#     decoded, compressed and written into a scratch folder of the output
+#     directory (probe_stage_times)
+#   - after every converted cycle and region, the settings are computed again
+#     from the stage times of all converted units (run report), for the units
+#     which are started afterwards
+# Within a worker process the czi file is decoded by one reader thread and the
+# files are written by one writer thread, the encoder threads work in
+# parallel. The settings keep the slowest stage saturated:
+#   - encoder threads: as many as needed that compression keeps up with the
+#     slower of decoding and writing
+#   - workers: as many as the cpu cores allow, each worker occupies
+#     (decode + encode) / (time per subblock of its slowest stage) cores. If
+#     writing is the slowest stage (e.g. network storage), a worker needs
+#     little cpu and more workers write in parallel. Bounded by the memory
+#     budget and the number of units
+#   - queues: two tiles per encoder thread; a write queue twice as deep, if
+#     writing is the slowest stage, which absorbs the latency of network
+#     storage
+# Every decision and its reason is added to the run report (events) and
+# printed.
+import os
+import math
+import time
+import shutil
+from collections import namedtuple
+from .tile_pipeline import encode_tiff
+
+PROBE_DIR = '.czi2codex_probe'
+PROBE_SUBBLOCKS = 8
+
+StageTimes = namedtuple('StageTimes', ['decode', 'encode', 'write',
+                                       'tile_mb'])
+StageTimes.__doc__ = """Measured seconds per subblock of the stages of the
+tile pipeline.
+decode: float
+    czi.read_image
+encode: float
+    compression (and flat-field statistics, overview), summed over the
+    encoder threads
+write: float
+    disk writes
+tile_mb: float
+    MB of a decoded subblock"""
+
+TuneSettings = namedtuple('TuneSettings', ['workers', 'encoder_threads',
+                                           'read_queue_size',
+                                           'write_queue_size'])
+
+
+def stage_times(stats: dict):
+    """StageTimes of the statistics of converted units (StageStats.to_dict(),
+    e.g. report.totals). None, if no subblock was decoded."""
+    counters = stats['counters']
+    n = counters.get('subblocks_read', 0)
+    if n == 0:
+        return None
+    stages = stats['stages_s']
+    return StageTimes(decode=stages.get('decode', 0.0) / n,
+                      encode=(stages.get('encode', 0.0) +
+                              stages.get('flat_field', 0.0) +
+                              stages.get('overview', 0.0)) / n,
+                      write=stages.get('write', 0.0) / n,
+                      tile_mb=counters.get('bytes_decoded', 0) / n / 2**20)
+
+
+def probe_stage_times(record, outdir: str, write_kwargs: dict,
+                      scene: int = 0, num_subblocks: int = PROBE_SUBBLOCKS):
+    """
+    Measures the stages on the first subblocks of a czi file: decoding,
+    compression (tif with write_kwargs) and writing into the scratch folder
+    outdir/.czi2codex_probe (removed afterwards).
+    Parameters:
+    -----------
+    record: CziRecord
+        czi file (see czi_cache.py)
+    outdir: str
+        output directory, on the storage which is measured
+    write_kwargs: dict
+        tif settings, see tile_pipeline.tiff_write_kwargs()
+    scene: int
+        scene of the subblocks
+    num_subblocks: int
+        number of measured subblocks
+    Returns:
+    --------
+    StageTimes
+    """
+    S, T, C, Z, M, Y, X = record.size
+    num_subblocks = max(1, min(num_subblocks, C * Z * M))
+    probe_dir = os.path.join(outdir, PROBE_DIR)
+    os.makedirs(probe_dir, exist_ok=True)
+    decode = encode = write = 0.0
+    nbytes = 0
+    try:
+        for i in range(num_subblocks):
+            m, cz = divmod(i, C * Z)
+            c, z = divmod(cz, Z)
+            start = time.perf_counter()
+            data, _ = record.czi.read_image(S=scene, T=0, C=c, Z=z, M=m)
+            decoded = time.perf_counter()
+            data = data.reshape(data.shape[-2:])
+            payload = encode_tiff(data, **write_kwargs)
+            encoded = time.perf_counter()
+            with open(os.path.join(probe_dir, f'{i}.tif'), 'wb') as f:
+                f.write(payload)
+            written = time.perf_counter()
+            decode += decoded - start
+            encode += encoded - decoded
+            write += written - encoded
+            nbytes += data.nbytes
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+    n = num_subblocks
+    return StageTimes(decode / n, encode / n, write / n, nbytes / n / 2**20)
+
+
+def tune(times: StageTimes, max_workers: int = 1, cpus: int = None,
+         memory_budget_mb: float = None):
+    """
+    Settings which keep the slowest stage saturated (see the top of this
+    file).
+    Parameters:
+    -----------
+    times: StageTimes
+        measured seconds per subblock
+    max_workers: int
+        maximal number of worker processes (e.g. the number of units)
+    cpus: int
+        number of cpu cores, None: os.cpu_count()
+    memory_budget_mb: float
+        maximal memory (MB) of tiles in flight of all workers, None:
+        unlimited
+    Returns:
+    --------
+    settings: TuneSettings
+    reasons: list
+        explanation of each setting
+    """
+    cpus = cpus or os.cpu_count() or 1
+    reasons = []
+    # reader and writer are one thread each per worker
+    serial = max(times.decode, times.write, 1e-6)
+    serial_stage = 'decode' if times.decode >= times.write else 'write'
+    encoder_threads = max(1, min(cpus, math.ceil(times.encode / serial)))
+    reasons.append(f'{encoder_threads} encoder threads: compression takes '
+                   f'{times.encode * 1e3:.1f} ms per subblock, {serial_stage}'
+                   f' {serial * 1e3:.1f} ms')
+    per_subblock = max(serial, times.encode / encoder_threads)
+    slowest = serial_stage if serial >= times.encode / encoder_threads \
+        else 'encode'
+    cores = (times.decode + times.encode) / per_subblock
+    workers = max(1, min(max_workers, int(cpus / max(cores, 1e-6))))
+    reasons.append(f'{workers} workers: {slowest} is the slowest stage, a '
+                   f'worker occupies {cores:.1f} of {cpus} cpu cores '
+                   f'(at most {max_workers} workers)')
+
+    read_queue_size = max(2, 2 * encoder_threads)
+    write_queue_size = read_queue_size
+    if slowest == 'write':
+        write_queue_size *= 2
+        reasons.append(f'write queue {write_queue_size}: writing is the '
+                       f'slowest stage, the deeper queue absorbs its latency')
+    if memory_budget_mb is not None and times.tile_mb > 0:
+        # tiles in flight per worker: queues and tiles being compressed
+        worker_mb = (read_queue_size + write_queue_size + encoder_threads) \
+            * times.tile_mb
+        fit = int(memory_budget_mb / worker_mb)
+        if fit < workers:
+            workers = max(1, fit)
+            reasons.append(f'{workers} workers: limited by the memory budget '
+                           f'of {memory_budget_mb:.0f} MB ({worker_mb:.0f} MB '
+                           f'per worker)')
+        if fit < 1:
+            tiles = max(3, int(memory_budget_mb / times.tile_mb) -
+                        encoder_threads)
+            read_queue_size = max(1, tiles // 3)
+            write_queue_size = max(1, tiles - read_queue_size)
+            reasons.append(f'queues {read_queue_size}/{write_queue_size}: '
+                           f'limited by the memory budget of '
+                           f'{memory_budget_mb:.0f} MB')
+    return TuneSettings(workers, encoder_threads, read_queue_size,
+                        write_queue_size), reasons
+
+
+class AutoTuner:
+    """
+    Current settings of an auto-tuned conversion, updated from the measured
+    stage times.
+    Parameters:
+    -----------
+    max_workers: int
+        maximal number of worker processes
+    memory_budget_mb: float
+        maximal memory (MB) of tiles in flight of all workers, None:
+        unlimited
+    log: callable
+        log(message), e.g. RunReport.log; the decisions are also printed
+    """
+
+    def __init__(self, max_workers: int, memory_budget_mb: float = None,
+                 log=None):
+        self.max_workers = max(1, int(max_workers))
+        self.memory_budget_mb = memory_budget_mb
+        self.log = log
+        self.settings = None
+
+    @property
+    def workers(self):
+        return self.settings.workers if self.settings else 1
+
+    def update(self, times: StageTimes, source: str):
+        """Computes the settings from times (measured by source, e.g.
+        'probe'). A change is logged with its reasons."""
+        if times is None:
+            return self.settings
+        settings, reasons = tune(times, self.max_workers,
+                                 memory_budget_mb=self.memory_budget_mb)
+        if settings != self.settings:
+            message = (f'auto-tune ({source}): {settings.workers} workers, '
+                       f'{settings.encoder_threads} encoder threads, queues '
+                       f'{settings.read_queue_size}/'
+                       f'{settings.write_queue_size}; per subblock decode '
+                       f'{times.decode * 1e3:.1f} ms, encode '
+                       f'{times.encode * 1e3:.1f} ms, write '
+                       f'{times.write * 1e3:.1f} ms ({times.tile_mb:.1f} MB). '
+                       + '; '.join(reasons))
+            print(message)
+            if self.log is not None:
+                self.log(message)
+            self.settings = settings
+        return self.settings
+
+    def pipeline_kwargs(self):
+        """Keyword arguments of convert_cycle for the next unit."""
+        s = self.settings
+        kwargs = {'encoder_threads': s.encoder_threads,
+                  'read_queue_size': s.read_queue_size,
+                  'write_queue_size': s.write_queue_size}
+        if self.memory_budget_mb is not None:
+            kwargs['memory_budget_mb'] = self.memory_budget_mb / s.workers
+        return kwargs
@@ -0,0 +1,65 @@
+# command line interface: one installed command 'czi2codex' with subcommands,
+#   czi2codex convert /dir/to/options.yaml --workers 4
+#   czi2codex options /dir/to/optionfile/
+# Every subcommand is the main() of a module (which can also be run with
+# 'python -m czi2codex.<module>'). Only the module of the given subcommand is
+# imported, and only when it is run: 'czi2codex options' and the help need
+# neither numpy, tifffile, lxml nor aicspylibczi and start quickly, which
+# matters when the commands are called many times for small jobs
+# (benchmarks/bench_import.py).
+import sys
+import argparse
+import importlib
+
+# subcommand -> (module, description)
+COMMANDS = {
+    'convert': ('run_czi2codex', 'convert the czi files to codex-format '
+                                 '(tifs, exposure times, json)'),
+    'options': ('run_generate_std_options_file', 'generate a standard '
+                                                 'options.yaml file'),
+    'json': ('generate_metadata_json', 'generate experiment.json of a '
+                                       'converted output directory'),
+    'inspect': ('run_inspect', 'check the czi files and options, print the '
+                               'work plan'),
+    'watch': ('watch_folder', 'convert the cycles while they are acquired'),
+    'queue': ('job_queue', 'convert with workers on several nodes, through '
+                           'a job queue'),
+    'batch': ('run_batch', 'convert many experiments with one pool of '
+                           'worker processes'),
+}
+
+
+def main(argv: list = None):
+    """
+    Runs 'czi2codex COMMAND [arguments]'.
+    Parameters:
+    -----------
+    argv: list
+        command and its arguments, default: sys.argv[1:]
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in COMMANDS:
+        module_name, _ = COMMANDS[argv[0]]
+        module = importlib.import_module('.' + module_name, __package__)
+        return module.main(argv[1:], prog=f'czi2codex {argv[0]}')
+
+    # without a valid command: help, version or the error message
+    from . import __version__
+    commands = '\n'.join(f'  {command:<9} {description}'
+                         for command, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog='czi2codex', usage='%(prog)s [-h] [--version] COMMAND ...',
+        description='Convert czi files to CODEX format.',
+        epilog=f'commands:\n{commands}\n\n'
+               f'"czi2codex COMMAND --help" shows the arguments of a '
+               f'command.',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--version', action='version',
+                        version=f'%(prog)s {__version__}')
+    parser.add_argument('command', choices=COMMANDS, metavar='COMMAND',
+                        help='see the commands below')
+    parser.parse_known_args(argv)
+
+
+if __name__ == "__main__":
+    main()
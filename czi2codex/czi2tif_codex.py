@@ -1,12 +1,30 @@
 import os
-import tifffile
 import glob
+import time
 import warnings
 from xml.etree import ElementTree
-from itertools import product
-from aicspylibczi import CziFile
-import xmltodict
-from lxml import etree
+from itertools import repeat
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait as wait_futures)
+from .tile_pipeline import (TilePipeline, RETAINED, tiff_write_kwargs,
+                            check_tiff_codec)
+from .auto_tune import AutoTuner, probe_stage_times, stage_times
+from .output_backends import get_output_backend, make_output_backend
+from .z_projection import ZProjectionBackend, Z_PROJECTIONS, SCORE_BYTES
+from .flat_field import (FlatFieldAccumulator, partial_stats_path,
+                         remove_superseded_stats, save_flat_field)
+from .overview import OverviewMosaic, overview_path, partial_overview_path
+from .selection import Selection, selected_tile_grid
+from .czi_cache import CziMetadataCache, CziRecord
+from .metadata_extractor import CziMetadata, extract_metadata
+from .sequential_reader import iter_subblocks
+from .memory_budget import peak_rss_mb
+from .run_report import RunReport, StageStats
+from .run_manifest import (CycleManifest, source_fingerprint, converted_cycles,
+                           read_exposure_times, write_exposure_times_file,
+                           read_exposure_times_file, EXPOSURE_TIMES_FILENAME,
+                           part_name)
 
 
 def extension(path: str, *, lower: bool = True):
@@ -19,47 +37,506 @@ def replace_extension(path: str, ext: str):
     return base + os.path.extsep + ext
 
 
-def write_exposure_times(meta_dict, i_cycle, outdir,
-                         overwrite_exposure=False):
-    """Write exposure_times.txt. Infer the exposure times from given meta-xml
-    given in dictionary format.
-    Return path to saved exposure_times.txt file."""
+def exposure_times_from_meta(meta):
+    """Infer the exposure times of all channels from given metadata: the
+    extracted fields (metadata_extractor.CziMetadata), the metadata-object
+    (lxml) or the meta-xml given in dictionary format."""
     # Metadata►Information►Image►Dimensions►Channels►Channel►0►ExposureTime
-    d_channel = meta_dict['ImageDocument']['Metadata']['Information']['Image'][
-        'Dimensions']['Channels']['Channel']
+    if isinstance(meta, dict):
+        d_channel = meta['ImageDocument']['Metadata']['Information'][
+            'Image']['Dimensions']['Channels']['Channel']
+        exposure_times = [d_channel[i]['ExposureTime']
+                          for i in range(len(d_channel))]
+    else:
+        if not isinstance(meta, CziMetadata):
+            meta = extract_metadata(meta)
+        exposure_times = [ch.exposure_time for ch in meta.channels]
     exptime = []
     default_scaling = 1E6
-    for i in range(len(d_channel)):
-        etime = float(d_channel[i]['ExposureTime'])/default_scaling
+    for exposure_time in exposure_times:
+        etime = float(exposure_time)/default_scaling
         if etime.is_integer():
             exptime.append(int(etime))
         else:
             exptime.append(etime)
+    return exptime
 
-    exp_filename = 'exposure_times.txt'
-    # Check if exposure_times.txt already exist
-    if os.path.exists(os.path.join(outdir, exp_filename)) and \
-            overwrite_exposure is False:
-        if i_cycle == 1:
-            warnings.warn(
-                f'\nWARNING: Exposure times file {exp_filename} already exist. '
-                f'If it shall be replaced, define: overwrite_exposure_times: '
-                f'true')
-    else:
-        if os.path.exists(os.path.join(outdir, exp_filename)) and \
-                overwrite_exposure and i_cycle == 1:
-            os.remove(os.path.join(outdir, exp_filename))
-        # write exposure_times.txt file
-        with open(os.path.join(outdir, exp_filename), 'a') as filehandle:
-            if i_cycle == 1:
-                filehandle.write('Cycle,CH1,CH2,CH3,CH4 \n')
-            filehandle.write(str(i_cycle))
-            for listitem in exptime:
-                filehandle.write(',%s' % listitem)
-            filehandle.write('\n')
-
-    exptime_path = os.path.join(outdir, exp_filename)
-    return exptime_path
+
+def write_exposure_times(meta, i_cycle, outdir,
+                         overwrite_exposure=False):
+    """Write the exposure times of one cycle to exposure_times.txt (cycle 1
+    starts a new file, later cycles are added to the rows in the file). Infer
+    the exposure times from given metadata (see exposure_times_from_meta).
+    An existing file is only replaced at cycle 1 with overwrite_exposure.
+    Return path to saved exposure_times.txt file."""
+    exptime_path = os.path.join(outdir, EXPOSURE_TIMES_FILENAME)
+    if i_cycle == 1 and os.path.exists(exptime_path) and \
+            not overwrite_exposure:
+        _warn_exposure_times_exist()
+        return exptime_path
+    rows = {} if i_cycle == 1 else read_exposure_times_file(outdir)
+    rows[i_cycle] = exposure_times_from_meta(meta)
+    return write_exposure_times_file(outdir, rows)
+
+
+def _warn_exposure_times_exist():
+    warnings.warn(
+        f'\nWARNING: Exposure times file {EXPOSURE_TIMES_FILENAME} already '
+        f'exist. If it shall be replaced, define: overwrite_exposure_times: '
+        f'true')
+
+
+def check_czi_record(record: CziRecord):
+    """Checks the dimensions of a czi file, which are expected by the
+    conversion. Only the header is read (no pixels are decoded). Raises an
+    Exception, if the file can not be converted."""
+    # S: scene
+    # T: time
+    # C: channel
+    # Z: focus position
+    # M: tile index in a mosaic
+    # Y, X: tile dimensions
+    if record.dims != 'STCZMYX':
+        raise Exception('unexpected dimension ordering')
+    S, T, C, Z, M, Y, X = record.size
+    if T != 1:
+        raise Exception('only one timepoint expected')
+
+    # Check zero-based indexing
+    dims_shapes = record.czi.dims_shape()
+    # dims_shape is a list of dictionaries, which map each dimension to its
+    # index range: one for all scenes, or one per scene (with the index
+    # range of its scene S), if the scenes differ in shape
+    for dims_shape in dims_shapes:
+        for dim, axis in dims_shape.items():
+            if axis[0] != 0 and not (dim == 'S' and len(dims_shapes) > 1):
+                raise Exception('expected zero-based indexing in CZI file')
+    # every scene is converted as a region of the same tile grid
+    tile_shapes = sorted({tuple(dims_shape.get(dim, (0, 1))[1]
+                                for dim in 'MYX')
+                          for dims_shape in dims_shapes})
+    if len(tile_shapes) > 1:
+        raise Exception(f'all regions (scenes) need the same tile grid, '
+                        f'found (tiles, tile height, tile width): '
+                        f'{tile_shapes}')
+
+    if not record.czi.is_mosaic():
+        raise Exception('expected a mosaic image')
+
+
+def check_conversion_settings(*, compression: str = 'zlib',
+                              compression_level: int = None,
+                              predictor: bool = False,
+                              tiff_tile: tuple = None,
+                              output_backend: str = 'tiff',
+                              z_projection: str = None,
+                              **kwargs):
+    """Raises an Exception, if the conversion can not run with the given
+    settings (the keyword arguments of czi_to_tiffs, others are ignored):
+    codec or output backend not available, unknown z-projection. Nothing is
+    written."""
+    backend = get_output_backend(output_backend)
+    backend.check_available()
+    if output_backend != 'zarr':
+        check_tiff_codec(**tiff_write_kwargs(compression, compression_level,
+                                             predictor, tiff_tile))
+    if z_projection is not None and z_projection not in Z_PROJECTIONS:
+        raise ValueError(f"unknown z-projection '{z_projection}', expected "
+                         f"one of {Z_PROJECTIONS}")
+
+
+def convert_cycle(i_cyc: int,
+                  czi_path: str,
+                  outdir: str,
+                  template: str = '1_{m:05}_Z{z:03}_CH{c:03}',
+                  *,
+                  scene: int = 0,
+                  compression: str = 'zlib',
+                  compression_level: int = None,
+                  predictor: bool = False,
+                  tiff_tile: tuple = None,
+                  save_tile_metadata: bool = False,
+                  encoder_threads: int = 2,
+                  read_queue_size: int = 8,
+                  write_queue_size: int = 8,
+                  cache: CziMetadataCache = None,
+                  resume: bool = False,
+                  read_order: str = 'file',
+                  prefetch_mb: int = 0,
+                  memory_budget_mb: float = None,
+                  output_backend: str = 'tiff',
+                  z_projection: str = None,
+                  flat_field: bool = False,
+                  overview_factor: int = None,
+                  selection: Selection = None,
+                  part: tuple = None,
+                  stats: StageStats = None):
+    """
+    Converts one scene (region) of the czi file of one cycle to tifs and
+    saves the metadata-xml of the czi file. The exposure_times.txt is not
+    written here, such that cycles and regions can be converted
+    independently (e.g. in parallel worker processes). Every written tile and
+    the exposure times are recorded in the run manifest of the cycle and
+    region (see run_manifest.py).
+    Parameters:
+    -----------
+    i_cyc: int
+        cycle number (starting from 1)
+    czi_path: str
+        path to the czi file of this cycle
+    outdir: str
+        output directory, where everything should be saved
+    template: str
+        output-filenaming template, default is: '1_{m:05}_Z{z:03}_CH{c:03}'
+    scene: int
+        scene of the czi file (starting from 0), which is saved as region
+        scene + 1 in the folder cycNNN_regRRR
+    compression: str
+        tiffile-compression: 'none', 'zlib', 'zstd', 'lzw', 'lz4', 'lzma'
+        (other than zlib and lzma need the 'imagecodecs' package)
+    compression_level: int
+        level of the compression, None: default level of the codec
+    predictor: bool
+        use horizontal differencing (predictor) before compression
+    tiff_tile: tuple
+        (height, width) of the tiles within each tif-file (tiled tif),
+        None: striped tif
+    save_tile_metadata: bool
+        save metadata for each tile?
+    encoder_threads: int
+        number of threads compressing the tiles, while the next tiles are
+        decoded and the previous ones are written. 0: no threads
+    read_queue_size: int
+        maximal number of decoded tiles waiting for compression
+    write_queue_size: int
+        maximal number of compressed tiles waiting to be written
+    cache: CziMetadataCache
+        cache of opened czi files and their metadata. If not given, the czi
+        file is opened without cache
+    resume: bool
+        if True, tiles which are recorded in the run manifest for the same
+        czi file and settings (and still exist) are not converted again
+    read_order: str
+        'file': read the subblocks in the order in which they are stored in
+        the czi file (avoids seeking, e.g. on network storage)
+        'tile': read tile by tile
+    prefetch_mb: int
+        with read_order='file', read the czi file sequentially up to this many
+        MB ahead of the decoder into the page cache. 0: no read-ahead
+    memory_budget_mb: float
+        maximal memory (MB) of tiles in flight in the tile pipeline, the
+        reader waits until enough tiles are written. None: unlimited
+    output_backend: str
+        'tiff': one tif-file per tile, channel and Z-plane (default)
+        'tiff_zstack': one multi-page tif-file per tile and channel
+        'tiff_hyperstack': one multi-page tif-file per tile
+        'zarr': one chunked array per cycle in outdir/codex.zarr
+        (see output_backends.py)
+    z_projection: str
+        reduce the Z-planes of every tile and channel to one plane, only the
+        projection is saved (as Z-plane 1): 'max' (maximum intensity) or
+        'edf' (extended depth of field). None: all Z-planes are saved
+    flat_field: bool
+        accumulate the flat-field statistics (per-pixel mean and variance,
+        intensity histogram) of all channels and save them in
+        outdir/flatfield/cycNNN_regRRR.npz (see flat_field.py). With resume,
+        converted tiles are read again, if these statistics are missing
+    overview_factor: int
+        save a stitched overview of every channel, downsampled by this
+        factor, as pyramidal tif outdir/overview/cycNNN_regRRR_CHCCC.tif
+        (see overview.py). With resume, converted tiles are read again, if
+        the overview is missing. None: no overview
+    selection: Selection
+        convert only the selected tiles, channels and Z-planes, which are
+        numbered anew from 1 in the output (see selection.py). Only their
+        subblocks are read. None: everything
+    part: tuple
+        (first, stop): convert only the (selected) tiles first..stop - 1
+        (output tile indices, from 0) of the scene, which keep their numbers.
+        The run manifest, flat-field statistics and overview of the part are
+        saved separately (with the suffix part_name(part)) and are merged
+        after all parts are converted (see job_queue.py). None: all tiles
+    stats: StageStats
+        per-stage timers and counters of the conversion are added to it
+        (see run_report.py)
+    Returns:
+    --------
+    C - Channels (selected)
+    Z - Z-Planes (selected)
+    tiles (selected, of the scene)
+    meta: lxml.etree._Element
+        metadata-object
+    tile_meta:
+        metadata for each tile
+    """
+    basename, _ = os.path.splitext(os.path.basename(czi_path))
+    if cache is None:
+        cache = CziMetadataCache()
+    if stats is None:
+        stats = StageStats()
+    record = cache.get(czi_path)
+    czi = record.czi
+
+    # output dir and foldername
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    region = scene + 1
+    foldername = 'cyc{:03}_reg{:03}'.format(int(basename[-2:]), region)  # Cyc{cycle:d}_reg{region:d}
+
+    # Extract and check dimensions
+    check_czi_record(record)
+    # Scene, Timepoints, Channels, Z-slices, Mosaic, Height, Width
+    S, T, C, Z, M, Y, X = record.size
+    if not 0 <= scene < S:
+        raise Exception(f'scene {scene} does not exist, the czi file has {S} '
+                        f'scenes')
+
+    # Extract & save metadata (once per czi file)
+    meta = record.meta
+    if scene == 0 and (part is None or part[0] == 0):
+        with open(os.path.join(outdir, basename + '.xml'), 'w') as f:
+            f.write(ElementTree.tostring(meta, encoding='unicode'))
+
+    # Get tile positions of all tiles, returns: (x, y, w, h)
+    with stats.timer('directory'):
+        tiles = record.scene_tiles[scene]
+
+    # selected tiles, channels and Z-planes (indices of the czi file) and
+    # their index in the output
+    if selection is None:
+        selection = Selection()
+    selected = (selection.tile_indices(tiles), selection.channel_indices(C),
+                selection.z_indices(Z))
+    out_m, out_c, out_z = ({i: i_out for i_out, i in enumerate(indices)}
+                           for indices in selected)
+    tiles = [tiles[m] for m in selected[0]]
+    M_out, C_out, Z_out = len(out_m), len(out_c), len(out_z)
+    suffix = None
+    if part is not None:
+        # tiles of the part, numbered as in the whole scene
+        suffix = part_name(part)
+        selected = (selected[0][part[0]:part[1]],) + selected[1:]
+    M_part = len(selected[0])
+    if M_part == 0:
+        print(f'Cycle = {i_cyc}, region = {region}: no tile is selected.')
+        return C_out, Z_out, tiles, meta, {}
+
+    # Run manifest: records each written tile, such that an interrupted
+    # conversion can be resumed
+    settings = {'output_backend': output_backend,
+                'template': template, 'compression': compression,
+                'compression_level': compression_level,
+                'predictor': predictor,
+                'tiff_tile': list(tiff_tile) if tiff_tile else None}
+    if output_backend == 'tiff':
+        # keep the fingerprints of runs before the backends were added
+        del settings['output_backend']
+    if z_projection is not None:
+        settings['z_projection'] = z_projection
+    if selection.renumbers:
+        settings['selection'] = {k: v for k, v in
+                                 selection.to_settings().items()
+                                 if k != 'cycles'}
+    manifest = CycleManifest(outdir, i_cyc,
+                             source_fingerprint(czi_path, settings),
+                             resume=resume, region=region, part=suffix)
+    backend = make_output_backend(
+        output_backend, outdir, foldername, template=template,
+        write_kwargs=tiff_write_kwargs(compression, compression_level,
+                                       predictor, tiff_tile),
+        shape=(M_out, C_out, 1 if z_projection else Z_out, Y, X))
+    if z_projection is not None and Z_out > 1:
+        backend = ZProjectionBackend(backend, z_projection, Z_out)
+    # converted tiles are read again (with resume), if their flat-field
+    # statistics or overview are missing
+    reread_done = False
+    ff_stats = None
+    if flat_field:
+        ff_stats = FlatFieldAccumulator(C_out, (Y, X))
+        ff_path = partial_stats_path(outdir, i_cyc, region, suffix)
+        reread_done = not os.path.exists(ff_path)
+    mosaic = None
+    if overview_factor:
+        mosaic = OverviewMosaic(tiles, C_out, overview_factor)
+        if part is None:
+            reread_done |= not all(
+                os.path.exists(overview_path(outdir, i_cyc, region, c))
+                for c in range(C_out))
+        else:
+            reread_done |= not os.path.exists(
+                partial_overview_path(outdir, i_cyc, region, suffix))
+
+    # the tiles are passed through the pipeline as (key, m, c, z), with the
+    # indices of the output
+    def encode(item, data):
+        key, m, c, z = item
+        if ff_stats is not None:
+            # before encode: the z-projection reduces into the first plane
+            with stats.timer('flat_field'):
+                ff_stats.add(c, data)
+        if mosaic is not None:
+            with stats.timer('overview'):
+                mosaic.add(m, c, data)
+        if key is None:
+            # converted tile, which is only read for the statistics or the
+            # overview
+            return None
+        with stats.timer('encode'):
+            payload = backend.encode(key, data, m, c, z)
+        # None: the plane is kept by the backend until its file is complete,
+        # it stays counted in the memory budget until the file is written
+        return RETAINED if payload is None else payload
+
+    def write(item, payload):
+        if payload is None:
+            # plane was only read for the flat-field statistics or overview
+            return
+        key, m, c, z = item
+        with stats.timer('write'):
+            backend.write(key, payload)
+        stats.count('bytes_written', len(payload))
+        stats.count('tiles_written', backend.num_pages)
+        stats.count('files_written')
+        manifest.add_tile(key, payload, *backend.manifest_coords(m, c, z))
+
+    # Save tiles
+    tile_meta = {}
+    num_skipped = 0
+    # decoded tiles are handed over to encoder threads, which compress them,
+    # and a writer thread, which saves them
+    memory_budget = None
+    if memory_budget_mb is not None:
+        memory_budget = int(memory_budget_mb * 2**20)
+        if backend.retains_planes and read_order != 'tile':
+            # the planes of a file are kept until it is complete: tile by
+            # tile, at most one file is incomplete at a time (in file order,
+            # e.g. Z-plane by Z-plane, all files of the cycle could be)
+            print(f'Cycle = {i_cyc}, region = {region}: the tiles are read '
+                  f'tile by tile (1_read_order: tile), which bounds the '
+                  f'planes kept for {output_backend}'
+                  f'{" and the z-projection" if z_projection else ""}.')
+            read_order = 'tile'
+    # memory counted per plane in addition to its pixels: the edf
+    # z-projection keeps a float32 focus measure next to each projection
+    score_bytes = SCORE_BYTES if z_projection == 'edf' and Z_out > 1 else 0
+    with manifest, TilePipeline(encode, write,
+                                encoder_threads=encoder_threads,
+                                read_queue_size=read_queue_size,
+                                write_queue_size=write_queue_size,
+                                memory_budget=memory_budget) as pipeline:
+        with stats.timer('xml_parse'):
+            metadata = record.metadata
+        exposure_times = exposure_times_from_meta(metadata)
+        manifest.set_exposure_times([exposure_times[c] for c in selected[1]])
+        # Iterate over tiles, channel and focus (in the order of the
+        # subblocks in the czi file, or tile by tile)
+        for m_in, c_in, z_in in iter_subblocks(
+                czi_path, record.directory, C, Z, M, read_order,
+                prefetch_mb * 2**20, scene, selected):
+            # Save tile as tiff
+            # filename = template.format(c=c, z=z, m=m, basename=basename)
+            # filename = os.path.join(outdir, filename)
+
+            m, c, z = out_m[m_in], out_c[c_in], out_z[z_in]
+            key = backend.tile_key(m, c, z)
+            done = manifest.is_done(key, verify_size=backend.verify_size)
+            if done:
+                num_skipped += 1
+            if not done or reread_done:
+                with stats.timer('decode'):
+                    tile_data, tile_shape = czi.read_image(
+                        S=scene, T=0, C=c_in, Z=z_in, M=m_in)
+                stats.count('subblocks_read')
+                stats.count('bytes_decoded', tile_data.nbytes)
+                # drop the singleton S, T, C, Z, M axes (view, no copy)
+                tile_data = tile_data.reshape(tile_data.shape[-2:])
+                pipeline.put((None if done else key, m, c, z), tile_data,
+                             group=None if done else key,
+                             nbytes=tile_data.nbytes +
+                             tile_data.size * score_bytes)
+            # Save tile metadata, the subblock xml is only parsed if needed
+            filename = template.format(c=c+1, z=z+1, m=m+1) # Codex format starts at 1!
+            filename = os.path.join(outdir, foldername, filename)
+            if save_tile_metadata and not (
+                    done and os.path.exists(filename + '.xml')):
+                with stats.timer('xml_parse'):
+                    cur_tile_meta = czi.read_subblock_metadata(
+                        unified_xml=True, S=scene, T=0, C=c_in, Z=z_in,
+                        M=m_in)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                cur_tile_meta.getroottree().write(filename + '.xml')
+    backend.close(cycle=i_cyc, region=region, tiles=[list(t) for t in tiles],
+                  source=os.path.basename(czi_path))
+    # the statistics are only saved, if they cover all tiles of the region
+    # or part (otherwise the saved ones of the same tiles are kept)
+    if ff_stats is not None and all(n == M_part * Z_out
+                                    for n in ff_stats.counts()):
+        ff_stats.save(ff_path)
+        if part is None:
+            # statistics of parts of the region (job queue) are replaced
+            remove_superseded_stats(outdir, i_cyc, region, [ff_path])
+    if mosaic is not None and all(n == M_part * Z_out
+                                  for n in mosaic.counts):
+        with stats.timer('overview'):
+            if part is None:
+                mosaic.save(outdir, i_cyc, region)
+            else:
+                mosaic.save_partial(partial_overview_path(
+                    outdir, i_cyc, region, suffix))
+    stats.count('tiles_skipped', num_skipped)
+    if num_skipped:
+        print(f'Cycle = {i_cyc}, region = {region}: {num_skipped} tiles were '
+              f'already converted and are skipped.')
+
+    return C_out, Z_out, tiles, meta, tile_meta
+
+
+def _run_cycle(i_cyc, czi_path, outdir, template, kwargs, cache, scene=0):
+    """Runs convert_cycle() for one scene and measures it. Returns tile_meta,
+    the statistics of the cycle and region (StageStats.to_dict()) and its
+    wall time."""
+    stats = StageStats()
+    start = time.perf_counter()
+    _, _, _, _, tile_meta = convert_cycle(i_cyc, czi_path, outdir, template,
+                                          scene=scene, cache=cache,
+                                          stats=stats, **kwargs)
+    return tile_meta, stats.to_dict(), time.perf_counter() - start
+
+
+def _convert_cycle_worker(i_cyc, czi_path, outdir, template, kwargs,
+                          scene=0):
+    """Runs convert_cycle() in a worker process, which opens its own czi
+    file. The parsed czi record is sent back to the main process (without the
+    file handle, the metadata as xml-string)."""
+    cache = CziMetadataCache()
+    result = _run_cycle(i_cyc, czi_path, outdir, template, kwargs, cache,
+                        scene)
+    return (cache.get(czi_path).to_state(),) + result
+
+
+def _dispatch_units(executor, units, outdir, template, unit_kwargs, active):
+    """Submits the units to the worker processes, at most active() of them
+    running at a time, and yields their results in the order of the units.
+    unit_kwargs() and active() are called for every submission, such that
+    the settings can change during the run (auto-tuning)."""
+    futures = deque()
+    pending = deque(units)
+
+    def top_up():
+        while pending and sum(not f.done() for f in futures) < active():
+            i_cyc, czi_path, scene = pending.popleft()
+            futures.append(executor.submit(
+                _convert_cycle_worker, i_cyc, czi_path, outdir, template,
+                unit_kwargs(), scene))
+
+    top_up()
+    while futures:
+        while not futures[0].done():
+            wait_futures([f for f in futures if not f.done()],
+                         return_when=FIRST_COMPLETED)
+            top_up()
+        yield futures.popleft().result()
+        top_up()
 
 
 # channel start from 1!!!
@@ -70,7 +547,26 @@ def czi_to_tiffs(czidir: str,
                  #'1_{m}_Z{z}_CH{c}',
                  *,
                  compression: str = 'zlib',
-                 save_tile_metadata: bool = False):
+                 compression_level: int = None,
+                 predictor: bool = False,
+                 tiff_tile: tuple = None,
+                 save_tile_metadata: bool = False,
+                 workers: int = 1,
+                 encoder_threads: int = 2,
+                 read_queue_size: int = 8,
+                 write_queue_size: int = 8,
+                 cache: CziMetadataCache = None,
+                 resume: bool = False,
+                 read_order: str = 'file',
+                 prefetch_mb: int = 0,
+                 memory_budget_mb: float = None,
+                 output_backend: str = 'tiff',
+                 z_projection: str = None,
+                 flat_field: bool = False,
+                 overview_factor: int = None,
+                 selection: Selection = None,
+                 auto_tune: bool = False,
+                 report: RunReport = None):
     """
     Reads czi files and converts them to tifs. Furthermore exposure_times.txt
     files are created.
@@ -85,10 +581,86 @@ def czi_to_tiffs(czidir: str,
         output-filenaming template, default is: '1_{m:05}_Z{z:03}_CH{c:03}'
     overwrite_exposure: bool
         if exposure_times.txt already exists, should it be overwritten or not?
+        Only used with resume=False and without a selection (then the file
+        is always rebuilt from the run manifest)
     compression: str
-        tiffile-compression
+        tiffile-compression: 'none', 'zlib', 'zstd', 'lzw', 'lz4', 'lzma'
+        (other than zlib and lzma need the 'imagecodecs' package)
+    compression_level: int
+        level of the compression, None: default level of the codec
+    predictor: bool
+        use horizontal differencing (predictor) before compression
+    tiff_tile: tuple
+        (height, width) of the tiles within each tif-file (tiled tif),
+        None: striped tif
     save_tile_metadata: bool
         save metadata for each tile?
+    workers: int
+        number of worker processes, which convert the cycles in parallel.
+        Each worker opens its own czi file. If None, all cpu cores are used.
+        Default: 1 (no worker processes)
+    encoder_threads: int
+        number of threads (per worker) compressing the tiles, while the next
+        tiles are decoded and the previous ones are written. 0: no threads
+    read_queue_size: int
+        maximal number of decoded tiles waiting for compression
+    write_queue_size: int
+        maximal number of compressed tiles waiting to be written
+    cache: CziMetadataCache
+        cache of opened czi files and their metadata, which can be reused
+        afterwards (e.g. in meta_to_json). If not given, a new cache is used
+    resume: bool
+        resume an interrupted or repeated conversion: only tiles, which are
+        missing or stale (czi file or settings changed) according to the run
+        manifest in outdir, are converted. exposure_times.txt is then rebuilt
+        from the manifest (overwrite_exposure is not used)
+    read_order: str
+        'file': read the subblocks in the order in which they are stored in
+        the czi file (avoids seeking, e.g. on network storage)
+        'tile': read tile by tile
+    prefetch_mb: int
+        with read_order='file', read the czi file sequentially up to this many
+        MB ahead of the decoder into the page cache. 0: no read-ahead
+    memory_budget_mb: float
+        maximal memory (MB) of tiles in flight, shared by all worker
+        processes. The peak resident memory is reported at the end of the
+        run. None: unlimited
+    output_backend: str
+        'tiff': one tif-file per tile, channel and Z-plane (default)
+        'tiff_zstack': one multi-page tif-file per tile and channel, with
+        the Z-planes as pages
+        'tiff_hyperstack': one multi-page tif-file per tile, with the pages in
+        (channel, Z) order
+        'zarr': one chunked array (tile, channel, z, y, x) per cycle and
+        region in the zarr store outdir/codex.zarr (needs 'zarr')
+    z_projection: str
+        save only a projection of the Z-planes of every tile and channel:
+        'max' (maximum intensity) or 'edf' (extended depth of field). None:
+        all Z-planes are saved
+    flat_field: bool
+        accumulate flat-field statistics of every cycle and channel while
+        converting and save the estimates (mean, standard deviation and
+        normalized flat-field per pixel, intensity percentiles) in
+        outdir/flatfield (see flat_field.py)
+    overview_factor: int
+        save a stitched overview of every cycle, region and channel,
+        downsampled by this factor while converting, as pyramidal tif in
+        outdir/overview (see overview.py). None: no overview
+    selection: Selection
+        convert only the selected cycles, tiles, channels and Z-planes (see
+        selection.py). exposure_times.txt is then rebuilt from the run
+        manifest, for all cycles converted into outdir (selected cycles) or
+        for all cycles. None: everything
+    auto_tune: bool
+        choose the number of worker processes, encoder threads and queue
+        sizes from the measured decode, compression and write times (on the
+        first subblocks, then after every converted cycle and region), see
+        auto_tune.py. workers is the upper limit (1 or None: all cpu cores),
+        encoder_threads and the queue sizes are ignored. The decisions are
+        logged in the run report
+    report: RunReport
+        the per-stage timers and counters of each cycle are added to it. The
+        run report is saved as czi2codex_run_report.json in outdir
     Returns:
     --------
     C - Channels
@@ -98,6 +670,7 @@ def czi_to_tiffs(czidir: str,
         metadata-object
     tile_meta:
         metadata for each tile
+    (all of the last cycle)
     """
     print('.......................................')
     print('Starting to run conversion czi to tifs.')
@@ -111,98 +684,157 @@ def czi_to_tiffs(czidir: str,
                                 'user specified directory: \n' + czidir +
                                 '\n Please check the defined directory '
                                 '"1_czidir" in the options.yaml file.')
+    if cache is None:
+        cache = CziMetadataCache()
 
-    # loop over cycles
-    for i_cyc in range(1, num_cycles+1):
-        # name of czi file without .czi extension
-        basename = czi_filename.format(i_cyc)
-
-        czi = CziFile(os.path.join(basedir, basename + czi_ext))
-
-        # output dir and foldername
-        if not os.path.exists(outdir):
-            os.makedirs(outdir, exist_ok=True)
-        foldername = 'cyc{:03}_reg001'.format(int(basename[-2:]))  # Cyc{cycle:d}_reg{region:d}
-        if not os.path.exists(os.path.join(outdir, foldername)):
-            os.makedirs(os.path.join(outdir, foldername), exist_ok=True)
-
-        # Extract and check dimensions
-        # S: scene
-        # T: time
-        # C: channel
-        # Z: focus position
-        # M: tile index in a mosaic
-        # Y, X: tile dimensions
-        if czi.dims != 'STCZMYX':
-            raise Exception('unexpected dimension ordering')
-        # Scene, Timepoints, Channels, Z-slices, Mosaic, Height, Width
-        S, T, C, Z, M, Y, X = czi.size
-        if S != 1:
-            raise Exception('only one scene expected')
-        if T != 1:
-            raise Exception('only one timepoint expected')
-
-        # Check zero-based indexing
-        dims_shape, = czi.dims_shape()
-        # dims_shape is a dictionary which maps each dimension to its index
-        # range
-        for axis in dims_shape.values():
-            if axis[0] != 0:
-                raise Exception('expected zero-based indexing in CZI file')
+    # name of czi file without .czi extension
+    cycles = range(1, num_cycles+1)
+    if selection is not None:
+        cycles = selection.cycle_list(num_cycles)
+    czi_paths = [os.path.join(basedir, czi_filename.format(i_cyc) + czi_ext)
+                 for i_cyc in cycles]
+    # work units: every scene (region) of every cycle is converted
+    # independently
+    units = [(i_cyc, czi_path, scene)
+             for i_cyc, czi_path in zip(cycles, czi_paths)
+             for scene in range(cache.get(czi_path).size[0])]
+    # fail before anything is decoded, if the selected tiles are no complete
+    # tile grid (experiment.json and the tile overlaps need one)
+    for czi_path in czi_paths:
+        selected_tile_grid(cache.get(czi_path).scene_tiles, selection)
 
-        if not czi.is_mosaic():
-            raise Exception('expected a mosaic image')
-
-        # Save tiles
-        tiles = []
-        tile_meta = {}
-        for m in range(M):
-            # Get tile position
-            tilepos = czi.read_subblock_rect(S=0, T=0, C=0, Z=0, M=m) # returns: (x, y, w, h)
-            tiles.append(tilepos)
-            # Iterate over channel and focus
-            for (c, z) in product(range(C), range(Z)):
-                # Get tile position
-                cur_tilepos = czi.read_subblock_rect(S=0, T=0, C=c, Z=z, M=m)
-                if cur_tilepos != tilepos:
-                    raise Exception('tile rect expected to be independent of Z and'
-                                    ' C dimensions')
-                # Get tile metadata
-                # _, cur_tile_meta = czi.read_subblock_metadata(unified_xml=True,
-                # S=0, T=0, C=c, Z=z, M=m)#[0]
-                cur_tile_meta = czi.read_subblock_metadata(unified_xml=True, S=0,
-                                                           T=0, C=c, Z=z, M=m)
-                # tile_meta[(c, z, m)] = cur_tile_meta[1]
-                # Save tile as tiff
-                # filename = template.format(c=c, z=z, m=m, basename=basename)
-                # filename = os.path.join(outdir, filename)
-
-                filename = template.format(c=c+1, z=z+1, m=m+1) # Codex format starts at 1!
-                filename = os.path.join(outdir, foldername, filename)
-                tile_data, tile_shape = czi.read_image(S=0, T=0, C=c, Z=z, M=m)
-                tifffile.imwrite(filename + '.tif', tile_data, compression=compression)
-                # Save tile metadata
-                if save_tile_metadata:
-                    cur_tile_meta.getroottree().write(filename + '.xml')
-
-        # Extract & save metadata
-        meta = czi.meta
-        with open(os.path.join(outdir, basename + '.xml'), 'w') as f:
-            f.write(ElementTree.tostring(meta, encoding='unicode'))
+    if report is None:
+        report = RunReport()
+    tuner = None
+    if auto_tune:
+        # workers is the upper limit, the tuner decides how many run
+        if workers is None or int(workers) <= 1:
+            workers = os.cpu_count()
+        tuner = AutoTuner(min(int(workers), len(units)), memory_budget_mb,
+                          log=report.log)
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(int(workers), len(units)))
+    # each worker process gets its share of the memory budget
+    if memory_budget_mb is not None:
+        memory_budget_mb = memory_budget_mb / workers
+    # fail early, if the codec or the backend is not available
+    check_conversion_settings(compression=compression,
+                              compression_level=compression_level,
+                              predictor=predictor, tiff_tile=tiff_tile,
+                              output_backend=output_backend,
+                              z_projection=z_projection)
+    get_output_backend(output_backend).prepare(outdir)
+    # without resume and selection, an existing exposure_times.txt is only
+    # replaced with overwrite_exposure
+    exposure_times_existed = os.path.exists(
+        os.path.join(outdir, EXPOSURE_TIMES_FILENAME))
+    kwargs = dict(compression=compression,
+                  compression_level=compression_level,
+                  predictor=predictor,
+                  tiff_tile=tiff_tile,
+                  save_tile_metadata=save_tile_metadata,
+                  encoder_threads=encoder_threads,
+                  read_queue_size=read_queue_size,
+                  write_queue_size=write_queue_size,
+                  resume=resume,
+                  read_order=read_order,
+                  prefetch_mb=prefetch_mb,
+                  memory_budget_mb=memory_budget_mb,
+                  output_backend=output_backend,
+                  z_projection=z_projection,
+                  flat_field=flat_field,
+                  overview_factor=overview_factor,
+                  selection=selection)
+    report.settings.update(kwargs, template=template, workers=workers,
+                           auto_tune=auto_tune)
 
-        # save exposure_times.txt for each cycle
-        meta_dict = xmltodict.parse(etree.tostring(meta))
+    def unit_kwargs():
+        if tuner is None:
+            return kwargs
+        return dict(kwargs, **tuner.pipeline_kwargs())
 
-        if i_cyc == 1:
-            print('Starting to write the exposure.txt file. \n'
-                  f'Cycle = {str(i_cyc)}')
-        else:
-            print(f'Cycle = {str(i_cyc)}')
-        write_exposure_times(meta_dict, i_cyc, outdir,
-                             overwrite_exposure)
+    if tuner is not None:
+        times = probe_stage_times(
+            cache.get(units[0][1]), outdir,
+            tiff_write_kwargs(compression, compression_level, predictor,
+                              tiff_tile), scene=units[0][2])
+        tuner.update(times, 'probe')
+
+    unit_cycles, unit_paths, unit_scenes = zip(*units)
+    if workers == 1:
+        results = (_run_cycle(i_cyc, czi_path, outdir, template,
+                              unit_kwargs(), cache, scene)
+                   for i_cyc, czi_path, scene in units)
+    elif tuner is not None:
+        print(f'Converting {num_cycles} cycles ({len(units)} regions) with '
+              f'up to {workers} worker processes (auto-tuned).')
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = _dispatch_units(executor, units, outdir, template,
+                                  unit_kwargs, lambda: tuner.workers)
+    else:
+        print(f'Converting {num_cycles} cycles ({len(units)} regions) with '
+              f'{workers} worker processes.')
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_convert_cycle_worker, unit_cycles,
+                               unit_paths, repeat(outdir), repeat(template),
+                               repeat(kwargs), unit_scenes)
+
+    try:
+        # loop over cycles and regions, results are returned in this order
+        for (i_cyc, czi_path, scene), result in zip(units, results):
+            if workers > 1:
+                state, tile_meta, cycle_stats, wall_time = result
+                cache.add(CziRecord.from_state(state))
+            else:
+                tile_meta, cycle_stats, wall_time = result
+            report.add_cycle(i_cyc, cycle_stats, wall_time, region=scene + 1)
+            if tuner is not None:
+                tuner.update(stage_times(report.totals.to_dict()),
+                             f'cycle {i_cyc}, region {scene + 1}')
+            if flat_field and scene == cache.get(czi_path).size[0] - 1:
+                # all regions of the cycle are converted
+                save_flat_field(outdir, i_cyc)
+            if scene > 0:
+                continue
+            record = cache.get(czi_path)
+            _, _, C, Z, _, _, _ = record.size
+            tiles, meta = record.tiles, record.meta
+
+            # the exposure times of each cycle were recorded in the run
+            # manifest, exposure_times.txt is written from it after the loop
+            if i_cyc == 1:
+                print('Starting to write the exposure.txt file. \n'
+                      f'Cycle = {str(i_cyc)}')
+            else:
+                print(f'Cycle = {str(i_cyc)}')
+    finally:
+        if workers > 1:
+            executor.shutdown()
+
+    if resume or selection is not None or overwrite_exposure or \
+            not exposure_times_existed:
+        # rebuild exposure_times.txt (one row per cycle) from the manifest
+        if selection is not None and selection.cycles is not None:
+            # previously converted cycles are kept
+            cycles = converted_cycles(outdir)
+        write_exposure_times_file(outdir, read_exposure_times(outdir, cycles))
+    else:
+        _warn_exposure_times_exist()
 
     print(f"...finished generation of .tif files and exposure.txt file! ...\n"
           f"...Saved in {outdir}")
+    rss = peak_rss_mb()
+    if rss is not None:
+        report.peak_rss_mb['main'] = rss
+        if workers > 1:
+            report.peak_rss_mb['workers'] = peak_rss_mb(children=True)
+            print(f'Peak memory (RSS): {rss:.0f} MB (main process), '
+                  f"{report.peak_rss_mb['workers']:.0f} MB (largest worker "
+                  f'process)')
+        else:
+            print(f'Peak memory (RSS): {rss:.0f} MB')
+    print(f'...Run report saved in {report.write(outdir)}')
 
     # Return shape and metadata
     return C, Z, tiles, meta, tile_meta
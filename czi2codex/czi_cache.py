@@ -0,0 +1,167 @@
+# per-run cache of opened czi files and their parsed metadata, shared by the
+# tif conversion (czi_to_tiffs) and the generation of experiment.json
+# (meta_to_json), such that every czi header is parsed once per run.
+# czi files are opened with aicspylibczi.CziFile; other readers with the
+# same API can be registered for a file extension (register_czi_reader), e.g.
+# the synthetic czi files of the benchmarks ('.sczi', synthetic_czi.py).
+import os
+from lxml import etree
+from .czi_directory import read_tile_rects, try_read_subblock_directory
+from .metadata_extractor import extract_metadata
+
+
+def _synthetic_czi(czi_path: str):
+    from .synthetic_czi import SyntheticCziFile
+    return SyntheticCziFile(czi_path)
+
+
+# file extension -> function, which opens a file with the CziFile API
+CZI_READERS = {'.sczi': _synthetic_czi}
+
+
+def register_czi_reader(ext: str, reader):
+    """Opens the files with the extension ext (e.g. '.sczi') with
+    reader(czi_path), which returns an object with the API of
+    aicspylibczi.CziFile."""
+    CZI_READERS[ext.lower()] = reader
+
+
+def open_czi(czi_path: str):
+    """Opens a czi file with the reader of its extension (default:
+    aicspylibczi.CziFile)."""
+    _, ext = os.path.splitext(czi_path)
+    if ext.lower() in CZI_READERS:
+        return CZI_READERS[ext.lower()](czi_path)
+    from aicspylibczi import CziFile
+    return CziFile(czi_path)
+
+
+def file_key(czi_path: str):
+    """Cache key of a czi file: (absolute path, mtime, size). A modified file
+    gets a new key."""
+    st = os.stat(czi_path)
+    return os.path.abspath(czi_path), st.st_mtime_ns, st.st_size
+
+
+class CziRecord:
+    """
+    Opened czi file with its dims, size, tile rects and metadata. Everything
+    is read lazily on first access and kept afterwards.
+    """
+
+    def __init__(self, czi_path: str, key=None, *, czi=None, dims=None,
+                 size=None, scene_tiles=None, meta=None):
+        self.path = czi_path
+        self.key = key if key is not None else file_key(czi_path)
+        self._czi = czi
+        self._dims = dims
+        self._size = size
+        self._scene_tiles = scene_tiles
+        self._meta = meta
+        self._metadata = None
+        self._directory = False
+
+    @property
+    def czi(self):
+        """aicspylibczi.CziFile handle (see open_czi)"""
+        if self._czi is None:
+            self._czi = open_czi(self.path)
+        return self._czi
+
+    @property
+    def dims(self):
+        if self._dims is None:
+            self._dims = self.czi.dims
+        return self._dims
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = tuple(self.czi.size)
+        return self._size
+
+    @property
+    def directory(self):
+        """subblock directory (list of czi_directory.SubblockEntry), None if
+        it can not be read directly from the file"""
+        if self._directory is False:
+            self._directory = try_read_subblock_directory(self.path)
+        return self._directory
+
+    @property
+    def scene_tiles(self):
+        """tile rects (x, y, w, h) of all M tiles, a list per scene"""
+        if self._scene_tiles is None:
+            S, T, C, Z, M, Y, X = self.size
+            self._scene_tiles = read_tile_rects(self.czi, self.directory, C,
+                                                Z, M, S)
+        return self._scene_tiles
+
+    @property
+    def tiles(self):
+        """tile rects (x, y, w, h) of all M tiles of the first scene"""
+        return self.scene_tiles[0]
+
+    @property
+    def meta(self):
+        """metadata as lxml.etree._Element"""
+        if self._meta is None:
+            self._meta = self.czi.meta
+        return self._meta
+
+    @property
+    def metadata(self):
+        """fields of the metadata used by czi2codex
+        (metadata_extractor.CziMetadata)"""
+        if self._metadata is None:
+            self._metadata = extract_metadata(self.meta)
+        return self._metadata
+
+    def to_state(self):
+        """Picklable state (without file handle), e.g. to send a record from
+        a worker process back to the main process."""
+        return (self.path, self.key, self.dims, self.size, self.scene_tiles,
+                etree.tostring(self.meta))
+
+    @classmethod
+    def from_state(cls, state):
+        path, key, dims, size, scene_tiles, meta = state
+        return cls(path, key, dims=dims, size=size, scene_tiles=scene_tiles,
+                   meta=etree.fromstring(meta))
+
+
+class CziMetadataCache:
+    """
+    Cache of CziRecords, keyed by file path, mtime and size.
+    Usage:
+        cache = CziMetadataCache()
+        record = cache.get('/dir/to/czifiles/filename_CYC01.czi')
+        S, T, C, Z, M, Y, X = record.size
+    """
+
+    def __init__(self):
+        self._records = {}
+
+    def get(self, czi_path: str) -> CziRecord:
+        """Returns the record of a czi file, opens the file if it is not
+        cached yet (or was modified)."""
+        key = file_key(czi_path)
+        record = self._records.get(key[0])
+        if record is None or record.key != key:
+            record = CziRecord(czi_path, key)
+            self._records[key[0]] = record
+        return record
+
+    def add(self, record: CziRecord):
+        self._records[record.key[0]] = record
+
+    def metadata(self, meta):
+        """Extracted fields of a metadata-object (CziMetadata). Cached, if
+        the metadata belongs to one of the records."""
+        for record in self._records.values():
+            if record._meta is meta:
+                return record.metadata
+        return extract_metadata(meta)
+
+    def clear(self):
+        self._records.clear()
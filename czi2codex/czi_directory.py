@@ -0,0 +1,182 @@
+# reads the subblock directory of a czi file directly from the ZISRAW
+# container, without decoding any pixels or parsing xml. One read per file
+# gives the tile rect, the dimension indices and the file position of every
+# subblock.
+import struct
+from itertools import product
+from collections import namedtuple
+
+SubblockEntry = namedtuple('SubblockEntry',
+                           ['file_position', 'pixel_type', 'compression',
+                            'pyramid_type', 'index', 'rect', 'stored_size'])
+SubblockEntry.__doc__ = """Entry of the subblock directory.
+file_position: int
+    offset of the subblock segment in the czi file
+index: dict
+    start index of each non-spatial dimension, e.g. {'C': 0, 'Z': 3, 'M': 7}
+rect: tuple
+    (x, y, w, h) of the subblock, as returned by read_subblock_rect
+stored_size: tuple
+    (w, h) of the stored pixels, smaller than the rect in pyramid levels"""
+
+_SEGMENT_HEADER = struct.Struct('<16sqq')
+_DIRECTORY_ENTRY = struct.Struct('<2siqiiB5xi')
+_DIMENSION_ENTRY = struct.Struct('<4siifi')
+
+
+def _read_segment(f, position: int, expected_id: bytes):
+    f.seek(position)
+    header = f.read(_SEGMENT_HEADER.size)
+    if len(header) != _SEGMENT_HEADER.size:
+        raise ValueError('unexpected end of czi file')
+    seg_id, allocated_size, used_size = _SEGMENT_HEADER.unpack(header)
+    if seg_id.rstrip(b'\x00') != expected_id:
+        raise ValueError(f'expected czi segment {expected_id!r}, found '
+                         f'{seg_id!r}')
+    return used_size if used_size > 0 else allocated_size
+
+
+def read_subblock_directory(czi_path: str):
+    """
+    Reads all entries of the subblock directory of a czi file.
+    Parameters:
+    -----------
+    czi_path: str
+        path to czi file
+    Returns:
+    --------
+    entries: list of SubblockEntry, in the order of the directory
+    """
+    with open(czi_path, 'rb') as f:
+        _read_segment(f, 0, b'ZISRAWFILE')
+        file_header = f.read(80)
+        directory_position, = struct.unpack_from('<q', file_header, 52)
+        if directory_position <= 0:
+            raise ValueError('czi file has no subblock directory')
+        used_size = _read_segment(f, directory_position, b'ZISRAWDIRECTORY')
+        buf = f.read(used_size)
+
+    try:
+        entry_count, = struct.unpack_from('<i', buf, 0)
+        offset = 128
+        entries = []
+        for _ in range(entry_count):
+            (schema, pixel_type, file_position, _, compression, pyramid_type,
+             dim_count) = _DIRECTORY_ENTRY.unpack_from(buf, offset)
+            if schema != b'DV':
+                raise ValueError(f'unknown subblock directory schema '
+                                 f'{schema!r}')
+            offset += _DIRECTORY_ENTRY.size
+            index = {}
+            rect = [0, 0, 0, 0]
+            stored_size = [0, 0]
+            for _ in range(dim_count):
+                dim, start, size, _, stored = _DIMENSION_ENTRY.unpack_from(
+                    buf, offset)
+                offset += _DIMENSION_ENTRY.size
+                dim = dim.rstrip(b'\x00').decode('ascii')
+                if dim == 'X':
+                    rect[0], rect[2] = start, size
+                    stored_size[0] = stored
+                elif dim == 'Y':
+                    rect[1], rect[3] = start, size
+                    stored_size[1] = stored
+                else:
+                    index[dim] = start
+            entries.append(SubblockEntry(file_position, pixel_type,
+                                         compression, pyramid_type, index,
+                                         tuple(rect), tuple(stored_size)))
+    except struct.error as e:
+        raise ValueError('corrupt subblock directory in czi file') from e
+    return entries
+
+
+def is_pyramid_subblock(entry: SubblockEntry):
+    """True for subblocks of a pyramid level (not read by read_image or
+    read_subblock_rect). As in libCZI, a subblock belongs to layer 0, if its
+    stored size equals its logical size: ZEN writes many pyramid subblocks
+    with pyramid type 0."""
+    return entry.pyramid_type != 0 or entry.stored_size != entry.rect[2:]
+
+
+def tile_rects(entries, C: int, Z: int, M: int, S: int = 1):
+    """
+    Returns the tile rect (x, y, w, h) of every mosaic tile and checks in one
+    pass over the directory, that the rect does not depend on the C and Z
+    dimensions and that every (C, Z, M) subblock exists (ValueError
+    otherwise).
+    Parameters:
+    -----------
+    entries: list of SubblockEntry
+        subblock directory, see read_subblock_directory()
+    C, Z, M, S: int
+        size of channel, focus, mosaic and scene dimension
+    Returns:
+    --------
+    rects: list (one entry per scene) of lists (one entry per tile) of tuples
+    """
+    rects = {}
+    counts = {}
+    for entry in entries:
+        if is_pyramid_subblock(entry):
+            continue
+        key = (entry.index.get('S', 0), entry.index.get('M', 0))
+        if key not in rects:
+            rects[key] = entry.rect
+            counts[key] = 0
+        elif rects[key] != entry.rect:
+            raise ValueError('tile rect expected to be independent of Z '
+                             'and C dimensions')
+        counts[key] += 1
+
+    tiles = []
+    for s in range(S):
+        scene_tiles = []
+        for m in range(M):
+            if counts.get((s, m), 0) != C * Z:
+                raise ValueError(f'expected {C * Z} subblocks for tile '
+                                 f'M={m} (scene S={s}) in the czi file, '
+                                 f'found {counts.get((s, m), 0)}')
+            scene_tiles.append(rects[(s, m)])
+        tiles.append(scene_tiles)
+    return tiles
+
+
+def try_read_subblock_directory(czi_path: str):
+    """Like read_subblock_directory(), but returns None if the directory can
+    not be read directly (e.g. the file is no plain ZISRAW container)."""
+    try:
+        return read_subblock_directory(czi_path)
+    except (OSError, ValueError):
+        return None
+
+
+def read_tile_rects(czi, entries, C: int, Z: int, M: int, S: int = 1):
+    """
+    Returns the tile positions (x, y, w, h) of all M tiles of every scene (a
+    list per scene) and checks that they are independent of the C and Z
+    dimensions. The rects are taken from the subblock directory (entries); if
+    it could not be read (None) or does not match the expected dimensions,
+    every rect is requested with read_subblock_rect.
+    """
+    if entries is not None:
+        try:
+            return tile_rects(entries, C, Z, M, S)
+        except ValueError:
+            # e.g. subblocks, which are not recognized as pyramid levels
+            pass
+
+    scene_tiles = []
+    for s in range(S):
+        tiles = []
+        for m in range(M):
+            # Get tile position
+            tilepos = czi.read_subblock_rect(S=s, T=0, C=0, Z=0, M=m)
+            tiles.append(tilepos)
+            for (c, z) in product(range(C), range(Z)):
+                cur_tilepos = czi.read_subblock_rect(S=s, T=0, C=c, Z=z, M=m)
+                if cur_tilepos != tilepos:
+                    raise Exception('tile rect expected to be independent of '
+                                    'Z and C dimensions')
+        scene_tiles.append(tiles)
+    return scene_tiles
@@ -0,0 +1,267 @@
+# flat-field / shading statistics, accumulated while the tiles are converted
+# (no second pass over the output). For every cycle and channel the per-pixel
+# mean and variance over all tiles and Z-planes are updated with Welford's
+# algorithm and an intensity histogram (percentile sketch) is counted. Each
+# cycle and region (work unit, possibly in a worker process) saves its partial
+# statistics to 'flatfield/cycNNN_regRRR.npz' (parts of a region, see
+# job_queue.py: 'cycNNN_regRRR_mFFFFF-LLLLL.npz'); the partial statistics of
+# the regions of a cycle are merged (Chan et al.) and the estimates are saved
+# in 'flatfield/' in the output directory. Of every region exactly one set is
+# merged: its whole-region statistics, or the parts of the current job queue
+# plan; superseded files (parts of an earlier plan, or parts replaced by a
+# whole-region conversion) are removed:
+#   - cycNNN_CHCCC_mean.tif, cycNNN_CHCCC_std.tif: per-pixel mean and standard
+#     deviation (float32)
+#   - cycNNN_CHCCC_flatfield.tif: mean normalized to an average of 1
+#   - flatfield.json: number of planes, mean intensity and intensity
+#     percentiles of each cycle and channel
+import os
+import glob
+import json
+import threading
+import numpy as np
+import tifffile
+
+FLAT_FIELD_DIR = 'flatfield'
+FLAT_FIELD_JSON = 'flatfield.json'
+PERCENTILES = (1, 5, 50, 95, 99)
+# maximal number of histogram bins, e.g. bins of 16 intensities for uint16
+MAX_HIST_BINS = 4096
+
+
+def partial_stats_path(outdir: str, i_cyc: int, region: int = 1,
+                       part: str = None):
+    name = 'cyc{:03}_reg{:03}'.format(i_cyc, region)
+    if part is not None:
+        name += '_' + part
+    return os.path.join(outdir, FLAT_FIELD_DIR, name + '.npz')
+
+
+def remove_superseded_stats(outdir: str, i_cyc: int, region: int,
+                            keep: list):
+    """Removes the partial statistics of a region (whole-region and part
+    files), which are not in keep (paths)."""
+    pattern = os.path.join(outdir, FLAT_FIELD_DIR,
+                           'cyc{:03}_reg{:03}*.npz'.format(i_cyc, region))
+    keep = {os.path.abspath(path) for path in keep}
+    for path in glob.glob(pattern):
+        if os.path.abspath(path) not in keep:
+            os.remove(path)
+
+
+class RunningStats:
+    """
+    Per-pixel running mean and variance of the planes of one channel and
+    the histogram of their intensities. The mean and the sum of squared
+    deviations are kept in float32 (8 bytes per pixel and channel in every
+    worker, e.g. 128 MB for 4 channels of 2048 x 2048 tiles).
+    Parameters:
+    -----------
+    shape: tuple
+        (Y, X) of the planes
+    bit_depth: int
+        number of bits of the (unsigned integer) intensities
+    """
+
+    def __init__(self, shape: tuple, bit_depth: int = 16):
+        self.count = 0
+        self.mean = np.zeros(shape, np.float32)
+        self.m2 = np.zeros(shape, np.float32)
+        self.bit_depth = bit_depth
+        bins = min(2 ** bit_depth, MAX_HIST_BINS)
+        self.shift = bit_depth - (bins.bit_length() - 1)
+        self.hist = np.zeros(bins, np.int64)
+
+    def add(self, plane):
+        """Adds one plane (Welford update, vectorized over the pixels)."""
+        self.count += 1
+        delta = plane - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (plane - self.mean)
+        self.hist += np.bincount((plane >> self.shift).ravel(),
+                                 minlength=len(self.hist))
+
+    def merge(self, other: 'RunningStats'):
+        """Adds the statistics of other planes (parallel variance of Chan et
+        al.)."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.hist = other.hist.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta * delta * (self.count * other.count /
+                                               count)
+        self.hist += other.hist
+        self.count = count
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    def percentiles(self, q=PERCENTILES):
+        """Intensity percentiles from the histogram (bin centers)."""
+        cumulative = np.cumsum(self.hist)
+        if cumulative[-1] == 0:
+            return {p: None for p in q}
+        width = 2 ** self.shift
+        bins = np.searchsorted(cumulative, np.asarray(q) / 100 *
+                               cumulative[-1])
+        return {p: float(b * width + (width - 1) / 2)
+                for p, b in zip(q, bins)}
+
+
+class FlatFieldAccumulator:
+    """
+    Running statistics of all channels of one cycle and region. add() is
+    called by the encoder threads of the tile pipeline.
+    Parameters:
+    -----------
+    C: int
+        number of channels
+    shape: tuple
+        (Y, X) of the tiles
+    """
+
+    def __init__(self, C: int, shape: tuple):
+        self.C = C
+        self.shape = tuple(shape)
+        self.channels = [None] * C
+        self._locks = [threading.Lock() for _ in range(C)]
+
+    def add(self, c: int, plane):
+        if not np.issubdtype(plane.dtype, np.unsignedinteger):
+            raise ValueError(f'flat-field statistics need unsigned integer '
+                             f'tiles, not {plane.dtype}')
+        with self._locks[c]:
+            if self.channels[c] is None:
+                self.channels[c] = RunningStats(self.shape,
+                                                plane.dtype.itemsize * 8)
+            self.channels[c].add(plane)
+
+    def counts(self):
+        return [0 if s is None else s.count for s in self.channels]
+
+    def merge(self, other: 'FlatFieldAccumulator'):
+        for c, stats in enumerate(other.channels):
+            if stats is None:
+                continue
+            if self.channels[c] is None:
+                self.channels[c] = RunningStats(self.shape, stats.bit_depth)
+            self.channels[c].merge(stats)
+
+    def save(self, path: str):
+        """Saves the partial statistics (npz, written atomically)."""
+        arrays = {}
+        for c, stats in enumerate(self.channels):
+            if stats is None:
+                continue
+            arrays[f'count_{c}'] = np.array(stats.count)
+            arrays[f'bit_depth_{c}'] = np.array(stats.bit_depth)
+            arrays[f'mean_{c}'] = stats.mean
+            arrays[f'm2_{c}'] = stats.m2
+            arrays[f'hist_{c}'] = stats.hist
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, C=np.array(self.C), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as f:
+            C = int(f['C'])
+            accumulator = None
+            for c in range(C):
+                if f'count_{c}' not in f:
+                    continue
+                if accumulator is None:
+                    accumulator = cls(C, f[f'mean_{c}'].shape)
+                stats = RunningStats(accumulator.shape,
+                                     int(f[f'bit_depth_{c}']))
+                stats.count = int(f[f'count_{c}'])
+                # (statistics of earlier versions are float64)
+                stats.mean = f[f'mean_{c}'].astype(np.float32, copy=False)
+                stats.m2 = f[f'm2_{c}'].astype(np.float32, copy=False)
+                stats.hist = f[f'hist_{c}']
+                accumulator.channels[c] = stats
+        return accumulator
+
+
+def save_flat_field(outdir: str, i_cyc: int, parts: dict = None):
+    """
+    Merges the partial statistics of all regions of a cycle and saves the
+    flat-field estimates of its channels (see the top of this file).
+    Parameters:
+    -----------
+    outdir: str
+        output directory
+    i_cyc: int
+        cycle
+    parts: dict
+        {region: [part names]} of the regions converted in parts (job queue
+        plan, None: the whole region); the other regions are merged from
+        their whole-region statistics
+    Returns the merged FlatFieldAccumulator (None, if no statistics were
+    found).
+    """
+    ff_dir = os.path.join(outdir, FLAT_FIELD_DIR)
+    parts = parts or {}
+    paths = []
+    for region, region_parts in parts.items():
+        region_paths = [partial_stats_path(outdir, i_cyc, region, part)
+                        for part in region_parts]
+        missing = [p for p in region_paths if not os.path.exists(p)]
+        if missing:
+            raise FileNotFoundError(f'flat-field statistics of cycle '
+                                    f'{i_cyc}, region {region} not found: '
+                                    f'{missing}')
+        remove_superseded_stats(outdir, i_cyc, region, region_paths)
+        paths += region_paths
+    # whole-region statistics of the other regions (without part suffix)
+    for path in glob.glob(os.path.join(
+            ff_dir, 'cyc{:03}_reg[0-9][0-9][0-9].npz'.format(i_cyc))):
+        if int(os.path.basename(path)[10:13]) not in parts:
+            paths.append(path)
+    merged = None
+    for path in sorted(paths):
+        accumulator = FlatFieldAccumulator.load(path)
+        if accumulator is None:
+            continue
+        if merged is None:
+            merged = accumulator
+        else:
+            merged.merge(accumulator)
+    if merged is None:
+        return None
+
+    summary_path = os.path.join(ff_dir, FLAT_FIELD_JSON)
+    summary = {}
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r') as f:
+            summary = json.load(f)
+    cycle_summary = {}
+    for c, stats in enumerate(merged.channels):
+        if stats is None:
+            continue
+        name = os.path.join(ff_dir, 'cyc{:03}_CH{:03}_'.format(i_cyc, c + 1))
+        mean = stats.mean.astype(np.float32)
+        average = float(stats.mean.mean())
+        tifffile.imwrite(name + 'mean.tif', mean)
+        tifffile.imwrite(name + 'std.tif',
+                         np.sqrt(stats.variance).astype(np.float32))
+        tifffile.imwrite(name + 'flatfield.tif',
+                         mean / average if average > 0 else mean)
+        cycle_summary['CH{:03}'.format(c + 1)] = {
+            'planes': stats.count,
+            'mean': average,
+            'percentiles': {str(p): v
+                            for p, v in stats.percentiles().items()}}
+    summary['cyc{:03}'.format(i_cyc)] = cycle_summary
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=4, sort_keys=True)
+    return merged
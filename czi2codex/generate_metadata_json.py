@@ -4,19 +4,22 @@ import os
 import glob
 import warnings
 
-import xmltodict
-from aicspylibczi import CziFile
-import numpy as np
 import json
+import argparse
 import yaml
 import lxml
 from lxml import etree
 from typing import Union
 import shutil
 from datetime import datetime
-#import czi2codex
-# from .run_generate_std_options_file import generate_std_options_file  #for jupyter-notebook
-from run_generate_std_options_file import generate_std_options_file
+from .run_generate_std_options_file import generate_std_options_file
+from .czi_cache import CziMetadataCache
+from .metadata_extractor import extract_metadata
+from .output_backends import save_experiment_attrs
+from .tile_overlap import compute_tile_overlaps, write_overlap_report
+from .run_report import RunReport
+from .run_manifest import converted_cycles
+from .selection import Selection, selected_tile_grid
 
 # TODO: cannot find wavelengths, that are given in Sonias experiment.json file
 #   "wavelengths": [
@@ -34,10 +37,10 @@ from run_generate_std_options_file import generate_std_options_file
 #     correction in: zPitch, xyResolution
 #   - for finding number of cycles: searches for '.czi' files in directory
 #       basedir
-#   - tile_x_overl determined by difference between first two tiles, FOR NOW:
-#         # TAKE THE OVERLAP BETWEEN THE FIRST TWO TILES
-#         #  (although there are inconsistencies, we might need to check and
-#         #  incorporate! [205,205,205,204]
+#   - tile overlaps are computed between all neighbouring tiles of all
+#     cycles (tile_overlap.py), the median is taken, since there are small
+#     inconsistencies: [205,205,205,204]. Statistics and outliers are
+#     reported in tile_overlap_report.json
 
 
 def convert_str2float_or_int(x):
@@ -69,12 +72,107 @@ def process_user_options(options_dir: str):
     return default_options
 
 
+def check_metadata(md, user_input: dict):
+    """
+    Consistency checks of the metadata of a czi file (and of the user
+    options), which are needed for experiment.json. Raises an Exception, if a
+    check fails.
+    Parameters:
+    -----------
+    md: metadata_extractor.CziMetadata
+        extracted metadata fields
+    user_input: dict
+        options, see process_user_options()
+    Returns:
+    --------
+    dict with 'region_width', 'region_height' (tile columns and rows),
+    'axial_resolution', 'lateral_resolution' (nm) and 'focus_offset'
+    """
+    # Region_height, region_width (one TileRegion per scene, all regions
+    # need the same tile grid)
+    region_grids = set(md.tile_regions)
+    if len(region_grids) != 1:
+        raise ValueError(f'All regions need the same number of tile columns '
+                         f'and rows, found (columns, rows): '
+                         f'{sorted(region_grids)}')
+    (region_width, region_height), = region_grids
+
+    C = len(md.channels)
+    if len(user_input['wavelengths']) != C:
+        raise ValueError(f"The number of given wavelengths ("
+                         f"{len(user_input['wavelengths'])}) in the "
+                         f"options.yaml file doesn't coincide with the number "
+                         f"of channels ({C}). "
+                         "Please check the given wavelengths. ")
+    em_wv_int = [int(channel.emission_wavelength) for channel in md.channels]
+    for i_wv in user_input['wavelengths']:
+        if i_wv not in em_wv_int:
+            warnings.warn('The user defined wavelengths do not coincide with the '
+                    'Emission wavelengths found in the metadata. \n'
+                    'User defined wavelengths: \n' +
+                    str(user_input['wavelengths']) + '\n'
+                    'Emission wavelengths extracted from metadata: \n' +
+                    str(em_wv_int) + '\nPlease check. User inputed wavelengths '
+                                     'are taken.')
+
+    # -------
+    # Z Pitch = axial resolution
+    # units in codex are in nanometers
+    default_corr_to_codex_units = 1e9
+    axial_resolution = md.scaling['Z'] * default_corr_to_codex_units
+    # check - compare to axial_resolution from Distance tag Z-distance
+    axial_resolution2 = md.z_interval * default_corr_to_codex_units
+    if axial_resolution != axial_resolution2:
+        raise Exception('Axial resolutions inferred from two independent spots'
+                        ' are not the same! Please check!')
+
+    # -------
+    # xyResolution = Lateral_resolution = pixelsize  / magnification
+    magnification = md.magnification
+    pixelsize = list(md.pixel_size)
+    if pixelsize[0] == pixelsize[1]:
+        lateral_resolution = pixelsize[0] / magnification * \
+                             1e-6 * default_corr_to_codex_units
+    else:
+        raise Exception('Pixelsize is not squared, does this make sense?')
+    # compare to Lateral_resolution from Distance tag
+    lat_resolutionx = md.scaling['X'] * default_corr_to_codex_units
+    lat_resolutiony = md.scaling['Y'] * default_corr_to_codex_units
+    if lat_resolutionx != lat_resolutiony:
+        raise Exception(
+            'Distance x resolution does not equal Distance y resolution.'
+            'Please check!')
+    if lateral_resolution != lat_resolutionx:
+        raise Exception(
+            'Computed lateral resolution and shown in X-Distance is not '
+            'the same! Please check!')
+
+    # ----------
+    # Focus Offset
+    focus_offset_list = list(md.focus_offsets)
+    # check if focus_offset is the same for all channels
+    if len(set(focus_offset_list)) == 1:
+        f_o = focus_offset_list[0]
+        focus_offset = convert_str2float_or_int(f_o)
+    else:
+        raise ValueError('Focus offset is not the same for all channels. '
+                         'Please check, which focus-offset value should be '
+                         'taken.')
+
+    return {'region_width': region_width, 'region_height': region_height,
+            'axial_resolution': axial_resolution,
+            'lateral_resolution': lateral_resolution,
+            'focus_offset': focus_offset}
+
+
 def meta_to_json(meta: Union[str, lxml.etree._Element],
                  czidir: str,
                  outdir: str,
                  channelnames: str,
                  options_dir: str,
-                 exposuretime: str=None):
+                 exposuretime: str=None,
+                 cache: CziMetadataCache=None,
+                 report: RunReport=None):
     """
     Creates experiment.json.
     Parameters
@@ -92,7 +190,26 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
         path to exposure_times.txt file
     options_dir: str
         directory to options.json file
+    cache: CziMetadataCache
+        cache of opened czi files and their metadata (e.g. the one used in
+        czi_to_tiffs). If not given, the czi file of the first cycle is opened
+    report: RunReport
+        the time for generating experiment.json (stage 'experiment_json') and
+        for parsing xml (stage 'xml_parse') are added to it
+    Returns:
+    --------
+    dict_json: dict
+        the fields saved in experiment.json
     """
+    if report is None:
+        report = RunReport()
+    with report.totals.timer('experiment_json'):
+        return _meta_to_json(meta, czidir, outdir, channelnames, options_dir,
+                      exposuretime, cache, report)
+
+
+def _meta_to_json(meta, czidir, outdir, channelnames, options_dir,
+                  exposuretime, cache, report):
     print(f"Starting to generate experiment.json file.")
     tiling_mode = 'grid'    # TODO infer or user input?
 
@@ -115,29 +232,16 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     #   available?
     basename = czi_filename.format(1) #'2020.07.08 Tonsil_betaTEST_sfter2-01'
 
-    # parse Metadata to dict
-    if isinstance(meta, str):
-        # basename, _ = os.path.splitext(os.path.basename(meta))
-        with open(meta, 'r') as f:
-            contents = f.read()
-        d = xmltodict.parse(contents)
-    elif isinstance(meta, lxml.etree._Element):
-        d = xmltodict.parse(etree.tostring(meta))
-
-    # Introducing some shortcuts
-    d_meta = d['ImageDocument']['Metadata']
-    d_obj = d_meta['Information']['Instrument']['Objectives']['Objective']
-    d_channel = d_meta['Information']['Image']['Dimensions']['Channels'][
-        'Channel']
-    d_region_00 = d_meta['Experiment']['ExperimentBlocks']['AcquisitionBlock'][
-        'SubDimensionSetups']['RegionsSetup']
-    d_region_tile = d_region_00['SampleHolder']['TileRegions'][
-        'TileRegion']
-    d_region_multitrack = d_region_00['SubDimensionSetups']['TilesSetup'][
-        'SubDimensionSetups']['MultiTrackSetup']
-    d_region_dist = d_region_multitrack['SubDimensionSetups'][
-        'ZStackSetup']['Interval']['Distance']
-    d_dist = d_meta['Scaling']['Items']['Distance']
+    if cache is None:
+        cache = CziMetadataCache()
+
+    # extract the used fields of the metadata (metadata_extractor.py)
+    with report.totals.timer('xml_parse'):
+        if isinstance(meta, str):
+            # basename, _ = os.path.splitext(os.path.basename(meta))
+            md = extract_metadata(etree.parse(meta))
+        elif isinstance(meta, lxml.etree._Element):
+            md = cache.metadata(meta)
 
     # ------------------
     # Cycle information
@@ -146,6 +250,12 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     for i in range(num_cycles):
         cycles_nr_list.append(int(os.path.splitext(os.path.basename(
             czi_files[i]))[0][-2:]))
+    # with selected cycles: all cycles converted into outdir (see
+    # selection.py), experiment.json then describes the output directory
+    selection = Selection.from_options(user_input) or Selection()
+    if selection.cycles is not None:
+        cycles_nr_list = converted_cycles(outdir)
+        num_cycles = len(cycles_nr_list)
 
     # ------------
     # read channelnames.txt and exposure_time.txt
@@ -165,120 +275,65 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     # Per_cycle_channel_names & Emission wavelength
     channel_names = []
     em_wv = []
-    for i_c in range(len(d_channel)):
-        channel_names.append(d_channel[i_c]['@Name'])
-        em_wv.append(d_channel[i_c]['EmissionWavelength'])
-
-        # Region_height, region_width
-        region_width = int(d_region_tile['Columns'])
-        region_height = int(d_region_tile['Rows'])
-
-        # ----------
-        # Tile width, tile height
-        # Tile_overlap: calculate with read_subblock_rect
-        czi = CziFile(os.path.join(basedir, basename + '.czi'))
-        S, T, C, Z, M, Y, X = czi.size
-        tilepos = []
-        # Get tile position,
-        for m in range(M):
-            tilepos.append(czi.read_subblock_rect(S=0, T=0, C=0, Z=0, M=m))
-        tile_width = tilepos[0][2]
-        tile_height = tilepos[0][3]
-        tile_x_overl = []
-        tile_y_overl = []
-        if tiling_mode == 'grid':
-            for i_x in range(region_width - 1):
-                tile_x_overl.append((tilepos[i_x][0] + tile_width) -
-                                    tilepos[i_x + 1][0])
-            for i_y in np.arange(0, M - region_width, region_width):
-                tile_y_overl.append((tilepos[i_y][1] + tile_height) -
-                                    tilepos[i_y + region_width][1])
-        else:
-            raise Exception(
-                'Calculation of tile overlaps for other tiling_modes'
-                '(than grid) not implemented yet. Please do so.')
-        # TODO: (?) FOR NOW: TAKE THE OVERLAP BETWEEN THE FIRST TWO TILES
-        #  (although there are inconsistencies, we might need to check and
-        #  incorporate! [205,205,205,204]
-        tile_overlap_x = round(tile_x_overl[0]/tile_width, 1)
-        tile_overlap_y = round(tile_y_overl[0]/tile_height, 1)
+    for channel in md.channels:
+        channel_names.append(channel.name)
+        em_wv.append(channel.emission_wavelength)
 
-    if len(user_input['wavelengths']) != C:
-        raise ValueError(f"The number of given wavelengths ("
-                         f"{len(user_input['wavelengths'])}) in the "
-                         f"options.yaml file doesn't coincide with the number "
-                         f"of channels ({C}). "
-                         "Please check the given wavelengths. ")
-    em_wv_int = [int(i) for i in em_wv]
-    for i_wv in user_input['wavelengths']:
-        if i_wv not in em_wv_int:
-            warnings.warn('The user defined wavelengths do not coincide with the '
-                    'Emission wavelengths found in the metadata. \n'
-                    'User defined wavelengths: \n' +
-                    str(user_input['wavelengths']) + '\n'
-                    'Emission wavelengths extracted from metadata: \n' +
-                    str(em_wv_int) + '\nPlease check. User inputed wavelengths '
-                                     'are taken.')
+    # consistency checks of the metadata and the values derived from it
+    checked = check_metadata(md, user_input)
+    region_width = checked['region_width']
+    region_height = checked['region_height']
+
+    # ----------
+    # Tile width, tile height
+    # Tile_overlap: computed at once over all tiles of all cycles, the tile
+    # rects (read_subblock_rect) are taken from the cache
+    record = cache.get(os.path.join(basedir, basename + czi_ext))
+    S, T, C, Z, M, Y, X = record.size
+    if tiling_mode != 'grid':
+        raise Exception(
+            'Calculation of tile overlaps for other tiling_modes'
+            '(than grid) not implemented yet. Please do so.')
+    cycle_records = [cache.get(os.path.join(basedir, czi_filename.format(
+        i_cyc) + czi_ext)) for i_cyc in sorted(cycles_nr_list)]
+    # selected tiles of all regions of all cycles, regions without selected
+    # tiles are not converted; with a selection of tiles, region_width and
+    # region_height are those of the selected tile grid
+    cycle_tiles = []
+    for r in cycle_records:
+        selected, grid = selected_tile_grid(r.scene_tiles, selection)
+        cycle_tiles.append(selected)
+        if grid is not None:
+            region_width, region_height = grid
+    regions = [s + 1 for s, tiles in enumerate(cycle_tiles[0]) if tiles]
+    # all regions of all cycles, the cycles of the overlap report are then
+    # (cycle, region) in this order
+    overlaps = compute_tile_overlaps([tiles for scene_tiles in cycle_tiles
+                                      for tiles in scene_tiles if tiles],
+                                     region_width)
+    # selected channels and Z-planes, the output is numbered anew
+    num_czi_channels = C
+    channel_indices = selection.channel_indices(C)
+    C = len(channel_indices)
+    Z = len(selection.z_indices(Z))
+    channel_names = [channel_names[c] for c in channel_indices]
+    wavelengths = [user_input['wavelengths'][c] for c in channel_indices]
+    tile_width = overlaps.tile_width
+    tile_height = overlaps.tile_height
+    # The overlaps are not exactly the same for all tiles (e.g.
+    # [205,205,205,204]), the median over all tiles and cycles is taken.
+    # Statistics and outliers are saved in tile_overlap_report.json.
+    tile_overlap_x = overlaps.fraction_x
+    tile_overlap_y = overlaps.fraction_y
+    write_overlap_report(overlaps, outdir)
 
     # tile_width_after = tile_width - math.floor(tile_overlap_x*tile_width)
     # tile_height_after = tile_height - math.floor(tile_overlap_y*tile_height)
 
-    # -------
-    # Z Pitch = axial resolution
-    # units in codex are in nanometers
-    default_corr_to_codex_units = 1e9
-    for i_dim in range(len(d_dist)):
-        if d_dist[i_dim]['@Id'] == 'Z':
-            axial_resolution = float(d_dist[i_dim]['Value']) * \
-                               default_corr_to_codex_units
-    # check - compare to axial_resolution from Distance tag Z-distance
-    axial_resolution2 = float(d_region_dist['Value']) * \
-                        default_corr_to_codex_units
-    if axial_resolution != axial_resolution2:
-        raise Exception('Axial resolutions inferred from two independent spots'
-                        ' are not the same! Please check!')
-
-    # -------
-    # xyResolution = Lateral_resolution = pixelsize  / magnification
-    magnification = float(d_obj['NominalMagnification'])
-    pixelsize_str = d_meta['ImageScaling']['ImagePixelSize']
-    pixelsize_map = map(float, pixelsize_str.split(','))
-    pixelsize = list(pixelsize_map)
-    if pixelsize[0] == pixelsize[1]:
-        lateral_resolution = pixelsize[0] / magnification * \
-                             1e-6 * default_corr_to_codex_units
-    else:
-        raise Exception('Pixelsize is not squared, does this make sense?')
-    # compare to Lateral_resolution from Distance tag
-    for i_dim in range(len(d_dist)):
-        if d_dist[i_dim]['@Id'] == 'X':
-            lat_resolutionx = float(
-                d_dist[i_dim]['Value']) * default_corr_to_codex_units
-        if d_dist[i_dim]['@Id'] == 'Y':
-            lat_resolutiony = float(
-                d_dist[i_dim]['Value']) * default_corr_to_codex_units
-    if lat_resolutionx != lat_resolutiony:
-        raise Exception(
-            'Distance x resolution does not equal Distance y resolution.'
-            'Please check!')
-    if lateral_resolution != lat_resolutionx:
-        raise Exception(
-            'Computed lateral resolution and shown in X-Distance is not '
-            'the same! Please check!')
-
-    # ----------
-    # Focus Offset
-    focus_offset_list = []
-    for i in range(len(d_region_multitrack['Track'])):
-        focus_offset_list.append(d_region_multitrack['Track'][i]['FocusOffset'])
-    # check if focus_offset is the same for all channels
-    if len(set(focus_offset_list)) == 1:
-        f_o = focus_offset_list[0]
-        focus_offset = convert_str2float_or_int(f_o)
-    else:
-        raise ValueError('Focus offset is not the same for all channels. '
-                         'Please check, which focus-offset value should be '
-                         'taken.')
+    axial_resolution = checked['axial_resolution']
+    lateral_resolution = checked['lateral_resolution']
+    magnification = md.magnification
+    focus_offset = checked['focus_offset']
 
     timestamp = datetime.now()
     dateprocessed = timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")
@@ -290,26 +345,26 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     dict_json['version'] = "1.x.x.x"    # TODO ? user defined?
     dict_json['name'] = basename
     dict_json['runName'] ="2020-11-04"  # TODO ? user defined?
-    dict_json['date'] = d_meta['Information']['Document']['CreationDate']
+    dict_json['date'] = md.creation_date
     dict_json['dateProcessed'] = dateprocessed
     dict_json['path'] = basedir
     dict_json['outputPath'] = outdir
     dict_json['codex_instrument'] = user_input['codex_instrument'] # TODO done,  possibility of user input
-    dict_json['microscope'] = d_meta['Information']['Instrument'][
-        'Microscopes']['Microscope']['@Name']
+    dict_json['microscope'] = md.microscope
     dict_json['magnification'] = magnification
-    dict_json['aperture'] = float(d_obj['LensNA'])
-    dict_json['objectiveType'] = d_obj['Immersion']
+    dict_json['aperture'] = md.lens_na
+    dict_json['objectiveType'] = md.immersion
     dict_json['xyResolution'] = lateral_resolution    # 377.442
     dict_json['zPitch'] = axial_resolution     # 1500.0
     # dict_json['channel_arrangement'] = "grayscale" # TODO done, does not exist in SONIAs example file, only in codex-examplefile. tocheck
     dict_json['per_cycle_channel_names'] = channel_names  # [', '.join(map(str, channel_names))]
-    dict_json['wavelengths'] = user_input['wavelengths']  #list(map(int, em_wv)) #[', '.join(map(int, em_wv))]
-    dict_json['bitDepth'] = int(d_meta['Information']['Image'][
-                                    'ComponentBitCount'])
-    dict_json['numRegions'] = S
-    dict_json['numCycles'] = len(czi_files)
-    dict_json['numZPlanes'] = Z
+    dict_json['wavelengths'] = wavelengths  #list(map(int, em_wv)) #[', '.join(map(int, em_wv))]
+    dict_json['bitDepth'] = md.bit_depth
+    dict_json['numRegions'] = len(regions)
+    dict_json['numCycles'] = num_cycles
+    # with a z-projection, one plane per tile and channel is saved
+    num_z_saved = 1 if user_input['1_z_projection'] else Z
+    dict_json['numZPlanes'] = num_z_saved
     dict_json['numChannels'] = C
     dict_json['regionWidth'] = region_width
     dict_json['regionHeight'] = region_height
@@ -334,15 +389,22 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     dict_json['useBlindDeconvolution'] = user_input['useBlindDeconvolution']  # TODO done
     dict_json['useDiagnosticMode'] = user_input['useDiagnosticMode']  # TODO done
 
-    dict_json['channelNames'] = {'channelNamesArray': [x.strip() for x in cn]}
+    names = [x.strip() for x in cn]
+    if len(names) == len(czi_files) * num_czi_channels:
+        # channelnames.txt lists every channel of every cycle: names of the
+        # converted cycles and selected channels
+        names = [name for i, name in enumerate(names)
+                 if i // num_czi_channels + 1 in cycles_nr_list and
+                 i % num_czi_channels in channel_indices]
+    dict_json['channelNames'] = {'channelNamesArray': names}
     dict_json['exposureTimes'] = {
         'exposureTimesArray': [(line.strip()).split(',') for line in et]}
 
     dict_json['projName'] = basename
-    dict_json['regIdx'] = [S]           # TODO done, is that correct? no idea..., leave it as it is in the example
+    dict_json['regIdx'] = regions  # regions (scenes) are saved as reg001, reg002, ...
     dict_json['cycle_lower_limit'] = min(cycles_nr_list)
     dict_json['cycle_upper_limit'] = max(cycles_nr_list)
-    dict_json['num_z_planes'] = user_input['num_z_planes']   # TODO done, Maybe the number of output z-planes (after focus merging), but I am not sure. For the moment I would leave it as in the example
+    dict_json['num_z_planes'] = min(user_input['num_z_planes'], num_z_saved)   # TODO done, Maybe the number of output z-planes (after focus merging), but I am not sure. For the moment I would leave it as in the example
     dict_json['region_width'] = region_width
     dict_json['region_height'] = region_height
     dict_json['tile_width'] = user_input['tile_width_minus_overlap'] # TODO done , could be defined by 2048-math.floor(2048*0.1) , Above tile_width was 2048, where is this 1844 coming from?
@@ -357,6 +419,58 @@ def meta_to_json(meta: Union[str, lxml.etree._Element],
     print('...Finished writing experiment.json file!..... \n'
           f'...Saved in {outdir}')
 
-    return
+    return dict_json
 
 
+def experiment_json(options_dir: str):
+    """
+    Generates experiment.json of an output directory, which is converted
+    already (the tifs and exposure_times.txt exist), e.g. after changing the
+    processor settings in options.yaml. Nothing is converted, the metadata
+    is read from the czi file of the first converted cycle.
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file,
+        (e.g. '/dir/to/czifiles/options.yaml')
+    Returns:
+    --------
+    dict_json: dict
+        the fields saved in experiment.json
+    """
+    user_input = process_user_options(options_dir)
+    czidir = user_input['1_czidir']
+    outdir = user_input['1_outdir']
+    czi_filename, czi_ext = os.path.splitext(czidir)
+    i_cyc = min(converted_cycles(outdir) or [1])
+    cache = CziMetadataCache()
+    report = RunReport()
+    meta = cache.get(czi_filename.format(i_cyc) + czi_ext).meta
+    dict_json = meta_to_json(meta, czidir, outdir,
+                             user_input['1_channelnames_dir'], options_dir,
+                             cache=cache, report=report)
+    save_experiment_attrs(user_input['1_output_backend'], outdir, dict_json)
+    return dict_json
+
+
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex json', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Generate experiment.json '
+                                                 'of a converted output '
+                                                 'directory (nothing is '
+                                                 'converted). Input: '
+                                                 'Directory to options.yaml')
+    parser.add_argument("options_dir", help="Directory to options.yaml file."
+                                            " (e.g. '/dir/to/optionfile/"
+                                            "options.yaml')",
+                        type=str)
+
+    args = parser.parse_args(argv)
+
+    experiment_json(options_dir=args.options_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+# multi-node conversion through a job queue on a shared filesystem. The
+# experiment is split into work units (cycle, region, tile range), which any
+# number of worker processes on any node with access to the output directory
+# claim and convert:
+#   plan      the coordinator writes the units into the queue directory
+#             'czi2codex_queue/' in the output directory (plan.json)
+#   worker    claims units by creating 'units/<unit>.lock' exclusively
+#             (O_CREAT | O_EXCL, atomic on local filesystems and NFSv3+),
+#             converts them and marks them done ('units/<unit>.done'). While a
+#             unit is converted, its lock file is touched every heartbeat
+#             seconds; a lock which was not touched for stale seconds belongs
+#             to a dead worker and is taken over by another worker (which
+#             resumes the unit from its run manifest). The clocks of the nodes
+#             must agree within a fraction of the stale time.
+#   assemble  once every unit is done: merges the flat-field statistics and
+#             overviews of the parts, writes exposure_times.txt (from the run
+#             manifest), experiment.json and the run report (of all units)
+#   local     plan, a number of local worker processes and assemble, e.g. for
+#             testing on one machine
+# A failed unit is marked 'units/<unit>.failed' (with the error) and is not
+# claimed again; plan re-queues failed units and keeps the done ones, unless
+# their czi file or conversion settings changed (the fingerprint of the unit
+# is recorded in its '.done' file).
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import argparse
+import threading
+import traceback
+import subprocess
+from .czi2tif_codex import _run_cycle, check_conversion_settings
+from .czi_cache import CziMetadataCache
+from .flat_field import save_flat_field
+from .generate_metadata_json import meta_to_json, process_user_options
+from .output_backends import get_output_backend, save_experiment_attrs
+from .overview import merge_overview_parts
+from .run_manifest import (read_exposure_times, write_exposure_times_file,
+                           part_name, source_fingerprint)
+from .run_report import RunReport
+from .run_czi2codex import check_paths, conversion_kwargs
+from .selection import Selection, selected_tile_grid
+
+QUEUE_DIR = 'czi2codex_queue'
+PLAN_FILENAME = 'plan.json'
+# conversion options, which do not change the output of a unit
+RUNTIME_OPTIONS = ('encoder_threads', 'read_queue_size', 'write_queue_size',
+                   'resume', 'read_order', 'prefetch_mb', 'memory_budget_mb')
+
+
+def queue_dir(outdir: str):
+    return os.path.join(outdir, QUEUE_DIR)
+
+
+def _unit_path(outdir: str, unit_id: str, ext: str):
+    return os.path.join(queue_dir(outdir), 'units', unit_id + ext)
+
+
+def _write_json(path: str, data: dict):
+    """Writes a json file atomically (complete or not at all)."""
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def read_plan(outdir: str):
+    path = os.path.join(queue_dir(outdir), PLAN_FILENAME)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No job queue found in {outdir}, please run '
+                                f'"job_queue.py plan" first.')
+    return _read_json(path)
+
+
+def unit_settings(user_input: dict):
+    """Conversion settings of the units (the options, which change their
+    output), for their fingerprint."""
+    kwargs = conversion_kwargs(user_input)
+    settings = {k: v for k, v in kwargs.items() if k not in RUNTIME_OPTIONS}
+    selection = settings.pop('selection')
+    settings['selection'] = selection.to_settings() if selection else None
+    settings['template'] = user_input['1_out_template']
+    # as read back from the json files of the queue
+    return json.loads(json.dumps(settings, default=str))
+
+
+def plan_queue(options_dir: str, tiles_per_unit: int = 16):
+    """
+    Splits the conversion into work units and writes the job queue into the
+    output directory (coordinator). Units of a previous plan, which are done
+    with the same czi file and conversion settings, are kept; failed units
+    and units of changed files or settings are queued again.
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file,
+        (e.g. '/dir/to/czifiles/options.yaml')
+    tiles_per_unit: int
+        number of tiles of a unit (all channels and Z-planes of these tiles).
+        0: one unit per cycle and region
+    Returns:
+    --------
+    plan: dict
+        'options_dir', 'options' (the options of all workers) and 'units':
+        list of {'id', 'cycle', 'czi_path', 'scene', 'part', 'fingerprint'}
+    """
+    user_input = process_user_options(options_dir)
+    czidir = user_input['1_czidir']
+    outdir = user_input['1_outdir']
+    check_paths(user_input)
+    kwargs = conversion_kwargs(user_input)
+    # fail before any unit is queued, if the codec, the backend or the
+    # z-projection is not available
+    check_conversion_settings(**kwargs)
+    get_output_backend(kwargs['output_backend']).prepare(outdir)
+
+    czi_filename, czi_ext = os.path.splitext(os.path.basename(czidir))
+    basedir = os.path.dirname(czidir)
+    num_cycles = len(glob.glob(os.path.join(basedir, '*' + czi_ext)))
+    if num_cycles == 0:
+        raise FileNotFoundError('No czi-files where found in the user '
+                                'specified directory: \n' + czidir)
+    selection = kwargs['selection'] or Selection()
+    settings = unit_settings(user_input)
+    cache = CziMetadataCache()
+    units = []
+    for i_cyc in selection.cycle_list(num_cycles):
+        czi_path = os.path.join(basedir, czi_filename.format(i_cyc) + czi_ext)
+        fingerprint = source_fingerprint(czi_path, settings)
+        # fails before any unit is queued, if the selected tiles are no
+        # complete tile grid
+        selected, _ = selected_tile_grid(cache.get(czi_path).scene_tiles,
+                                         selection)
+        for scene, tiles in enumerate(selected):
+            M = len(tiles)
+            step = tiles_per_unit if tiles_per_unit else max(M, 1)
+            for first in range(0, M, step):
+                part = (first, min(first + step, M))
+                units.append({'id': 'cyc{:03}_reg{:03}_{}'.format(
+                                  i_cyc, scene + 1, part_name(part)),
+                              'cycle': i_cyc, 'czi_path': czi_path,
+                              'scene': scene, 'part': list(part),
+                              'fingerprint': fingerprint})
+
+    units_dir = os.path.join(queue_dir(outdir), 'units')
+    os.makedirs(units_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(units_dir, '*.failed')):
+        os.remove(path)
+    # done units of another czi file or other settings are converted again
+    num_changed = 0
+    for unit in units:
+        done_path = _unit_path(outdir, unit['id'], '.done')
+        if os.path.exists(done_path) and _read_json(done_path).get(
+                'fingerprint') != unit['fingerprint']:
+            os.remove(done_path)
+            num_changed += 1
+    if num_changed:
+        print(f'Job queue: {num_changed} done units are queued again (czi '
+              f'file or conversion settings changed)')
+    plan = {'options_dir': os.path.abspath(options_dir),
+            'options': user_input, 'units': units}
+    _write_json(os.path.join(queue_dir(outdir), PLAN_FILENAME), plan)
+    print(f'Job queue: {len(units)} units in {queue_dir(outdir)}')
+    return plan
+
+
+def queue_status(outdir: str, stale: float = 300.0):
+    """Returns {'done', 'failed', 'running', 'stale', 'queued'}: the unit ids
+    of the plan by state."""
+    status = {'done': [], 'failed': [], 'running': [], 'stale': [],
+              'queued': []}
+    now = time.time()
+    for unit in read_plan(outdir)['units']:
+        unit_id = unit['id']
+        if os.path.exists(_unit_path(outdir, unit_id, '.done')):
+            status['done'].append(unit_id)
+        elif os.path.exists(_unit_path(outdir, unit_id, '.failed')):
+            status['failed'].append(unit_id)
+        else:
+            try:
+                age = now - os.stat(_unit_path(outdir, unit_id,
+                                               '.lock')).st_mtime
+            except OSError:
+                status['queued'].append(unit_id)
+                continue
+            status['stale' if age > stale else 'running'].append(unit_id)
+    return status
+
+
+class UnitLock:
+    """
+    Exclusive claim of a work unit by a lock file on the shared filesystem,
+    which is touched every heartbeat seconds while the unit is converted.
+    Parameters:
+    -----------
+    path: str
+        path to the lock file
+    worker: str
+        name of the worker (host and process id)
+    heartbeat: float
+        seconds between two touches of the lock file
+    """
+
+    def __init__(self, path: str, worker: str, heartbeat: float = 30.0):
+        self.path = path
+        self.worker = worker
+        self.heartbeat = heartbeat
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, stale: float = None):
+        """Creates the lock file, True if the unit was claimed. A lock file
+        older than stale seconds is taken over (None: never)."""
+        if stale is not None:
+            self._break_stale(stale)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker, 'claimed': time.time()}, f)
+        self._thread = threading.Thread(target=self._touch, daemon=True)
+        self._thread.start()
+        return True
+
+    def _break_stale(self, stale: float):
+        try:
+            if time.time() - os.stat(self.path).st_mtime <= stale:
+                return
+            # only one worker renames the stale lock file
+            broken = f'{self.path}.{self.worker}.stale'
+            os.rename(self.path, broken)
+        except OSError:
+            return
+        if time.time() - os.stat(broken).st_mtime > stale:
+            print(f'Taking over the unit of a dead worker: '
+                  f'{os.path.basename(self.path)}')
+            os.remove(broken)
+            return
+        # another worker had claimed the unit in between: give it back
+        try:
+            os.link(broken, self.path)
+        except OSError:
+            pass
+        os.remove(broken)
+
+    def _touch(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                os.utime(self.path)
+            except OSError:
+                print(f'WARNING: the lock file {self.path} was removed, the '
+                      f'unit may be converted twice.')
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def run_worker(options_dir: str, poll: float = 10.0, stale: float = 300.0,
+               heartbeat: float = 30.0, max_units: int = None):
+    """
+    Claims and converts units of the job queue, until every unit is done or
+    failed (units claimed by other live workers are waited for, such that
+    they are taken over if their worker dies).
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file, which was used for the plan
+    poll: float
+        seconds between two scans of the queue, while all remaining units are
+        claimed by other workers
+    stale: float
+        seconds without heartbeat, after which the unit of a worker is taken
+        over
+    heartbeat: float
+        seconds between two touches of the lock file of a claimed unit
+    max_units: int
+        stop after this many units (converted or failed). None: no limit
+    Returns:
+    --------
+    converted: list
+        ids of the units converted by this worker (failed units are not
+        listed)
+    """
+    outdir = process_user_options(options_dir)['1_outdir']
+    plan = read_plan(outdir)
+    user_input = plan['options']
+    template = user_input['1_out_template']
+    kwargs = conversion_kwargs(user_input)
+    # a unit, which is taken over, continues from its run manifest
+    kwargs['resume'] = True
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    cache = CziMetadataCache()
+    converted = []
+    num_claimed = 0
+    print(f'Worker {worker}: {len(plan["units"])} units in the queue.')
+    while max_units is None or num_claimed < max_units:
+        claimed = False
+        waiting = 0
+        for unit in plan['units']:
+            unit_id = unit['id']
+            if os.path.exists(_unit_path(outdir, unit_id, '.done')) or \
+                    os.path.exists(_unit_path(outdir, unit_id, '.failed')):
+                continue
+            lock = UnitLock(_unit_path(outdir, unit_id, '.lock'), worker,
+                            heartbeat)
+            if not lock.acquire(stale):
+                waiting += 1
+                continue
+            try:
+                if os.path.exists(_unit_path(outdir, unit_id, '.done')):
+                    # done in between
+                    continue
+                claimed = True
+                num_claimed += 1
+                if _convert_unit(unit, outdir, template, kwargs, cache,
+                                 worker):
+                    converted.append(unit_id)
+            finally:
+                lock.release()
+            break
+        if not claimed:
+            if waiting == 0:
+                break
+            time.sleep(poll)
+    print(f'Worker {worker}: converted {len(converted)} units'
+          + (f', {num_claimed - len(converted)} failed.'
+             if num_claimed > len(converted) else '.'))
+    return converted
+
+
+def _convert_unit(unit: dict, outdir: str, template: str, kwargs: dict,
+                  cache: CziMetadataCache, worker: str):
+    """Converts one unit and marks it done (or failed). Returns True, if it
+    was converted."""
+    unit_id = unit['id']
+    print(f'Worker {worker}: converting {unit_id}')
+    try:
+        tile_meta, cycle_stats, wall_time = _run_cycle(
+            unit['cycle'], unit['czi_path'], outdir, template,
+            dict(kwargs, part=tuple(unit['part'])), cache, unit['scene'])
+    except Exception as e:
+        _write_json(_unit_path(outdir, unit_id, '.failed'),
+                    {'worker': worker, 'error': str(e),
+                     'traceback': traceback.format_exc()})
+        print(f'Worker {worker}: {unit_id} failed: {e}')
+        return False
+    _write_json(_unit_path(outdir, unit_id, '.done'),
+                {'worker': worker, 'stats': cycle_stats,
+                 'wall_time_s': wall_time,
+                 'fingerprint': unit.get('fingerprint')})
+    return True
+
+
+def assemble(options_dir: str, wait: bool = False, poll: float = 10.0,
+             stale: float = 300.0):
+    """
+    Writes the results of the whole experiment, once every unit of the job
+    queue is done: flat-field estimates, overviews, exposure_times.txt,
+    experiment.json and the run report.
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file, which was used for the plan
+    wait: bool
+        wait until every unit is done (otherwise an Exception is raised, if
+        units are missing). Failed units always raise an Exception
+    poll: float
+        seconds between two checks of the queue (with wait)
+    stale: float
+        seconds without heartbeat, after which a unit counts as abandoned
+    """
+    outdir = process_user_options(options_dir)['1_outdir']
+    plan = read_plan(outdir)
+    user_input = plan['options']
+    while True:
+        status = queue_status(outdir, stale)
+        missing = len(plan['units']) - len(status['done'])
+        if status['failed']:
+            raise Exception(f"{len(status['failed'])} units failed: "
+                            f"{status['failed']}. The errors are saved in "
+                            f"{os.path.join(queue_dir(outdir), 'units')}; "
+                            f"run plan again to queue them again.")
+        if missing == 0:
+            break
+        if not wait:
+            raise Exception(f"{missing} of {len(plan['units'])} units are not "
+                            f"done yet ({len(status['running'])} running, "
+                            f"{len(status['stale'])} abandoned, "
+                            f"{len(status['queued'])} queued).")
+        time.sleep(poll)
+
+    kwargs = conversion_kwargs(user_input)
+    report = RunReport(dict(kwargs, template=user_input['1_out_template'],
+                            queue_units=len(plan['units'])))
+    cycles = sorted({unit['cycle'] for unit in plan['units']})
+    # the parts of the plan per cycle and region: only their flat-field
+    # statistics and overview canvases are merged
+    parts = {}
+    for unit in plan['units']:
+        parts.setdefault(unit['cycle'], {}).setdefault(
+            unit['scene'] + 1, []).append(part_name(unit['part']))
+    for unit in plan['units']:
+        done = _read_json(_unit_path(outdir, unit['id'], '.done'))
+        report.add_cycle(unit['cycle'], done['stats'], done['wall_time_s'],
+                         region=unit['scene'] + 1,
+                         part=part_name(unit['part']))
+    if kwargs['flat_field']:
+        for i_cyc in cycles:
+            save_flat_field(outdir, i_cyc, parts.get(i_cyc))
+    if kwargs['overview_factor']:
+        for i_cyc, cycle_parts in sorted(parts.items()):
+            for region, region_parts in sorted(cycle_parts.items()):
+                merge_overview_parts(outdir, i_cyc, region, region_parts)
+    write_exposure_times_file(outdir, read_exposure_times(outdir, cycles))
+    print(f"...finished generation of .tif files and exposure.txt file! ...\n"
+          f"...Saved in {outdir}")
+
+    cache = CziMetadataCache()
+    meta = cache.get(plan['units'][-1]['czi_path']).meta
+    dict_json = meta_to_json(meta, user_input['1_czidir'], outdir,
+                             user_input['1_channelnames_dir'],
+                             plan['options_dir'], cache=cache, report=report)
+    save_experiment_attrs(kwargs['output_backend'], outdir, dict_json)
+    print(f'...Run report saved in {report.write(outdir)}')
+
+
+def run_local(options_dir: str, workers: int = 2, tiles_per_unit: int = 16,
+              stale: float = 300.0, heartbeat: float = 30.0):
+    """Plans the queue, converts it with workers local worker processes
+    (started like on other nodes) and assembles the results."""
+    plan_queue(options_dir, tiles_per_unit)
+    command = [sys.executable, '-m', 'czi2codex', 'queue', 'worker',
+               options_dir, '--stale', str(stale), '--heartbeat',
+               str(heartbeat), '--poll', '1']
+    processes = [subprocess.Popen(command) for _ in range(workers)]
+    codes = [p.wait() for p in processes]
+    if any(codes):
+        raise Exception(f'worker processes failed with exit codes {codes}')
+    assemble(options_dir)
+
+
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex queue', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Convert czi files to codex-'
+                                                 'format with workers on '
+                                                 'several nodes, through a job '
+                                                 'queue in the output '
+                                                 'directory. Input: Directory '
+                                                 'to options.yaml')
+    parser.add_argument("command", help="plan: write the job queue, worker: "
+                                        "convert units of the queue, "
+                                        "assemble: write exposure_times.txt "
+                                        "and experiment.json, status: count "
+                                        "the units by state, local: plan, "
+                                        "local workers and assemble",
+                        choices=['plan', 'worker', 'assemble', 'status',
+                                 'local'])
+    parser.add_argument("options_dir", help="Directory to options.yaml file."
+                                            " (e.g. '/dir/to/optionfile/"
+                                            "options.yaml')",
+                        type=str)
+    parser.add_argument("--tiles-per-unit", help="Tiles per work unit (plan, "
+                                                 "local). 0: one unit per "
+                                                 "cycle and region.",
+                        type=int, default=16)
+    parser.add_argument("--workers", help="Number of local worker processes "
+                                          "(local).",
+                        type=int, default=2)
+    parser.add_argument("--poll", help="Seconds between two scans of the "
+                                       "queue.",
+                        type=float, default=10.0)
+    parser.add_argument("--stale", help="Seconds without heartbeat, after "
+                                        "which the unit of a worker is taken "
+                                        "over.",
+                        type=float, default=300.0)
+    parser.add_argument("--heartbeat", help="Seconds between two heartbeats "
+                                            "of a worker.",
+                        type=float, default=30.0)
+    parser.add_argument("--wait", help="Wait until all units are done "
+                                       "(assemble).",
+                        action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.command == 'plan':
+        plan_queue(args.options_dir, args.tiles_per_unit)
+    elif args.command == 'worker':
+        run_worker(args.options_dir, poll=args.poll, stale=args.stale,
+                   heartbeat=args.heartbeat)
+    elif args.command == 'assemble':
+        assemble(args.options_dir, wait=args.wait, poll=args.poll,
+                 stale=args.stale)
+    elif args.command == 'status':
+        outdir = process_user_options(args.options_dir)['1_outdir']
+        for state, units in queue_status(outdir, args.stale).items():
+            print(f'{state:<8} {len(units)}')
+    else:
+        run_local(args.options_dir, workers=args.workers,
+                  tiles_per_unit=args.tiles_per_unit, stale=args.stale,
+                  heartbeat=args.heartbeat)
+
+
+if __name__ == "__main__":
+    main()
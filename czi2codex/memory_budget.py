@@ -0,0 +1,74 @@
+# bounding the memory of tiles in flight (decoded, being compressed or
+# waiting to be written) and reporting the peak memory of a run.
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class BudgetAborted(Exception):
+    """Raised by MemoryBudget.acquire(), if waiting was aborted."""
+
+
+class MemoryBudget:
+    """
+    Counting semaphore over bytes. acquire() blocks until the requested
+    bytes fit into the budget; a single request larger than the budget is
+    granted if nothing else is in use, so there is no deadlock.
+    Bytes can be held (hold()): they stay in use, but are kept by a consumer
+    until more bytes arrive (e.g. the planes of a tif stack, which is only
+    written when complete). If only held bytes are in use, a request is
+    granted beyond the budget, since the held bytes can not be freed without
+    it.
+    Parameters:
+    -----------
+    budget_bytes: int
+        maximal number of bytes in use, None: unlimited
+    """
+
+    def __init__(self, budget_bytes: int = None):
+        self.budget_bytes = budget_bytes
+        self.used = 0
+        self.held = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int, abort: threading.Event = None):
+        with self._cond:
+            while (self.budget_bytes is not None and
+                   self.used > self.held and
+                   self.used + nbytes > self.budget_bytes):
+                if abort is not None and abort.is_set():
+                    raise BudgetAborted('waiting for memory aborted')
+                self._cond.wait(timeout=0.1)
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def hold(self, nbytes: int):
+        """Marks acquired bytes as held (still in use)."""
+        with self._cond:
+            self.held += nbytes
+            self._cond.notify_all()
+
+    def release(self, nbytes: int, held: int = 0):
+        """Releases nbytes, of which held bytes were marked by hold()."""
+        with self._cond:
+            self.used -= nbytes
+            self.held -= held
+            self._cond.notify_all()
+
+
+def peak_rss_mb(children: bool = False):
+    """Peak resident memory (MB) of this process, or of the largest
+    terminated child process (e.g. worker processes). None, if unknown."""
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is given in bytes on macOS, in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 2**20
+    return maxrss / 2**10
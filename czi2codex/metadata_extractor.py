@@ -0,0 +1,109 @@
+# extraction of the metadata fields used by czi2codex directly from the lxml
+# tree of the czi metadata. The XPath expressions are compiled once; the
+# metadata document is neither serialized nor converted to a dictionary.
+from collections import namedtuple
+from lxml import etree
+
+ChannelMetadata = namedtuple('ChannelMetadata',
+                             ['name', 'exposure_time', 'emission_wavelength'])
+ChannelMetadata.__doc__ = """Metadata of one channel.
+name: str
+exposure_time: float
+    ExposureTime as given in the czi metadata (ns)
+emission_wavelength: float
+    EmissionWavelength (nm), None if missing"""
+
+CziMetadata = namedtuple('CziMetadata',
+                         ['creation_date', 'microscope', 'bit_depth',
+                          'channels', 'magnification', 'lens_na',
+                          'immersion', 'pixel_size', 'scaling',
+                          'tile_regions', 'focus_offsets', 'z_interval'])
+CziMetadata.__doc__ = """Metadata fields of a czi file used by czi2codex.
+creation_date: str
+microscope: str
+    name of the (first) microscope
+bit_depth: int
+    ComponentBitCount
+channels: tuple of ChannelMetadata
+magnification, lens_na: float
+    NominalMagnification and LensNA of the (first) objective
+immersion: str
+pixel_size: tuple of float
+    ImagePixelSize (camera pixel size, um)
+scaling: dict
+    Scaling Distance of each axis, e.g. {'X': 3.25e-07, 'Y': ..., 'Z': ...}
+tile_regions: tuple of (columns, rows)
+    tile grid of each TileRegion
+focus_offsets: tuple of str
+    FocusOffset of each Track (as str, see convert_str2float_or_int)
+z_interval: float
+    distance of the Z-stack interval, None if missing"""
+
+_META = 'Metadata/'
+_CHANNELS = etree.XPath(_META + 'Information/Image/Dimensions/Channels/Channel')
+_CREATION_DATE = etree.XPath(_META + 'Information/Document/CreationDate/text()')
+_MICROSCOPE = etree.XPath(
+    _META + 'Information/Instrument/Microscopes/Microscope[1]/@Name')
+_BIT_DEPTH = etree.XPath(_META + 'Information/Image/ComponentBitCount/text()')
+_OBJECTIVE = etree.XPath(
+    _META + 'Information/Instrument/Objectives/Objective[1]')
+_PIXEL_SIZE = etree.XPath(_META + 'ImageScaling/ImagePixelSize/text()')
+_SCALING = etree.XPath(_META + 'Scaling/Items/Distance')
+_REGIONS_SETUP = (_META + 'Experiment/ExperimentBlocks/AcquisitionBlock/'
+                  'SubDimensionSetups/RegionsSetup/')
+_TILE_REGIONS = etree.XPath(_REGIONS_SETUP +
+                            'SampleHolder/TileRegions/TileRegion')
+_MULTITRACK = (_REGIONS_SETUP + 'SubDimensionSetups/TilesSetup/'
+               'SubDimensionSetups/MultiTrackSetup/')
+_FOCUS_OFFSETS = etree.XPath(_MULTITRACK + 'Track/FocusOffset/text()')
+_Z_INTERVAL = etree.XPath(_MULTITRACK + 'SubDimensionSetups/ZStackSetup/'
+                          'Interval/Distance/Value/text()')
+
+
+def _first(values, convert=str):
+    return convert(values[0]) if values else None
+
+
+def _child(element, tag: str, convert=str):
+    child = element.find(tag) if element is not None else None
+    if child is None or child.text is None:
+        return None
+    return convert(child.text)
+
+
+def extract_metadata(meta) -> CziMetadata:
+    """
+    Extracts the used metadata fields from the czi metadata.
+    Parameters:
+    -----------
+    meta: lxml.etree._Element or lxml.etree._ElementTree
+        metadata-object (czi.meta), root element 'ImageDocument'
+    Returns:
+    --------
+    CziMetadata
+    """
+    if isinstance(meta, etree._ElementTree):
+        meta = meta.getroot()
+    channels = tuple(
+        ChannelMetadata(ch.get('Name'),
+                        _child(ch, 'ExposureTime', float),
+                        _child(ch, 'EmissionWavelength', float))
+        for ch in _CHANNELS(meta))
+    objective = _first(_OBJECTIVE(meta), lambda e: e)
+    pixel_size = _first(_PIXEL_SIZE(meta))
+    return CziMetadata(
+        creation_date=_first(_CREATION_DATE(meta)),
+        microscope=_first(_MICROSCOPE(meta)),
+        bit_depth=_first(_BIT_DEPTH(meta), int),
+        channels=channels,
+        magnification=_child(objective, 'NominalMagnification', float),
+        lens_na=_child(objective, 'LensNA', float),
+        immersion=_child(objective, 'Immersion'),
+        pixel_size=tuple(float(p) for p in pixel_size.split(','))
+        if pixel_size else None,
+        scaling={d.get('Id'): _child(d, 'Value', float)
+                 for d in _SCALING(meta)},
+        tile_regions=tuple((_child(t, 'Columns', int), _child(t, 'Rows', int))
+                           for t in _TILE_REGIONS(meta)),
+        focus_offsets=tuple(str(f) for f in _FOCUS_OFFSETS(meta)),
+        z_interval=_first(_Z_INTERVAL(meta), float))
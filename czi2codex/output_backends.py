@@ -0,0 +1,406 @@
+# output backends of the tile conversion. A backend decides, where the tiles
+# of a cycle are stored:
+#   - 'tiff' (default): one tif-file per tile, channel and Z-plane,
+#     outdir/cycNNN_reg001/1_00001_Z001_CH001.tif
+#   - 'tiff_zstack': one multi-page tif-file per tile and channel with the
+#     Z-planes as pages, outdir/cycNNN_reg001/1_00001_CH001.tif
+#   - 'tiff_hyperstack': one multi-page tif-file per tile with the pages in
+#     (channel, Z) order, outdir/cycNNN_reg001/1_00001.tif
+#   - 'zarr': one chunked array per cycle and region in the zarr store
+#     outdir/codex.zarr/cycNNN_reg001 with axes (tile, channel, z, y, x) and
+#     one chunk per plane. experiment.json is additionally saved in the
+#     attributes of the store. Needs the 'zarr' package.
+# The backends plug into the TilePipeline: encode() is called in the encoder
+# threads, write() in the writer thread. read_tile_plane() and iter_planes()
+# give the per-plane view of the output of every backend.
+import io
+import os
+import re
+import threading
+import tifffile
+from .tile_pipeline import encode_tiff, write_file, tiff_write_kwargs
+
+OUTPUT_BACKENDS = ('tiff', 'tiff_zstack', 'tiff_hyperstack', 'zarr')
+DEFAULT_TEMPLATE = '1_{m:05}_Z{z:03}_CH{c:03}'
+ZARR_STORE = 'codex.zarr'
+
+
+class TiffBackend:
+    """
+    One tif-file per tile, channel and Z-plane (CODEX layout).
+    Parameters:
+    -----------
+    outdir: str
+        output directory
+    foldername: str
+        folder of the cycle and region, e.g. 'cyc001_reg001'
+    template: str
+        output-filenaming template, e.g. '1_{m:05}_Z{z:03}_CH{c:03}'
+    write_kwargs: dict
+        keyword arguments for tifffile, see tile_pipeline.tiff_write_kwargs()
+    """
+    name = 'tiff'
+    # the size of a written tile can be checked on disk (resume)
+    verify_size = True
+    # planes per written file
+    num_pages = 1
+    # encode() keeps planes until their file is complete
+    retains_planes = False
+
+    def __init__(self, outdir: str, foldername: str,
+                 template: str = DEFAULT_TEMPLATE,
+                 write_kwargs: dict = None):
+        self.folder = os.path.join(outdir, foldername)
+        self.template = self.file_template(template)
+        self.write_kwargs = write_kwargs or tiff_write_kwargs()
+        os.makedirs(self.folder, exist_ok=True)
+
+    @classmethod
+    def check_available(cls):
+        """Raises an ImportError, if a package of the backend is missing."""
+
+    @classmethod
+    def prepare(cls, outdir: str):
+        """Called once per run in the main process, before any cycle is
+        converted."""
+
+    @classmethod
+    def file_template(cls, template: str):
+        """Filenaming template of the files of this backend."""
+        return template
+
+    @classmethod
+    def page_index(cls, c: int, z: int, C: int, Z: int):
+        """Page of a plane within its file."""
+        return 0
+
+    def tile_key(self, m: int, c: int, z: int):
+        """Output path of a plane (0-based indices), which is also its key
+        in the run manifest."""
+        # Codex format starts at 1!
+        filename = self.template.format(c=c+1, z=z+1, m=m+1)
+        return os.path.join(self.folder, filename + '.tif')
+
+    def manifest_coords(self, m: int, c: int, z: int):
+        """Subblock coordinates recorded with a file in the run manifest."""
+        return m, c, z
+
+    def encode(self, key: str, data, m: int, c: int, z: int):
+        """Returns the payload to be written, None if nothing is to be
+        written yet."""
+        return encode_tiff(data, **self.write_kwargs)
+
+    def write(self, key: str, payload):
+        write_file(key, payload)
+
+    def close(self, **attrs):
+        """Called after all planes of the cycle are written."""
+
+
+class TiffStackBackend(TiffBackend):
+    """
+    One multi-page tif-file per tile and channel, with the Z-planes as pages
+    ('tiff_zstack'). The planes of a file are kept until the stack is
+    complete, then the encoder thread which received the last plane
+    compresses the whole stack through one TiffWriter and the writer thread
+    saves it with a single write. The kept planes stay counted in the memory
+    budget of the tile pipeline until their file is written; with a budget
+    the tiles are read tile by tile, such that one stack after another is
+    completed. The filenaming template is used without its Z-field (e.g.
+    '1_{m:05}_CH{c:03}').
+    Parameters:
+    -----------
+    outdir, foldername, template, write_kwargs:
+        see TiffBackend
+    shape: tuple
+        (M, C, Z, ...) - tiles, channels and Z-planes of the cycle
+    """
+    name = 'tiff_zstack'
+    # fields of the template, which are stacked within one file
+    stacked_fields = ('z',)
+
+    def __init__(self, outdir: str, foldername: str,
+                 template: str = DEFAULT_TEMPLATE,
+                 write_kwargs: dict = None, shape: tuple = None):
+        super().__init__(outdir, foldername, template, write_kwargs)
+        _, self.C, self.Z = (int(s) for s in shape[:3])
+        self.num_pages = self.Z * (self.C if 'c' in self.stacked_fields
+                                   else 1)
+        self.retains_planes = self.num_pages > 1
+        self._stacks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def file_template(cls, template: str):
+        for field in cls.stacked_fields:
+            # remove the field with its prefix, e.g. '_Z{z:03}'
+            template = re.sub(r'_?[A-Za-z]*\{' + field + r'(:[^}]*)?\}', '',
+                              template)
+        return template
+
+    @classmethod
+    def page_index(cls, c: int, z: int, C: int, Z: int):
+        return z
+
+    def manifest_coords(self, m: int, c: int, z: int):
+        return m, None if 'c' in self.stacked_fields else c, None
+
+    def encode(self, key: str, data, m: int, c: int, z: int):
+        with self._lock:
+            stack = self._stacks.setdefault(key, [None] * self.num_pages)
+            stack[self.page_index(c, z, self.C, self.Z)] = data
+            if any(page is None for page in stack):
+                return None
+            del self._stacks[key]
+        return self._encode_stack(stack)
+
+    def _encode_stack(self, stack):
+        height, width = stack[0].shape
+        shape = (len(stack), height, width)
+        kwargs = dict(self.write_kwargs)
+        tile = kwargs.get('tile')
+        if tile:
+            # tiled tif: the iterator yields the tif-tiles of all pages
+            pages = (page[y:y + tile[0], x:x + tile[1]] for page in stack
+                     for y in range(0, height, tile[0])
+                     for x in range(0, width, tile[1]))
+        else:
+            pages = iter(stack)
+        axes = 'CZYX' if 'c' in self.stacked_fields else 'ZYX'
+        if axes == 'CZYX':
+            shape = (self.C, self.Z, height, width)
+        buf = io.BytesIO()
+        with tifffile.TiffWriter(buf) as tif:
+            tif.write(pages, shape=shape, dtype=stack[0].dtype,
+                      photometric='minisblack', metadata={'axes': axes},
+                      **kwargs)
+        return buf.getbuffer()
+
+    def close(self, **attrs):
+        if self._stacks:
+            raise Exception(f'{len(self._stacks)} incomplete tif stacks in '
+                            f'{self.folder}')
+
+
+class TiffHyperstackBackend(TiffStackBackend):
+    """
+    One multi-page tif-file per tile ('tiff_hyperstack'), with C x Z pages in
+    (channel, Z) order (axes 'CZYX'). The template is used without its Z- and
+    channel-field (e.g. '1_{m:05}'). See TiffStackBackend.
+    """
+    name = 'tiff_hyperstack'
+    stacked_fields = ('z', 'c')
+
+    @classmethod
+    def page_index(cls, c: int, z: int, C: int, Z: int):
+        return c * Z + z
+
+
+class ZarrBackend:
+    """
+    One chunked zarr array per cycle and region, shape (M, C, Z, Y, X), with
+    one chunk per plane. The encoder threads compress and store the chunks
+    concurrently (zarr's default compressor); the writer thread only records
+    the written planes, with the size of their stored chunks.
+    Parameters:
+    -----------
+    outdir: str
+        output directory, the store is saved as outdir/codex.zarr
+    foldername: str
+        name of the array of the cycle and region, e.g. 'cyc001_reg001'
+    shape: tuple
+        (M, C, Z, Y, X) - tiles, channels, Z-planes, tile height and width
+    """
+    name = 'zarr'
+    # chunk files are not 1:1 with the recorded payloads (resume trusts the
+    # manifest)
+    verify_size = False
+    num_pages = 1
+    retains_planes = False
+
+    def __init__(self, outdir: str, foldername: str, shape: tuple):
+        self.zarr = _import_zarr()
+        self.store_path = os.path.join(outdir, ZARR_STORE)
+        self.foldername = foldername
+        self.shape = tuple(int(s) for s in shape)
+        self._array = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def check_available(cls):
+        _import_zarr()
+
+    @classmethod
+    def prepare(cls, outdir: str):
+        """Creates the root group of the store (once, before the worker
+        processes add their arrays)."""
+        _import_zarr().open_group(os.path.join(outdir, ZARR_STORE), mode='a')
+
+    def tile_key(self, m: int, c: int, z: int):
+        return os.path.join(self.store_path, self.foldername, f'{m}.{c}.{z}')
+
+    def manifest_coords(self, m: int, c: int, z: int):
+        return m, c, z
+
+    def encode(self, key: str, data, m: int, c: int, z: int):
+        height, width = data.shape
+        array = self._get_array(data.dtype)
+        array[m, c, z, :height, :width] = data
+        # the stored (compressed) chunk is the payload of the written bytes
+        # and the manifest
+        path = os.path.join(self.store_path, self.foldername,
+                            _chunk_key(array, (m, c, z, 0, 0)))
+        if not os.path.exists(path):
+            # a chunk of fill values is not stored
+            return b''
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(self, key: str, payload):
+        pass
+
+    def close(self, **attrs):
+        """Saves attrs (e.g. tile rects) in the attributes of the array."""
+        if self._array is None:
+            self._get_array(None)
+        self._array.attrs.update(
+            {'axes': ['tile', 'channel', 'z', 'y', 'x'], **attrs})
+
+    def _get_array(self, dtype):
+        with self._lock:
+            if self._array is None:
+                path = os.path.join(self.store_path, self.foldername)
+                chunks = (1, 1, 1) + self.shape[3:]
+                array = self.zarr.open_array(store=path, mode='a',
+                                             shape=self.shape, chunks=chunks,
+                                             dtype=dtype or 'uint16')
+                if array.shape != self.shape or (
+                        dtype is not None and array.dtype != dtype):
+                    # array of a previous run with other dimensions
+                    array = self.zarr.open_array(store=path, mode='w',
+                                                 shape=self.shape,
+                                                 chunks=chunks, dtype=dtype)
+                self._array = array
+            return self._array
+
+
+def _chunk_key(array, coords: tuple):
+    """Key (path in the store) of the chunk of an array at coords."""
+    if hasattr(array, 'metadata'):
+        # zarr >= 3
+        return array.metadata.encode_chunk_key(coords)
+    return array._chunk_key(coords)
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError("The output backend 'zarr' needs the 'zarr' "
+                          "package (pip install zarr).") from e
+    return zarr
+
+
+def get_output_backend(name: str):
+    """Returns the backend class of an output backend name."""
+    backends = {'tiff': TiffBackend, 'tiff_zstack': TiffStackBackend,
+                'tiff_hyperstack': TiffHyperstackBackend, 'zarr': ZarrBackend}
+    if name not in backends:
+        raise ValueError(f"unknown output backend '{name}', expected one of "
+                         f"{OUTPUT_BACKENDS}")
+    return backends[name]
+
+
+def make_output_backend(name: str, outdir: str, foldername: str, *,
+                        template: str, write_kwargs: dict, shape: tuple):
+    """Creates the output backend of one cycle and region."""
+    backend = get_output_backend(name)
+    if backend is TiffBackend:
+        return TiffBackend(outdir, foldername, template, write_kwargs)
+    if issubclass(backend, TiffStackBackend):
+        return backend(outdir, foldername, template, write_kwargs, shape)
+    return backend(outdir, foldername, shape)
+
+
+def read_tile_plane(outdir: str, foldername: str, m: int, c: int, z: int,
+                    output_backend: str = 'tiff',
+                    template: str = DEFAULT_TEMPLATE):
+    """
+    Reads one plane from the output of any backend.
+    Parameters:
+    -----------
+    outdir: str
+        output directory of the conversion
+    foldername: str
+        folder (or array) of the cycle and region, e.g. 'cyc001_reg001'
+    m, c, z: int
+        tile, channel and Z-plane (starting from 0)
+    output_backend: str
+        backend, with which the tiles were written
+    template: str
+        output-filenaming template of the conversion
+    Returns:
+    --------
+    np.ndarray (Y, X)
+    """
+    if output_backend == 'zarr':
+        array = _import_zarr().open_array(
+            os.path.join(outdir, ZARR_STORE, foldername), mode='r')
+        return array[m, c, z]
+    backend = get_output_backend(output_backend)
+    with tifffile.TiffFile(_tif_path(backend, outdir, foldername, template,
+                                     m, c, z)) as tif:
+        C, Z = _stack_shape(backend, tif)
+        return tif.pages[backend.page_index(c, z, C, Z)].asarray()
+
+
+def iter_planes(outdir: str, foldername: str, M: int, C: int, Z: int,
+                output_backend: str = 'tiff',
+                template: str = DEFAULT_TEMPLATE):
+    """Yields (m, c, z, plane) of all planes of a cycle and region (indices
+    starting from 0), opening every file once. See read_tile_plane()."""
+    if output_backend == 'zarr':
+        array = _import_zarr().open_array(
+            os.path.join(outdir, ZARR_STORE, foldername), mode='r')
+        for m in range(M):
+            for c in range(C):
+                for z in range(Z):
+                    yield m, c, z, array[m, c, z]
+        return
+    backend = get_output_backend(output_backend)
+    files = {}
+    for m in range(M):
+        for c in range(C):
+            for z in range(Z):
+                path = _tif_path(backend, outdir, foldername, template,
+                                 m, c, z)
+                files.setdefault(path, []).append((m, c, z))
+    for path, planes in files.items():
+        with tifffile.TiffFile(path) as tif:
+            for m, c, z in planes:
+                index = backend.page_index(c, z, C, Z)
+                yield m, c, z, tif.pages[index].asarray()
+
+
+def _tif_path(backend, outdir, foldername, template, m, c, z):
+    filename = backend.file_template(template).format(c=c+1, z=z+1, m=m+1)
+    return os.path.join(outdir, foldername, filename + '.tif')
+
+
+def _stack_shape(backend, tif):
+    """(C, Z) of the stack in a tif-file."""
+    shape = tif.series[0].shape
+    if backend is TiffHyperstackBackend:
+        return shape[0], shape[1]
+    if backend is TiffStackBackend:
+        return 1, shape[0] if len(shape) > 2 else 1
+    return 1, 1
+
+
+def save_experiment_attrs(name: str, outdir: str, dict_json: dict):
+    """Saves the fields of experiment.json in the store of chunked backends
+    (no-op for 'tiff')."""
+    if name == 'zarr':
+        group = _import_zarr().open_group(os.path.join(outdir, ZARR_STORE),
+                                          mode='a')
+        group.attrs.update({'experiment': dict_json})
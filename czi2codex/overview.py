@@ -0,0 +1,182 @@
+# stitched low-resolution overview of every cycle, region and channel, built
+# while the tiles stream through the conversion: each plane is downsampled
+# by block averaging and placed at its tile position (x, y) into a canvas,
+# which is the only image kept in memory. Z-planes and overlapping tiles are
+# combined with the maximum. The overviews are saved as pyramidal tifs
+# 'overview/cycNNN_regRRR_CHCCC.tif' in the output directory: the canvas as
+# first page and levels downsampled by 2 each as SubIFDs, until the smaller
+# side is below OVERVIEW_MIN_SIZE. The parts of a region (tile ranges, see
+# job_queue.py) save their canvases as 'overview/cycNNN_regRRR_part.npz',
+# which are combined by merge_overview_parts() once all parts are converted.
+# Canvases of parts, which are superseded (by an overview of the whole region
+# or by the parts of a new plan), are removed.
+import os
+import glob
+import threading
+import numpy as np
+import tifffile
+
+OVERVIEW_DIR = 'overview'
+OVERVIEW_MIN_SIZE = 256
+
+
+def overview_path(outdir: str, i_cyc: int, region: int, c: int):
+    return os.path.join(outdir, OVERVIEW_DIR,
+                        'cyc{:03}_reg{:03}_CH{:03}.tif'.format(i_cyc, region,
+                                                               c + 1))
+
+
+def partial_overview_path(outdir: str, i_cyc: int, region: int, part: str):
+    return os.path.join(outdir, OVERVIEW_DIR,
+                        'cyc{:03}_reg{:03}_{}.npz'.format(i_cyc, region, part))
+
+
+def remove_partial_overviews(outdir: str, i_cyc: int, region: int,
+                             keep: list = ()):
+    """Removes the saved canvases of the parts of a region, which are not in
+    keep (paths)."""
+    keep = {os.path.abspath(path) for path in keep}
+    for path in glob.glob(partial_overview_path(outdir, i_cyc, region, '*')):
+        if os.path.abspath(path) not in keep:
+            os.remove(path)
+
+
+def block_reduce(plane, factor: int):
+    """Mean of factor x factor blocks of a 2d plane (vectorized); the right
+    and bottom rest, which is smaller than a block, is dropped."""
+    if factor == 1:
+        return plane
+    h, w = plane.shape[0] // factor, plane.shape[1] // factor
+    blocks = plane[:h * factor, :w * factor].reshape(h, factor, w, factor)
+    if np.issubdtype(plane.dtype, np.integer):
+        total = blocks.sum(axis=(1, 3), dtype=np.uint64)
+        return (total // (factor * factor)).astype(plane.dtype)
+    return blocks.mean(axis=(1, 3)).astype(plane.dtype)
+
+
+def pyramid(image, min_size: int = OVERVIEW_MIN_SIZE):
+    """Returns the levels [image, image / 2, image / 4, ...] down to a
+    smaller side of min_size pixels."""
+    levels = [image]
+    while min(levels[-1].shape) // 2 >= min_size:
+        levels.append(block_reduce(levels[-1], 2))
+    return levels
+
+
+class OverviewMosaic:
+    """
+    Downsampled mosaic of the tiles of one cycle and region, one canvas per
+    channel. add() is called by the encoder threads of the tile pipeline.
+    Parameters:
+    -----------
+    tiles: list
+        tile positions (x, y, w, h) of the region, index m
+    C: int
+        number of channels
+    factor: int
+        downsampling factor of the overview
+    """
+
+    def __init__(self, tiles, C: int, factor: int):
+        if factor < 1:
+            raise ValueError(f'the overview factor must be at least 1, not '
+                             f'{factor}')
+        self.tiles = [tuple(t) for t in tiles]
+        self.factor = factor
+        self.x0 = min(t[0] for t in self.tiles)
+        self.y0 = min(t[1] for t in self.tiles)
+        width = max(t[0] + t[2] for t in self.tiles) - self.x0
+        height = max(t[1] + t[3] for t in self.tiles) - self.y0
+        self.shape = (height // factor, width // factor)
+        self.canvases = [None] * C
+        self.counts = [0] * C
+        self._locks = [threading.Lock() for _ in range(C)]
+
+    def add(self, m: int, c: int, plane):
+        x, y = self.tiles[m][:2]
+        small = block_reduce(plane, self.factor)
+        top = (y - self.y0) // self.factor
+        left = (x - self.x0) // self.factor
+        h = min(small.shape[0], self.shape[0] - top)
+        w = min(small.shape[1], self.shape[1] - left)
+        with self._locks[c]:
+            if self.canvases[c] is None:
+                self.canvases[c] = np.zeros(self.shape, plane.dtype)
+            region = self.canvases[c][top:top + h, left:left + w]
+            np.maximum(region, small[:h, :w], out=region)
+            self.counts[c] += 1
+
+    def save(self, outdir: str, i_cyc: int, region: int):
+        """Saves the pyramidal overview tif of every channel (of the whole
+        region, saved canvases of its parts are removed)."""
+        os.makedirs(os.path.join(outdir, OVERVIEW_DIR), exist_ok=True)
+        for c, canvas in enumerate(self.canvases):
+            if canvas is not None:
+                _save_pyramid(overview_path(outdir, i_cyc, region, c),
+                              canvas, self.factor)
+        remove_partial_overviews(outdir, i_cyc, region)
+
+    def save_partial(self, path: str):
+        """Saves the canvases of a part of the region (npz, written
+        atomically)."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, factor=np.array(self.factor),
+                 **{f'canvas_{c}': canvas
+                    for c, canvas in enumerate(self.canvases)
+                    if canvas is not None})
+        os.replace(tmp_path, path)
+
+
+def _save_pyramid(path: str, canvas, factor: int):
+    levels = pyramid(canvas)
+    with tifffile.TiffWriter(path + '.tmp') as tif:
+        tif.write(levels[0], subifds=len(levels) - 1,
+                  photometric='minisblack', compression='zlib',
+                  metadata={'axes': 'YX', 'factor': factor})
+        for level in levels[1:]:
+            tif.write(level, subfiletype=1, photometric='minisblack',
+                      compression='zlib')
+    os.replace(path + '.tmp', path)
+
+
+def merge_overview_parts(outdir: str, i_cyc: int, region: int,
+                         parts: list):
+    """
+    Combines the saved canvases of the parts of a region (maximum) and saves
+    the pyramidal overview tif of every channel. Canvases of other parts
+    (e.g. of an earlier plan) are removed. Returns the number of merged
+    parts.
+    Parameters:
+    -----------
+    outdir: str
+        output directory
+    i_cyc, region: int
+        cycle and region
+    parts: list
+        names of the parts of the region (see run_manifest.part_name)
+    """
+    paths = [partial_overview_path(outdir, i_cyc, region, part)
+             for part in parts]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f'overview canvases of cycle {i_cyc}, region '
+                                f'{region} not found: {missing}')
+    remove_partial_overviews(outdir, i_cyc, region, keep=paths)
+    canvases = {}
+    factor = None
+    for path in paths:
+        with np.load(path) as f:
+            factor = int(f['factor'])
+            for name in f.files:
+                if not name.startswith('canvas_'):
+                    continue
+                c = int(name[len('canvas_'):])
+                if c in canvases:
+                    np.maximum(canvases[c], f[name], out=canvases[c])
+                else:
+                    canvases[c] = f[name]
+    for c, canvas in canvases.items():
+        _save_pyramid(overview_path(outdir, i_cyc, region, c), canvas,
+                      factor)
+    return len(paths)
@@ -0,0 +1,393 @@
+# batch conversion of many experiments (one options.yaml each) with one
+# shared pool of worker processes. The work units (cycle and region) of all
+# experiments are scheduled into one global queue:
+#   fair      round robin over the experiments, all of them progress
+#             at the same rate (default)
+#   priority  the experiments in the given order, one after the other (the
+#             pool is filled with units of the next experiment, while the
+#             last units of the previous one are converted)
+# Only a few units per worker are in flight, therefore a failing experiment
+# (e.g. a corrupt czi file) is stopped without blocking the others: its
+# remaining units are not dispatched and the other experiments continue. If a
+# worker process crashes (e.g. in the czi decoder), the units in flight are
+# converted again one at a time, and only the unit which crashes alone fails
+# its experiment. Once
+# all units of an experiment are converted, its exposure_times.txt (from the
+# run manifest), flat-field estimates, experiment.json and run report are
+# written. A batch summary with the status and throughput of every experiment
+# is saved as json.
+import os
+import glob
+import time
+import json
+import argparse
+import traceback
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait as wait_futures)
+from concurrent.futures.process import BrokenProcessPool
+from .czi2tif_codex import _convert_cycle_worker, check_conversion_settings
+from .czi_cache import CziMetadataCache, CziRecord
+from .flat_field import save_flat_field
+from .generate_metadata_json import meta_to_json, process_user_options
+from .memory_budget import peak_rss_mb
+from .output_backends import get_output_backend, save_experiment_attrs
+from .run_manifest import (converted_cycles, read_exposure_times,
+                           write_exposure_times_file)
+from .run_report import RunReport
+from .run_czi2codex import check_paths, conversion_kwargs
+from .selection import Selection, selected_tile_grid
+
+SUMMARY_FILENAME = 'czi2codex_batch_summary.json'
+SCHEDULES = ('fair', 'priority')
+# units in flight per worker process
+UNITS_IN_FLIGHT = 2
+
+
+def find_options_files(paths):
+    """
+    Options files of the batch: paths to options files (.yaml), directories
+    (searched recursively for 'options.yaml') and text files listing such
+    paths (one per line). Duplicates are removed, the order is kept.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                if 'options.yaml' in files:
+                    found.append(os.path.join(root, 'options.yaml'))
+        elif os.path.splitext(path)[1].lower() == '.txt':
+            with open(path, 'r') as f:
+                found.extend(find_options_files(
+                    [line.strip() for line in f if line.strip()]))
+        else:
+            found.append(path)
+    unique = []
+    for path in (os.path.abspath(p) for p in found):
+        if path not in unique:
+            unique.append(path)
+    return unique
+
+
+class Experiment:
+    """
+    One experiment (options file) of the batch: its work units, run report
+    and state ('queued', 'running', 'done', 'failed').
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file,
+        (e.g. '/dir/to/czifiles/options.yaml')
+    workers: int
+        number of worker processes of the batch (the memory budget of the
+        options is shared by them)
+    """
+
+    def __init__(self, options_dir: str, workers: int):
+        self.options_dir = options_dir
+        self.workers = workers
+        self.state = 'queued'
+        self.error = None
+        self.units = []
+        self.pending = 0
+        # units with a result (a setup, which fails partway, converted none)
+        self.converted = 0
+        self.outdir = None
+        self.started = None
+        self.finished = None
+        self.cache = CziMetadataCache()
+        self.report = RunReport()
+
+    @property
+    def name(self):
+        return os.path.basename(os.path.dirname(self.options_dir)) or \
+            self.options_dir
+
+    def setup(self):
+        """Reads the options and headers of the czi files and lists the work
+        units (cycle, czi path, scene)."""
+        self.user_input = user_input = process_user_options(self.options_dir)
+        self.czidir = user_input['1_czidir']
+        self.outdir = user_input['1_outdir']
+        self.template = user_input['1_out_template']
+        check_paths(user_input)
+        self.kwargs = conversion_kwargs(user_input)
+        check_conversion_settings(**self.kwargs)
+        get_output_backend(self.kwargs['output_backend']).prepare(self.outdir)
+        if self.kwargs['memory_budget_mb'] is not None:
+            self.kwargs['memory_budget_mb'] /= self.workers
+
+        czi_filename, czi_ext = os.path.splitext(os.path.basename(
+            self.czidir))
+        basedir = os.path.dirname(self.czidir)
+        num_cycles = len(glob.glob(os.path.join(basedir, '*' + czi_ext)))
+        if num_cycles == 0:
+            raise FileNotFoundError('No czi-files where found in the user '
+                                    'specified directory: \n' + self.czidir)
+        selection = self.kwargs['selection'] or Selection()
+        self.cycles = selection.cycle_list(num_cycles)
+        for i_cyc in self.cycles:
+            czi_path = os.path.join(basedir,
+                                    czi_filename.format(i_cyc) + czi_ext)
+            record = self.cache.get(czi_path)
+            # the selected tiles must be a complete tile grid
+            selected_tile_grid(record.scene_tiles, selection)
+            for scene in range(record.size[0]):
+                self.units.append((i_cyc, czi_path, scene))
+        self.pending = len(self.units)
+        self.report.settings.update(self.kwargs, template=self.template,
+                                    workers=self.workers, batch=True)
+
+    def fail(self, error: str):
+        if self.state != 'failed':
+            self.state = 'failed'
+            self.error = error
+            self.finished = time.perf_counter()
+            print(f'Experiment {self.name} FAILED: {error.splitlines()[-1]}')
+
+    def add_result(self, unit: tuple, result: tuple):
+        i_cyc, czi_path, scene = unit
+        state, _, cycle_stats, wall_time = result
+        self.cache.add(CziRecord.from_state(state))
+        self.report.add_cycle(i_cyc, cycle_stats, wall_time,
+                              region=scene + 1)
+        self.pending -= 1
+        self.converted += 1
+
+    def finish(self):
+        """Writes the exposure times, flat-field estimates, experiment.json
+        and run report, once all units are converted."""
+        outdir = self.outdir
+        selection = self.kwargs['selection']
+        cycles = self.cycles
+        if selection is not None and selection.cycles is not None:
+            # previously converted cycles are kept
+            cycles = converted_cycles(outdir)
+        write_exposure_times_file(outdir, read_exposure_times(outdir, cycles))
+        if self.kwargs['flat_field']:
+            for i_cyc in self.cycles:
+                save_flat_field(outdir, i_cyc)
+        meta = self.cache.get(self.units[-1][1]).meta
+        dict_json = meta_to_json(meta, self.czidir, outdir,
+                                 self.user_input['1_channelnames_dir'],
+                                 self.options_dir, cache=self.cache,
+                                 report=self.report)
+        save_experiment_attrs(self.kwargs['output_backend'], outdir,
+                              dict_json)
+        self.report.write(outdir)
+        self.state = 'done'
+        self.finished = time.perf_counter()
+        print(f'Experiment {self.name} done: {outdir}')
+
+    def summary(self):
+        """Status and throughput of the experiment (batch summary)."""
+        totals = self.report.totals.to_dict()
+        counters = totals['counters']
+        wall_time = None
+        if self.started is not None and self.finished is not None:
+            wall_time = self.finished - self.started
+        tiles = counters.get('tiles_written', 0)
+        decoded_mb = counters.get('bytes_decoded', 0) / 2**20
+        return {'options': self.options_dir, 'outdir': self.outdir,
+                'state': self.state, 'error': self.error,
+                'units': len(self.units),
+                'units_converted': self.converted,
+                'wall_time_s': wall_time,
+                'tiles': tiles, 'mb_decoded': decoded_mb,
+                'tiles_per_second': tiles / wall_time if wall_time else None,
+                'mb_per_second': decoded_mb / wall_time if wall_time
+                else None,
+                'stages_s': totals['stages_s']}
+
+
+def schedule(experiments, order: str = 'fair'):
+    """Global queue of the units [(experiment, unit)] of all experiments:
+    round robin ('fair') or experiment by experiment ('priority')."""
+    if order not in SCHEDULES:
+        raise ValueError(f"unknown schedule '{order}', expected one of "
+                         f"{SCHEDULES}")
+    if order == 'priority':
+        return deque((e, u) for e in experiments for u in e.units)
+    queues = [deque((e, u) for u in e.units) for e in experiments]
+    queue = deque()
+    while any(queues):
+        for q in queues:
+            if q:
+                queue.append(q.popleft())
+    return queue
+
+
+def run_batch(paths, workers: int = None, order: str = 'fair',
+              summary_path: str = SUMMARY_FILENAME):
+    """
+    Converts the experiments of many options files with one shared pool of
+    worker processes (see the top of this file).
+    Parameters:
+    -----------
+    paths: list
+        options files, directories with options.yaml files or text files
+        listing them (see find_options_files())
+    workers: int
+        number of worker processes shared by all experiments. None: all cpu
+        cores
+    order: str
+        'fair' (round robin over the experiments) or 'priority' (in the
+        given order)
+    summary_path: str
+        path of the batch summary (json)
+    Returns:
+    --------
+    summary: dict
+        per experiment: state, error, units, wall time, tiles, MB decoded,
+        tiles/s and MB/s
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, int(workers))
+    start = time.perf_counter()
+    experiments = [Experiment(p, workers) for p in find_options_files(paths)]
+    print('.......................................')
+    print(f'Batch of {len(experiments)} experiments with {workers} worker '
+          f'processes ({order} schedule).')
+    for experiment in experiments:
+        try:
+            experiment.setup()
+        except Exception:
+            experiment.fail(traceback.format_exc())
+    queue = schedule([e for e in experiments if e.state != 'failed'], order)
+
+    in_flight = {}
+    # units in flight during a crash of a worker process, which are
+    # converted again one at a time
+    suspects = deque()
+    isolated = False
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(experiment, unit):
+        if experiment.state == 'queued':
+            experiment.state = 'running'
+            experiment.started = time.perf_counter()
+        i_cyc, czi_path, scene = unit
+        future = executor.submit(
+            _convert_cycle_worker, i_cyc, czi_path, experiment.outdir,
+            experiment.template, experiment.kwargs, scene)
+        in_flight[future] = (experiment, unit)
+
+    try:
+        while queue or suspects or in_flight:
+            # fill the pool, units of failed experiments are dropped
+            if suspects:
+                if not in_flight:
+                    experiment, unit = suspects.popleft()
+                    if experiment.state != 'failed':
+                        submit(experiment, unit)
+                        isolated = True
+            else:
+                isolated = False
+                while queue and len(in_flight) < workers * UNITS_IN_FLIGHT:
+                    experiment, unit = queue.popleft()
+                    if experiment.state != 'failed':
+                        submit(experiment, unit)
+            if not in_flight:
+                continue
+            done, _ = wait_futures(in_flight, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                experiment, unit = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken.append((experiment, unit))
+                    continue
+                except Exception:
+                    experiment.fail(traceback.format_exc())
+                    continue
+                if experiment.state == 'failed':
+                    continue
+                experiment.add_result(unit, result)
+                if experiment.pending == 0:
+                    try:
+                        experiment.finish()
+                    except Exception:
+                        experiment.fail(traceback.format_exc())
+            if broken:
+                # a worker process died: a new pool converts the units in
+                # flight again one at a time, the unit which crashes alone
+                # fails its experiment
+                broken += list(in_flight.values())
+                in_flight.clear()
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers)
+                if isolated:
+                    experiment, unit = broken[0]
+                    experiment.fail(f'a worker process crashed while '
+                                    f'converting cycle {unit[0]}, region '
+                                    f'{unit[2] + 1}')
+                else:
+                    suspects.extend(broken)
+    finally:
+        executor.shutdown()
+
+    summary = {'wall_time_s': time.perf_counter() - start,
+               'workers': workers, 'order': order,
+               'peak_rss_mb': {'main': peak_rss_mb(),
+                               'workers': peak_rss_mb(children=True)},
+               'experiments': [e.summary() for e in experiments]}
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=4, default=str)
+    print_summary(summary)
+    print(f'...Batch summary saved in {summary_path}')
+    return summary
+
+
+def print_summary(summary: dict):
+    """Prints the batch summary of run_batch()."""
+    print('.......................................')
+    print(f"Batch finished in {summary['wall_time_s']:.1f} s")
+    for e in summary['experiments']:
+        name = os.path.basename(os.path.dirname(e['options']))
+        if e['state'] == 'done':
+            print(f"{name:<30} done    {e['tiles']:7d} tiles  "
+                  f"{e['wall_time_s']:8.1f} s  "
+                  f"{e['tiles_per_second']:7.1f} tiles/s  "
+                  f"{e['mb_per_second']:7.1f} MB/s")
+        else:
+            print(f"{name:<30} {e['state']:<7} {e['units_converted']}/"
+                  f"{e['units']} units")
+
+
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex batch', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Convert many experiments '
+                                                 'czi to codex-format with '
+                                                 'one shared pool of worker '
+                                                 'processes. Input: options '
+                                                 'files, directories with '
+                                                 'options.yaml files or text '
+                                                 'files listing them')
+    parser.add_argument("paths", help="options.yaml files, directories "
+                                      "(searched for options.yaml) or .txt "
+                                      "files with one path per line",
+                        type=str, nargs='+')
+    parser.add_argument("--workers", help="Number of worker processes shared "
+                                          "by all experiments.",
+                        type=int, default=None)
+    parser.add_argument("--order", help="fair: round robin over the "
+                                        "experiments, priority: in the given "
+                                        "order.",
+                        choices=SCHEDULES, default='fair')
+    parser.add_argument("--summary", help="Path of the batch summary.",
+                        type=str, default=SUMMARY_FILENAME)
+
+    args = parser.parse_args(argv)
+    summary = run_batch(args.paths, workers=args.workers, order=args.order,
+                        summary_path=args.summary)
+    if any(e['state'] != 'done' for e in summary['experiments']):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
-# from .czi2tif_codex import czi_to_tiffs #for jupyter-notebook
-# from .generate_metadata_json import meta_to_json #for jupyter-notebook
-from czi2tif_codex import czi_to_tiffs
-from generate_metadata_json import meta_to_json
+from .czi2tif_codex import czi_to_tiffs
+from .generate_metadata_json import meta_to_json, process_user_options
+from .czi_cache import CziMetadataCache
+from .output_backends import save_experiment_attrs
+from .run_report import RunReport
+from .selection import Selection
 import argparse
-import yaml
+import cProfile
+import pstats
 import os
 
 
-def czi2codex_all(options_dir: str):
+def czi2codex_all(options_dir: str, workers: int = None,
+                  profile: bool = False):
     """
     Run the complete czi2codex-formatting. First create tif files for all
     cycles, channels, mosaics, Z-planes; then generate 'exposure_times.txt'-
@@ -29,17 +33,53 @@ def czi2codex_all(options_dir: str):
         output-filenaming template, default is: '1_{m:05}_Z{z:03}_CH{c:03}'
     overwrite_exposure: bool
         if exposure_times.txt exist, shall it then be overwritten?
+    workers: int
+        number of worker processes converting the cycles in parallel. If not
+        given, it is read from "1_workers:" in options.yaml.
+    profile: bool
+        run the conversion within cProfile, the profile is saved as
+        czi2codex_profile.prof in the output directory (main process only)
+    The per-stage timers and counters of the run are saved as
+    czi2codex_run_report.json in the output directory.
     """
-    # read standard options file
-    with open(options_dir) as yaml_file:
-        user_input = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    # read options file, missing entries are filled with the default options
+    user_input = process_user_options(options_dir)
 
     channelnames_dir = user_input['1_channelnames_dir']
     czidir = user_input['1_czidir']
     outdir = user_input['1_outdir']
     out_tempate = user_input['1_out_template']
     overwrite_exposure_times = user_input['1_overwrite_exposure_times']
+    if workers is None:
+        workers = user_input['1_workers']
+    check_paths(user_input)
 
+    # every czi file is opened and parsed once, for both steps
+    cache = CziMetadataCache()
+    report = RunReport()
+
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        _convert_all(czidir, outdir, out_tempate, overwrite_exposure_times,
+                     workers, user_input, channelnames_dir, options_dir,
+                     cache, report)
+    finally:
+        if profile:
+            profiler.disable()
+            profile_path = os.path.join(outdir, 'czi2codex_profile.prof')
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+            print(f'...Profile saved in {profile_path}')
+    return
+
+
+def check_paths(user_input: dict):
+    """Raises a FileNotFoundError, if channelnames.txt or the output
+    directory of the options do not exist."""
+    channelnames_dir = user_input['1_channelnames_dir']
+    outdir = user_input['1_outdir']
     if not os.path.exists(channelnames_dir):
         raise FileNotFoundError('File not found. Please check directory to the '
                                 'channelnames.txt, which should be defined in '
@@ -53,19 +93,53 @@ def czi2codex_all(options_dir: str):
                                 'in options.yaml. \nDirectory  not found: ' +
                                 outdir)
 
+
+def conversion_kwargs(user_input: dict):
+    """Keyword arguments of the tile conversion (czi_to_tiffs,
+    convert_cycle) from the '1_' options."""
+    return dict(compression=user_input['1_compression'],
+                compression_level=user_input['1_compression_level'],
+                predictor=user_input['1_predictor'],
+                tiff_tile=user_input['1_tiff_tile'],
+                encoder_threads=user_input['1_encoder_threads'],
+                read_queue_size=user_input['1_read_queue_size'],
+                write_queue_size=user_input['1_write_queue_size'],
+                resume=user_input['1_resume'],
+                read_order=user_input['1_read_order'],
+                prefetch_mb=user_input['1_prefetch_mb'],
+                memory_budget_mb=user_input['1_memory_budget_mb'],
+                output_backend=user_input['1_output_backend'],
+                z_projection=user_input['1_z_projection'],
+                flat_field=user_input['1_flat_field'],
+                overview_factor=user_input['1_overview_factor'],
+                selection=Selection.from_options(user_input))
+
+
+def _convert_all(czidir, outdir, out_tempate, overwrite_exposure_times,
+                 workers, user_input, channelnames_dir, options_dir, cache,
+                 report):
     # convert czi to tifs & generate exposure_times.txt
     _, _, _, meta, _ = czi_to_tiffs(czidir,
                                     outdir,
                                     out_tempate,
-                                    overwrite_exposure_times)
+                                    overwrite_exposure_times,
+                                    workers=workers,
+                                    cache=cache,
+                                    report=report,
+                                    auto_tune=user_input['1_auto_tune'],
+                                    **conversion_kwargs(user_input))
     # generate experiment.json
-    meta_to_json(meta, czidir, outdir,
-                 channelnames_dir, options_dir)
-    return
+    dict_json = meta_to_json(meta, czidir, outdir, channelnames_dir,
+                             options_dir, cache=cache, report=report)
+    save_experiment_attrs(user_input['1_output_backend'], outdir, dict_json)
+    report.write(outdir)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Run conversion czi to codex-'
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex convert', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Run conversion czi to codex-'
                                                  'format. Writes '
                                                  'exposure_times.txt and '
                                                  'experiment.json. Input: '
@@ -74,10 +148,23 @@ if __name__ == "__main__":
                                               " (e.g. '/dir/to/optionfile/"
                                               "options.yaml')",
                         type=str)
+    parser.add_argument("--workers", help="Number of worker processes, which "
+                                          "convert the cycles in parallel. "
+                                          "Overrides '1_workers' in "
+                                          "options.yaml.",
+                        type=int, default=None)
+    parser.add_argument("--profile", help="Run within cProfile and save the "
+                                          "profile as czi2codex_profile.prof "
+                                          "in the output directory.",
+                        action='store_true')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # with open(args.options_dir) as yaml_file:
     #     user_input = yaml.load(yaml_file, Loader=yaml.FullLoader)
 
-    czi2codex_all(options_dir=args.options_dir)
+    czi2codex_all(options_dir=args.options_dir, workers=args.workers,
+                  profile=args.profile)
+
 
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,29 @@ def generate_std_options_file(outdir: str,
                     '1_channelnames_dir': os.path.join(outdir,"channelnames.txt"),
                     '1_overwrite_exposure_times': False,
                     '1_out_template': "1_{m:05}_Z{z:03}_CH{c:03}",
+                    '1_memory_budget_mb': None,
+                    '1_prefetch_mb': 0,
+                    '1_read_order': "file",
+                    '1_resume': True,
+                    '1_workers': 1,
+                    '1_auto_tune': False,
+                    '1_num_cycles': None,
+                    '1_cycles': None,
+                    '1_tiles': None,
+                    '1_bbox': None,
+                    '1_channels': None,
+                    '1_z_planes': None,
+                    '1_output_backend': "tiff",
+                    '1_z_projection': None,
+                    '1_flat_field': False,
+                    '1_overview_factor': None,
+                    '1_compression': "zlib",
+                    '1_compression_level': None,
+                    '1_predictor': False,
+                    '1_tiff_tile': None,
+                    '1_encoder_threads': 2,
+                    '1_read_queue_size': 8,
+                    '1_write_queue_size': 8,
                     'codex_instrument': "CODEX instrument",
                     'tilingMode': "gridrows",
                     'referenceCycle': 2,
@@ -52,16 +75,20 @@ def generate_std_options_file(outdir: str,
     return user_setting
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Generate standard '
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex options', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Generate standard '
                                                  'options.yaml file.')
     parser.add_argument("options_dir", help="Directory to options.yaml file."
                                             " (e.g. '/dir/to/optionfile/')",
                         type=str)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     generate_std_options_file(args.options_dir, filename='', save=True)
 
 
-
+if __name__ == "__main__":
+    main()
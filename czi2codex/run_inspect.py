@@ -0,0 +1,301 @@
+# metadata-only inspection of a conversion ("dry run"): reads the headers and
+# subblock directories of the czi files of all cycles in parallel (no pixels
+# are decoded), runs the checks of czi_to_tiffs and meta_to_json, and prints
+# a work plan with the dimensions, tile rects, overlaps and exposure times of
+# every cycle, the expected number and size of the output files and an
+# estimated runtime. Nothing is written to the output directory.
+import os
+import glob
+import json
+import warnings
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from .czi2tif_codex import (check_czi_record, check_conversion_settings,
+                            exposure_times_from_meta)
+from .czi_cache import CziMetadataCache, CziRecord
+from .generate_metadata_json import process_user_options, check_metadata
+from .output_backends import get_output_backend, OUTPUT_BACKENDS
+from .run_czi2codex import check_paths, conversion_kwargs
+from .run_report import REPORT_FILENAME
+from .selection import Selection, selected_tile_grid
+from .tile_overlap import compute_tile_overlaps
+
+# throughput (MB of decoded tiles per second and worker process), which is
+# assumed for the runtime estimate, if the output directory holds no run
+# report of a previous run
+DEFAULT_THROUGHPUT_MBS = 50.0
+
+
+def _inspect_cycle(czi_path: str):
+    """Reads the header, subblock directory and metadata of one czi file (in
+    a worker process). Returns the state of its CziRecord (None, if it could
+    not be read) and a list of errors."""
+    record = CziMetadataCache().get(czi_path)
+    try:
+        check_czi_record(record)
+        # reads the tile rects and checks that they are independent of C, Z
+        record.scene_tiles
+        return record.to_state(), []
+    except Exception as e:
+        return None, [f'{os.path.basename(czi_path)}: {e}']
+
+
+def _measured_throughput(outdir: str):
+    """MB of decoded tiles per second and worker of a previous run, from its
+    run report (None, if there is none)."""
+    path = os.path.join(outdir, REPORT_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        cycles = json.load(f).get('cycles', [])
+    decoded = sum(c['counters'].get('bytes_decoded', 0) for c in cycles)
+    wall_time = sum(c['wall_time_s'] for c in cycles)
+    if decoded == 0 or wall_time <= 0:
+        return None
+    return decoded / wall_time / 2**20
+
+
+def inspect_run(options_dir: str, workers: int = None):
+    """
+    Inspects the czi files and options of a conversion without converting
+    anything, and prints the work plan.
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file,
+        (e.g. '/dir/to/czifiles/options.yaml')
+    workers: int
+        number of worker processes, which read the czi files in parallel.
+        None: all cpu cores. The runtime is estimated for "1_workers:" of
+        options.yaml
+    Returns:
+    --------
+    plan: dict
+        'cycles': per cycle: file, size (S, T, C, Z, M, Y, X), tile rects per
+        scene and exposure times
+        'output': expected planes, files and MB (uncompressed)
+        'overlaps': tile width, height and overlap fractions
+        'runtime_s': estimated runtime of the conversion
+        'errors': list of the checks, which fail (the conversion would fail)
+        'warnings': list of warnings
+    """
+    user_input = process_user_options(options_dir)
+    czidir = user_input['1_czidir']
+    outdir = user_input['1_outdir']
+    kwargs = conversion_kwargs(user_input)
+    errors = []
+    plan = {'cycles': {}, 'errors': errors, 'warnings': []}
+
+    def check(func, *args, **kw):
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                result = func(*args, **kw)
+            plan['warnings'].extend(str(w.message) for w in caught)
+            return result
+        except Exception as e:
+            errors.append(str(e))
+            return None
+
+    check(check_paths, user_input)
+    check(check_conversion_settings, **kwargs)
+
+    # czi files: czi_to_tiffs expects the cycles 1..N of the filename
+    # template, N is the number of czi files in the directory
+    czi_filename, czi_ext = os.path.splitext(os.path.basename(czidir))
+    basedir = os.path.dirname(czidir)
+    num_cycles = len(glob.glob(os.path.join(basedir, '*' + czi_ext)))
+    if num_cycles == 0:
+        errors.append(f'No czi-files where found in the user specified '
+                      f'directory: {czidir}')
+    if user_input['1_num_cycles'] and user_input['1_num_cycles'] != \
+            num_cycles:
+        plan['warnings'].append(f"{num_cycles} czi files found, "
+                                f"'1_num_cycles' is "
+                                f"{user_input['1_num_cycles']}")
+    czi_paths = {}
+    for i_cyc in range(1, num_cycles + 1):
+        path = os.path.join(basedir, czi_filename.format(i_cyc) + czi_ext)
+        if not os.path.exists(path):
+            errors.append(f'czi file of cycle {i_cyc} not found: {path}')
+        elif not os.path.splitext(os.path.basename(path))[0][-2:].isdigit():
+            errors.append(f'the filename of cycle {i_cyc} does not end with '
+                          f'the two digit cycle number: {path}')
+        else:
+            czi_paths[i_cyc] = path
+
+    # headers and subblock directories of all cycles, in parallel
+    cache = CziMetadataCache()
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(int(workers), len(czi_paths) or 1))
+    if workers == 1:
+        results = [_inspect_cycle(p) for p in czi_paths.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_inspect_cycle, czi_paths.values()))
+    records = {}
+    for i_cyc, (state, cycle_errors) in zip(czi_paths, results):
+        errors.extend(cycle_errors)
+        if state is None:
+            continue
+        record = CziRecord.from_state(state)
+        cache.add(record)
+        records[i_cyc] = record
+        plan['cycles'][i_cyc] = {
+            'file': os.path.basename(record.path),
+            'size': dict(zip(record.dims, record.size)),
+            'tiles': [[list(t) for t in tiles]
+                      for tiles in record.scene_tiles],
+            'exposure_times': check(exposure_times_from_meta,
+                                    record.metadata)}
+
+    if not records:
+        plan['output'] = plan['overlaps'] = plan['runtime_s'] = None
+        print_plan(plan)
+        return plan
+
+    # all cycles need the dimensions of the first cycle (experiment.json is
+    # generated from it)
+    first = min(records)
+    S, T, C, Z, M, Y, X = records[first].size
+    for i_cyc, record in records.items():
+        if record.size != records[first].size:
+            errors.append(f'cycle {i_cyc} has other dimensions than cycle '
+                          f'{first}: {record.size} instead of '
+                          f'{records[first].size} ({record.dims})')
+
+    # checks of meta_to_json, with the metadata of the first cycle
+    md = records[first].metadata
+    checked = check(check_metadata, md, user_input)
+    if os.path.exists(user_input['1_channelnames_dir']):
+        with open(user_input['1_channelnames_dir'], 'r') as f:
+            num_names = len([line for line in f if line.strip()])
+        if num_names != C * num_cycles:
+            plan['warnings'].append(f'channelnames.txt has {num_names} '
+                                    f'names, expected {C * num_cycles} '
+                                    f'({num_cycles} cycles x {C} channels)')
+    # selected tiles of every cycle and their tile grid, as in czi_to_tiffs
+    # and meta_to_json (the overlaps are computed over the selected tiles)
+    selection = kwargs['selection'] or Selection()
+    selected = []
+    for record in records.values():
+        result = check(selected_tile_grid, record.scene_tiles, selection)
+        if result is None:
+            selected = None
+            break
+        selected.append(result)
+    overlaps = None
+    if checked is not None and selected:
+        grid = selected[0][1]
+        overlaps = check(compute_tile_overlaps,
+                         [tiles for scene_tiles, _ in selected
+                          for tiles in scene_tiles if tiles],
+                         checked['region_width'] if grid is None else grid[0])
+    plan['overlaps'] = None if overlaps is None else {
+        'tile_width': int(overlaps.tile_width),
+        'tile_height': int(overlaps.tile_height),
+        'overlap_x': overlaps.fraction_x, 'overlap_y': overlaps.fraction_y}
+
+    # expected output of the selected cycles, tiles, channels and Z-planes
+    cycles = [i_cyc for i_cyc in check(selection.cycle_list, num_cycles) or []
+              if i_cyc in records]
+    tiles = sum(len(check(selection.tile_indices, t) or [])
+                for t in records[first].scene_tiles)
+    C = len(check(selection.channel_indices, C) or [])
+    Z = len(check(selection.z_indices, Z) or [])
+    num_z_saved = 1 if kwargs['z_projection'] else Z
+    stacked_fields = ()
+    if kwargs['output_backend'] in OUTPUT_BACKENDS:
+        # (an unknown backend is reported by check_conversion_settings)
+        stacked_fields = getattr(get_output_backend(kwargs['output_backend']),
+                                 'stacked_fields', ())
+    pages = ((num_z_saved if 'z' in stacked_fields else 1) *
+             (C if 'c' in stacked_fields else 1))
+    bytes_per_pixel = (md.bit_depth + 7) // 8 if md.bit_depth else 2
+    planes = len(cycles) * tiles * C * num_z_saved
+    decoded_mb = len(cycles) * tiles * C * Z * Y * X * bytes_per_pixel / \
+        2**20
+    plan['output'] = {'backend': kwargs['output_backend'],
+                      'cycles': cycles, 'planes': planes,
+                      'files': planes // max(pages, 1),
+                      'mb_uncompressed': planes * Y * X * bytes_per_pixel /
+                      2**20,
+                      'mb_decoded': decoded_mb}
+
+    # runtime estimate: decoded MB / (throughput per worker * workers)
+    throughput = _measured_throughput(outdir)
+    plan['throughput_source'] = 'run report' if throughput else 'assumed'
+    throughput = throughput or DEFAULT_THROUGHPUT_MBS
+    run_workers = max(1, min(int(user_input['1_workers'] or os.cpu_count()),
+                             max(len(cycles), 1) * S))
+    plan['runtime_s'] = decoded_mb / (throughput * run_workers)
+    plan['throughput_mbs'] = throughput
+    plan['workers'] = run_workers
+    print_plan(plan)
+    return plan
+
+
+def print_plan(plan: dict):
+    """Prints the work plan of inspect_run()."""
+    print('.......................................')
+    print('Work plan (metadata only, nothing was converted)')
+    for i_cyc, cycle in sorted(plan['cycles'].items()):
+        size = cycle['size']
+        print(f"Cycle {i_cyc:3d}: {cycle['file']}  S={size['S']} "
+              f"C={size['C']} Z={size['Z']} M={size['M']} "
+              f"tiles {size['X']}x{size['Y']}  exposure times "
+              f"{cycle['exposure_times']}")
+    if plan.get('overlaps'):
+        o = plan['overlaps']
+        print(f"Tiles: {o['tile_width']}x{o['tile_height']} pixels, overlap "
+              f"x {o['overlap_x']}, y {o['overlap_y']}")
+    if plan.get('output'):
+        out = plan['output']
+        print(f"Output ({out['backend']}, {len(out['cycles'])} cycles): "
+              f"{out['planes']} planes in "
+              f"{out['files']} files, {out['mb_uncompressed']:.0f} MB "
+              f"uncompressed ({out['mb_decoded']:.0f} MB decoded)")
+    if plan.get('runtime_s') is not None:
+        print(f"Estimated runtime: {plan['runtime_s']:.0f} s with "
+              f"{plan['workers']} workers at {plan['throughput_mbs']:.0f} "
+              f"MB/s per worker ({plan['throughput_source']})")
+    for warning in plan['warnings']:
+        print(f'WARNING: {warning}')
+    for error in plan['errors']:
+        print(f'ERROR: {error}')
+    if not plan['errors']:
+        print('All checks passed.')
+
+
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex inspect', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Inspect the czi files and '
+                                                 'options of a conversion '
+                                                 '(headers only, nothing is '
+                                                 'converted) and print the '
+                                                 'work plan. Input: Directory '
+                                                 'to options.yaml')
+    parser.add_argument("options_dir", help="Directory to options.yaml file."
+                                            " (e.g. '/dir/to/optionfile/"
+                                            "options.yaml')",
+                        type=str)
+    parser.add_argument("--workers", help="Number of worker processes, which "
+                                          "read the czi files in parallel.",
+                        type=int, default=None)
+    parser.add_argument("--json", help="Save the work plan as json file.",
+                        type=str, default=None)
+
+    args = parser.parse_args(argv)
+    plan = inspect_run(options_dir=args.options_dir, workers=args.workers)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(plan, f, indent=4, default=str)
+    if plan['errors']:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
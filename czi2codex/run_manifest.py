@@ -0,0 +1,207 @@
+# run manifest for incremental / resumable conversions. For every cycle and
+# region a journal 'czi2codex_manifest/cycNNN_regRRR.jsonl' is kept in the
+# output directory:
+#   - first line: fingerprint of the source czi file and conversion settings
+#   - one line per written tile: output file, subblock coordinates, size, crc32
+#   - one line with the exposure times of the cycle
+# Lines are appended (and flushed) as soon as a tile is written, therefore an
+# interrupted run can be resumed tile by tile. If the source czi file or the
+# conversion settings change, the journal of that cycle and region is started
+# anew. A part of a region (tile range, see job_queue.py) has its own journal
+# 'cycNNN_regRRR_mFFFFF-LLLLL.jsonl'.
+import os
+import glob
+import json
+import threading
+import zlib
+
+MANIFEST_DIR = 'czi2codex_manifest'
+EXPOSURE_TIMES_FILENAME = 'exposure_times.txt'
+
+
+def source_fingerprint(czi_path: str, settings: dict = None):
+    """Fingerprint of a czi file (name, size, mtime) and the conversion
+    settings, with which its tiles were written."""
+    st = os.stat(czi_path)
+    return {'file': os.path.basename(czi_path),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'settings': settings or {}}
+
+
+def part_name(part: tuple):
+    """Suffix of the files of a part (first, stop) of a region: the tile
+    numbers from 1, e.g. (0, 16) -> 'm00001-00016'."""
+    return 'm{:05}-{:05}'.format(part[0] + 1, part[1])
+
+
+def manifest_path(outdir: str, i_cyc: int, region: int = 1, part: str = None):
+    name = 'cyc{:03}_reg{:03}'.format(i_cyc, region)
+    if part is not None:
+        name += '_' + part
+    return os.path.join(outdir, MANIFEST_DIR, name + '.jsonl')
+
+
+def _read_journal(path: str):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # last line of an interrupted run
+                break
+    return entries
+
+
+class CycleManifest:
+    """
+    Journal of the written tiles of one cycle and region.
+    Parameters:
+    -----------
+    outdir: str
+        output directory
+    i_cyc: int
+        cycle number
+    fingerprint: dict
+        see source_fingerprint()
+    resume: bool
+        if True, tiles recorded for the same fingerprint are kept and
+        is_done() reports them; otherwise the journal is started anew
+    region: int
+        region (scene) number, starting from 1
+    part: str
+        part of the region (see part_name()), None: whole region
+    """
+
+    def __init__(self, outdir: str, i_cyc: int, fingerprint: dict,
+                 resume: bool = True, region: int = 1, part: str = None):
+        self.outdir = outdir
+        self.i_cyc = i_cyc
+        self.region = region
+        self.path = manifest_path(outdir, i_cyc, region, part)
+        self.tiles = {}
+        self.exposure_times = None
+        self._lock = threading.Lock()
+
+        entries = _read_journal(self.path) if resume else []
+        if entries and entries[0].get('source') == fingerprint:
+            for entry in entries[1:]:
+                if 'tile' in entry:
+                    self.tiles[entry['tile']] = entry
+                elif 'exposure_times' in entry:
+                    self.exposure_times = entry['exposure_times']
+        else:
+            # new or stale journal
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                f.write(json.dumps({'source': fingerprint}) + '\n')
+        self._file = open(self.path, 'a')
+
+    def is_done(self, filename: str, verify_size: bool = True):
+        """True, if the tile was written for the same source and settings and
+        the file on disk still has the recorded size (if verify_size)."""
+        entry = self.tiles.get(self._relpath(filename))
+        if entry is None:
+            return False
+        if not verify_size:
+            return True
+        try:
+            return os.path.getsize(filename) == entry['size']
+        except OSError:
+            return False
+
+    def add_tile(self, filename: str, payload: bytes, m: int, c: int,
+                 z: int):
+        """Records a written tile (called by the writer thread)."""
+        entry = {'tile': self._relpath(filename), 'm': m, 'c': c, 'z': z,
+                 'size': len(payload), 'crc32': zlib.crc32(payload)}
+        with self._lock:
+            self.tiles[entry['tile']] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def set_exposure_times(self, exposure_times: list):
+        with self._lock:
+            self.exposure_times = list(exposure_times)
+            self._file.write(json.dumps(
+                {'exposure_times': self.exposure_times}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _relpath(self, filename: str):
+        return os.path.relpath(filename, self.outdir).replace(os.sep, '/')
+
+
+def converted_cycles(outdir: str):
+    """Sorted cycles, which have a run manifest (of any region) in the output
+    directory."""
+    pattern = os.path.join(outdir, MANIFEST_DIR, 'cyc*_reg*.jsonl')
+    return sorted({int(os.path.basename(path)[3:6])
+                   for path in glob.glob(pattern)})
+
+
+def read_exposure_times(outdir: str, cycles):
+    """Exposure times of the given cycles, as recorded in the manifest (of
+    the first converted region).
+    Returns a dictionary {cycle: [exposure times]}, cycles without
+    recorded exposure times are missing."""
+    rows = {}
+    for i_cyc in cycles:
+        paths = sorted(glob.glob(os.path.join(
+            outdir, MANIFEST_DIR, 'cyc{:03}_reg*.jsonl'.format(i_cyc))))
+        for path in paths:
+            for entry in _read_journal(path):
+                if 'exposure_times' in entry:
+                    rows[i_cyc] = entry['exposure_times']
+            if i_cyc in rows:
+                break
+    return rows
+
+
+def read_exposure_times_file(outdir: str):
+    """Rows of exposure_times.txt as {cycle: [exposure times]} (empty, if
+    there is no file)."""
+    exptime_path = os.path.join(outdir, EXPOSURE_TIMES_FILENAME)
+    rows = {}
+    if not os.path.exists(exptime_path):
+        return rows
+    with open(exptime_path, 'r') as filehandle:
+        # the first line is the header
+        for line in filehandle.readlines()[1:]:
+            values = line.strip().split(',')
+            if values[0]:
+                times = [float(v) for v in values[1:]]
+                rows[int(values[0])] = [int(t) if t.is_integer() else t
+                                        for t in times]
+    return rows
+
+
+def write_exposure_times_file(outdir: str, rows: dict):
+    """(Re)writes exposure_times.txt with one row per cycle, sorted by cycle.
+    This is the only writer of exposure_times.txt (conversion, resume, watch
+    folder, job queue and batch), so its header always lists the channels
+    CH1..CHn of the rows.
+    Returns the path to exposure_times.txt."""
+    exptime_path = os.path.join(outdir, EXPOSURE_TIMES_FILENAME)
+    num_channels = max((len(r) for r in rows.values()), default=0)
+    with open(exptime_path, 'w') as filehandle:
+        filehandle.write('Cycle,' + ','.join(
+            f'CH{i + 1}' for i in range(num_channels)) + ' \n')
+        for i_cyc in sorted(rows):
+            filehandle.write(str(i_cyc))
+            for listitem in rows[i_cyc]:
+                filehandle.write(',%s' % listitem)
+            filehandle.write('\n')
+    return exptime_path
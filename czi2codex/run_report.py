@@ -0,0 +1,146 @@
+# instrumentation of czi2codex runs: per-stage timers and counters, collected
+# per cycle (also in worker processes) and saved as JSON run report
+# 'czi2codex_run_report.json' in the output directory.
+#
+# Report schema (REPORT_SCHEMA_VERSION = 1):
+# {
+#   "schema": "czi2codex-run-report",
+#   "schema_version": 1,
+#   "started": ISO timestamp, "finished": ISO timestamp,
+#   "wall_time_s": float,
+#   "settings": {conversion settings},
+#   "totals": {"stages_s": {stage: s}, "counters": {name: n}},
+#   "cycles": [{"cycle": int, "region": int, "wall_time_s": float,
+#               "part": str (only for parts of a region, see job_queue.py),
+#               "tiles": int,
+#               "tiles_per_second": float, "stages_s": {...},
+#               "counters": {...}}, ...],
+#   "peak_rss_mb": {"main": float, "workers": float},
+#   "events": [{"time_s": float, "message": str}, ...]
+# }
+# Stages (seconds, summed over threads): "directory" (subblock directory and
+# tile rects), "decode" (czi.read_image), "encode" (tif compression), "write"
+# (disk writes), "xml_parse" (metadata xml to dict, tile metadata),
+# "experiment_json" (meta_to_json), "flat_field" (flat-field statistics),
+# "overview" (downsampled overview).
+# Counters: "subblocks_read", "bytes_decoded", "bytes_written",
+# "tiles_written" (planes), "files_written" (files or chunks of the output
+# backend), "tiles_skipped".
+# New fields may be added; existing fields keep their name and meaning.
+import os
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+REPORT_SCHEMA_VERSION = 1
+REPORT_FILENAME = 'czi2codex_run_report.json'
+
+
+class StageStats:
+    """Thread-safe per-stage timers and counters."""
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, func):
+        """Returns func, wrapped in timer(stage)."""
+        def timed_func(*args, **kwargs):
+            with self.timer(stage):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def merge(self, other: dict):
+        """Adds the timers and counters of to_dict() of another StageStats
+        (e.g. from a worker process)."""
+        with self._lock:
+            for stage, seconds in other['stages_s'].items():
+                self.stages[stage] += seconds
+            for name, n in other['counters'].items():
+                self.counters[name] += n
+
+    def to_dict(self):
+        with self._lock:
+            return {'stages_s': dict(self.stages),
+                    'counters': dict(self.counters)}
+
+
+class RunReport:
+    """
+    Collects the statistics of a run, see the schema above.
+    Usage:
+        report = RunReport(settings)
+        stats = StageStats()
+        with stats.timer('decode'): ...
+        report.add_cycle(1, stats.to_dict(), wall_time)
+        report.write(outdir)
+    """
+
+    def __init__(self, settings: dict = None):
+        self.settings = dict(settings or {})
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.totals = StageStats()
+        self.cycles = {}
+        self.peak_rss_mb = {}
+        self.events = []
+
+    def add_cycle(self, i_cyc: int, stats: dict, wall_time: float,
+                  region: int = 1, part: str = None):
+        """Adds the statistics of one converted cycle (and region, or part of
+        a region)."""
+        self.totals.merge(stats)
+        tiles = stats['counters'].get('tiles_written', 0)
+        self.cycles[(i_cyc, region, part or '')] = {
+            'cycle': i_cyc,
+            'region': region,
+            **({'part': part} if part is not None else {}),
+            'wall_time_s': wall_time,
+            'tiles': tiles,
+            'tiles_per_second': tiles / wall_time if wall_time > 0 else 0.0,
+            'stages_s': stats['stages_s'],
+            'counters': stats['counters']}
+
+    def log(self, message: str):
+        """Adds an event (e.g. a decision of the run) to the report."""
+        self.events.append({'time_s': time.perf_counter() - self._start,
+                            'message': message})
+
+    def to_dict(self):
+        return {'schema': 'czi2codex-run-report',
+                'schema_version': REPORT_SCHEMA_VERSION,
+                'started': self.started.isoformat(),
+                'finished': datetime.now().isoformat(),
+                'wall_time_s': time.perf_counter() - self._start,
+                'settings': self.settings,
+                'totals': self.totals.to_dict(),
+                'cycles': [self.cycles[i] for i in sorted(self.cycles)],
+                'peak_rss_mb': self.peak_rss_mb,
+                'events': self.events}
+
+    def write(self, outdir: str, filename: str = REPORT_FILENAME):
+        """Saves the run report as json file, returns its path."""
+        report_path = os.path.join(outdir, filename)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
+        return report_path
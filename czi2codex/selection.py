@@ -0,0 +1,188 @@
+# selection of a subset of an experiment for the conversion: cycles, tiles
+# (tile numbers and/or a bounding box in stage coordinates), channels and
+# Z-planes, all numbered from 1 as in the output.
+#   - selected cycles keep their numbers, such that single cycles can be
+#     converted again into an existing output directory; exposure_times.txt
+#     and experiment.json then cover all converted cycles of the output
+#     directory (see run_manifest.converted_cycles)
+#   - selected tiles, channels and Z-planes are numbered anew from 1 in the
+#     output (in the order of the czi file), such that the output is a
+#     complete, smaller CODEX experiment (e.g. a quick test set of a few tiles
+#     of a new panel). Use a new output directory for such subsets.
+# Only the subblocks of the selection are read from the czi files.
+import numpy as np
+
+
+def parse_numbers(value, name: str = 'numbers'):
+    """
+    Sorted list of the numbers (>= 1) given as int, list of int or
+    ranges 'first-last' (e.g. [1, '4-6'] -> [1, 4, 5, 6]). None: None (all).
+    """
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    numbers = set()
+    for item in value:
+        if isinstance(item, str) and '-' in item:
+            first, last = (int(i) for i in item.split('-', 1))
+            numbers.update(range(first, last + 1))
+        else:
+            numbers.add(int(item))
+    if not numbers or min(numbers) < 1:
+        raise ValueError(f'{name} must be numbers starting from 1, not '
+                         f'{value}')
+    return sorted(numbers)
+
+
+class Selection:
+    """
+    Subset of the cycles, tiles, channels and Z-planes to convert. None:
+    all of them.
+    Parameters:
+    -----------
+    cycles, tiles, channels, z_planes: list
+        numbers starting from 1, see parse_numbers()
+    bbox: list
+        [x_min, y_min, x_max, y_max] in stage coordinates (pixels) of the
+        tile rects (see read_subblock_rect), tiles intersecting it are
+        selected (if tiles are given as well: tiles of both)
+    """
+
+    def __init__(self, cycles=None, tiles=None, bbox=None, channels=None,
+                 z_planes=None):
+        self.cycles = parse_numbers(cycles, 'cycles')
+        self.tiles = parse_numbers(tiles, 'tiles')
+        self.channels = parse_numbers(channels, 'channels')
+        self.z_planes = parse_numbers(z_planes, 'z_planes')
+        if bbox is not None:
+            bbox = [int(b) for b in bbox]
+            if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                raise ValueError(f'bbox must be [x_min, y_min, x_max, '
+                                 f'y_max], not {bbox}')
+        self.bbox = bbox
+
+    @classmethod
+    def from_options(cls, user_input: dict):
+        """Selection of the options ('1_cycles', '1_tiles', '1_bbox',
+        '1_channels', '1_z_planes'), None if nothing is selected."""
+        selection = cls(cycles=user_input['1_cycles'],
+                        tiles=user_input['1_tiles'],
+                        bbox=user_input['1_bbox'],
+                        channels=user_input['1_channels'],
+                        z_planes=user_input['1_z_planes'])
+        return selection if selection.to_settings() else None
+
+    def to_settings(self):
+        """Selected fields as dict (e.g. for the run manifest)."""
+        settings = {'cycles': self.cycles, 'tiles': self.tiles,
+                    'bbox': self.bbox, 'channels': self.channels,
+                    'z_planes': self.z_planes}
+        return {k: v for k, v in settings.items() if v is not None}
+
+    def __repr__(self):
+        return f'Selection({self.to_settings()})'
+
+    @property
+    def renumbers(self):
+        """True, if tiles, channels or Z-planes are selected (the output is
+        numbered anew)."""
+        return (self.tiles is not None or self.bbox is not None or
+                self.channels is not None or self.z_planes is not None)
+
+    def cycle_list(self, num_cycles: int):
+        """Selected cycles of cycles 1..num_cycles."""
+        if self.cycles is None:
+            return list(range(1, num_cycles + 1))
+        missing = [c for c in self.cycles if c > num_cycles]
+        if missing:
+            raise ValueError(f'selected cycles {missing} do not exist, there '
+                             f'are {num_cycles} cycles')
+        return list(self.cycles)
+
+    def channel_indices(self, C: int):
+        """Selected channels as indices (from 0) of the czi file."""
+        return _indices(self.channels, C, 'channels')
+
+    def z_indices(self, Z: int):
+        """Selected Z-planes as indices (from 0) of the czi file."""
+        return _indices(self.z_planes, Z, 'z_planes')
+
+    def tile_indices(self, tiles):
+        """Selected tiles as indices m (from 0) of a scene with the tile
+        rects (x, y, w, h) tiles. Can be empty (no tile of the scene in the
+        bounding box)."""
+        indices = _indices(self.tiles, len(tiles), 'tiles')
+        if self.bbox is not None:
+            x_min, y_min, x_max, y_max = self.bbox
+            indices = [m for m in indices
+                       if tiles[m][0] < x_max and
+                       tiles[m][0] + tiles[m][2] > x_min and
+                       tiles[m][1] < y_max and
+                       tiles[m][1] + tiles[m][3] > y_min]
+        return indices
+
+
+def _indices(numbers, size: int, name: str):
+    if numbers is None:
+        return list(range(size))
+    if numbers[-1] > size:
+        raise ValueError(f'selected {name} {[n for n in numbers if n > size]}'
+                         f' do not exist, there are {size}')
+    return [n - 1 for n in numbers]
+
+
+def grid_shape(tiles):
+    """(columns, rows) of a grid of tile rects (x, y, w, h): the number of
+    distinct x and y positions (positions closer than half a tile are the
+    same column or row)."""
+    def count(starts, size):
+        starts = np.sort(np.asarray(starts))
+        return 1 + int(np.count_nonzero(np.diff(starts) > size / 2))
+    rects = np.asarray([list(t) for t in tiles])
+    return (count(rects[:, 0], rects[0, 2]),
+            count(rects[:, 1], rects[0, 3]))
+
+
+def selected_tile_grid(scene_tiles, selection: Selection):
+    """
+    Selected tiles ('1_tiles', '1_bbox') of the regions of a czi file and
+    their tile grid. experiment.json describes one grid per region and the
+    tile overlaps are computed on it, so the selected tiles of every region
+    must be a complete rectangular grid, the same in all regions. Checked
+    before anything is converted (czi_to_tiffs, job queue, batch, inspect).
+    Parameters:
+    -----------
+    scene_tiles: list
+        tile rects (x, y, w, h) of every region, see CziRecord.scene_tiles
+    selection: Selection
+        selection of the conversion (None: everything)
+    Returns:
+    --------
+    selected: list
+        the selected tile rects of every region (empty: the region has no
+        selected tile and is not converted)
+    grid: tuple
+        (columns, rows) of the selected tiles, None if all tiles are
+        converted (the grid of the metadata)
+    """
+    selection = selection or Selection()
+    selected = [[tiles[m] for m in selection.tile_indices(tiles)]
+                for tiles in scene_tiles]
+    if selection.tiles is None and selection.bbox is None:
+        return selected, None
+    grids = {grid_shape(tiles) for tiles in selected if tiles}
+    if not grids:
+        raise ValueError(f'No tile is selected ({selection}).')
+    if len(grids) != 1:
+        raise ValueError(f'The selected tiles of all regions need the same '
+                         f'number of tile columns and rows, found (columns, '
+                         f'rows): {sorted(grids)}')
+    (columns, rows), = grids
+    for region, tiles in enumerate(selected):
+        if tiles and len(tiles) != columns * rows:
+            raise ValueError(f'The selected tiles of region {region + 1} are '
+                             f'not a complete grid: {len(tiles)} tiles in '
+                             f'{columns} columns x {rows} rows. Select a '
+                             f'rectangle of tiles ({selection}).')
+    return selected, (columns, rows)
@@ -0,0 +1,161 @@
+# reading the subblocks of a czi file in the order in which they are stored
+# on disk. Together with a read-ahead thread, which streams the file in large
+# sequential chunks into the page cache, the decoder never has to seek back
+# and forth in the file; this matters most on spinning disks and network
+# storage (NFS).
+import os
+import threading
+from itertools import product
+from .czi_directory import is_pyramid_subblock
+
+
+def subblock_read_order(entries, C: int, Z: int, M: int, scene: int = 0,
+                        selected=None):
+    """
+    Returns the subblocks (file_position, m, c, z) of a scene, sorted by their
+    position in the czi file.
+    Parameters:
+    -----------
+    entries: list of SubblockEntry
+        subblock directory, see czi_directory.read_subblock_directory()
+    C, Z, M: int
+        size of channel, focus and mosaic dimension
+    scene: int
+        index of the scene (S)
+    selected: tuple
+        (tiles, channels, z-planes): collections of the indices m, c, z of
+        the subblocks to read. None: all subblocks
+    """
+    order = []
+    for entry in entries:
+        if is_pyramid_subblock(entry) or entry.index.get('S', 0) != scene:
+            continue
+        m = entry.index.get('M', 0)
+        c = entry.index.get('C', 0)
+        z = entry.index.get('Z', 0)
+        if m < M and c < C and z < Z and (
+                selected is None or (m in selected[0] and c in selected[1]
+                                     and z in selected[2])):
+            order.append((entry.file_position, m, c, z))
+    order.sort()
+    return order
+
+
+def iter_subblocks(czi_path: str, entries, C: int, Z: int, M: int,
+                   read_order: str = 'file', prefetch_bytes: int = 0,
+                   scene: int = 0, selected=None):
+    """
+    Yields the indices (m, c, z) of all (selected) subblocks of a scene.
+    Parameters:
+    -----------
+    czi_path: str
+        path to czi file
+    entries: list of SubblockEntry or None
+        subblock directory. If None, the tile order is used
+    C, Z, M: int
+        size of channel, focus and mosaic dimension
+    read_order: str
+        'file': in the order of the subblocks in the czi file
+        'tile': tile by tile, (channel, focus) within each tile
+    prefetch_bytes: int
+        with read_order='file': read the file sequentially up to this many
+        bytes ahead of the current subblock. 0: no read-ahead
+    scene: int
+        index of the scene (S)
+    selected: tuple
+        (tiles, channels, z-planes): collections of the indices m, c, z of
+        the subblocks to read. None: all subblocks. The read-ahead streams
+        the file from the first to the last selected subblock
+    """
+    if read_order not in ('file', 'tile'):
+        raise ValueError(f"unknown read order '{read_order}', expected 'file' "
+                         f"or 'tile'")
+    if selected is None:
+        selected = (range(M), range(C), range(Z))
+    else:
+        selected = tuple(set(s) for s in selected)
+    if read_order == 'tile' or entries is None:
+        for m in sorted(selected[0]):
+            for (c, z) in product(sorted(selected[1]), sorted(selected[2])):
+                yield m, c, z
+        return
+
+    order = subblock_read_order(entries, C, Z, M, scene, selected)
+    if prefetch_bytes <= 0 or not order:
+        for _, m, c, z in order:
+            yield m, c, z
+        return
+    # up to the subblock following the last selected one (or the end)
+    end = min((e.file_position for e in entries
+               if e.file_position > order[-1][0]),
+              default=os.path.getsize(czi_path))
+    with SequentialPrefetcher(czi_path, order[0][0], end,
+                              prefetch_bytes) as prefetcher:
+        for position, m, c, z in order:
+            prefetcher.advance(position)
+            yield m, c, z
+
+
+class SequentialPrefetcher:
+    """
+    Reads a file sequentially in large chunks in a background thread, staying
+    at most window_bytes ahead of the position reported with advance(). The
+    data is discarded, it only has to end up in the page cache before the
+    decoder reads it.
+    """
+
+    def __init__(self, path: str, start: int, end: int, window_bytes: int,
+                 chunk_bytes: int = 16 * 2**20):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.window_bytes = window_bytes
+        self.chunk_bytes = min(chunk_bytes, max(window_bytes, 1))
+        self._position = start
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='czi-prefetch', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        return False
+
+    def advance(self, position: int):
+        """Reports the file position of the subblock read next."""
+        with self._cond:
+            self._position = position
+            self._cond.notify_all()
+
+    def _run(self):
+        buf = bytearray(self.chunk_bytes)
+        try:
+            with open(self.path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), self.start,
+                                     self.end - self.start,
+                                     os.POSIX_FADV_SEQUENTIAL)
+                f.seek(self.start)
+                offset = self.start
+                while offset < self.end:
+                    with self._cond:
+                        while (not self._stop and offset - self._position >=
+                               self.window_bytes):
+                            self._cond.wait()
+                        if self._stop:
+                            return
+                    n = f.readinto(buf)
+                    if not n:
+                        return
+                    offset += n
+        except OSError:
+            # read-ahead is only an optimization, the decoder reads the file
+            # itself
+            return
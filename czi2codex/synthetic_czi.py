@@ -0,0 +1,239 @@
+# synthetic czi files for benchmarks without microscope data. A synthetic czi
+# file is a small json file (extension '.sczi') with the parameters of a
+# mosaic: number of scenes, channels, Z-planes and tiles, tile size, overlap
+# and jitter of the tile positions, and the size of the metadata. It is read
+# with SyntheticCziFile, which serves the part of the aicspylibczi.CziFile
+# API used by czi2codex (dims, size, dims_shape, is_mosaic, meta,
+# read_image, read_subblock_rect, read_subblock_metadata); czi_cache.py
+# opens '.sczi' files with it. The pixels are generated on every read_image
+# (deterministic, smooth structures with noise, such that the tiles compress
+# like real data), the metadata xml contains every field read by czi2codex
+# and is padded with acquisition settings to the size of real czi files.
+import os
+import json
+import threading
+import zlib
+import numpy as np
+import yaml
+from lxml import etree
+from .run_generate_std_options_file import generate_std_options_file
+
+SYNTHETIC_EXT = '.sczi'
+
+METADATA = """<ImageDocument><Metadata>
+<Information>
+<Document><CreationDate>2020-07-08T16:13:40</CreationDate></Document>
+<Image><ComponentBitCount>16</ComponentBitCount><Dimensions><Channels>
+{channels}</Channels></Dimensions></Image>
+<Instrument><Microscopes><Microscope Name="Axio Observer"/></Microscopes>
+<Objectives><Objective><NominalMagnification>20</NominalMagnification>
+<LensNA>0.8</LensNA><Immersion>Air</Immersion></Objective></Objectives>
+</Instrument></Information>
+<ImageScaling><ImagePixelSize>6.5,6.5</ImagePixelSize></ImageScaling>
+<Scaling><Items><Distance Id="X"><Value>3.25e-07</Value></Distance>
+<Distance Id="Y"><Value>3.25e-07</Value></Distance>
+<Distance Id="Z"><Value>1.5e-06</Value></Distance></Items></Scaling>
+<Experiment><ExperimentBlocks><AcquisitionBlock><SubDimensionSetups>
+<RegionsSetup><SampleHolder><TileRegions>{regions}</TileRegions>
+</SampleHolder>
+<SubDimensionSetups><TilesSetup><SubDimensionSetups><MultiTrackSetup>
+{tracks}<SubDimensionSetups><ZStackSetup><Interval><Distance>
+<Value>1.5e-06</Value></Distance></Interval></ZStackSetup>
+</SubDimensionSetups></MultiTrackSetup></SubDimensionSetups></TilesSetup>
+</SubDimensionSetups></RegionsSetup></SubDimensionSetups></AcquisitionBlock>
+</ExperimentBlocks></Experiment>
+<HardwareSetting>{padding}</HardwareSetting>
+</Metadata></ImageDocument>"""
+
+PADDING = ('<ParameterCollection Id="MTBFocus{i}"><Position>{i}.25</Position>'
+           '<Speed>1</Speed><Acceleration>0.5</Acceleration>'
+           '<Comment>stage setting {i} of the acquisition</Comment>'
+           '</ParameterCollection>')
+
+# distance of the scenes (regions) on the stage (pixels)
+SCENE_OFFSET = 100000
+
+
+def emission_wavelengths(C: int):
+    return [465 + 100 * c for c in range(C)]
+
+
+def synthetic_metadata(C: int = 4, S: int = 1, columns: int = 3,
+                       rows: int = 2, size_mb: float = 0.0):
+    """Metadata xml (str) of a synthetic czi file, padded with acquisition
+    settings to about size_mb MB."""
+    channels = ''.join(f'<Channel Name="ch{c}" Id="Channel:{c}">'
+                       f'<ExposureTime>{(c + 1) * 25e6}</ExposureTime>'
+                       f'<EmissionWavelength>{wavelength}'
+                       f'</EmissionWavelength></Channel>'
+                       for c, wavelength in
+                       enumerate(emission_wavelengths(C)))
+    tracks = ''.join('<Track><FocusOffset>0</FocusOffset></Track>'
+                     for _ in range(C))
+    regions = (f'<TileRegion><Columns>{columns}</Columns><Rows>{rows}</Rows>'
+               f'</TileRegion>') * S
+    n_pad = int(size_mb * 2**20 / len(PADDING.format(i=100000)))
+    padding = ''.join(PADDING.format(i=i) for i in range(n_pad))
+    return METADATA.format(channels=channels, regions=regions,
+                           tracks=tracks, padding=padding)
+
+
+def write_synthetic_czi(path: str, *, S: int = 1, C: int = 4, Z: int = 3,
+                        columns: int = 3, rows: int = 2, Y: int = 512,
+                        X: int = 512, overlap: float = 0.1, jitter: int = 2,
+                        seed: int = 0, metadata_mb: float = 0.0):
+    """
+    Writes a synthetic czi file (json, see the top of this file).
+    Parameters:
+    -----------
+    path: str
+        file path, with the extension '.sczi'
+    S, C, Z: int
+        number of scenes (regions), channels and Z-planes
+    columns, rows: int
+        tile grid of every scene (M = columns * rows tiles, row by row)
+    Y, X: int
+        tile size (pixels)
+    overlap: float
+        overlap of neighbouring tiles (fraction of the tile size)
+    jitter: int
+        maximal random deviation of the tile positions from the grid
+        (pixels)
+    seed: int
+        seed of the pixels and tile positions (e.g. the cycle number)
+    metadata_mb: float
+        size of the padding of the metadata xml (MB)
+    """
+    spec = {'S': S, 'C': C, 'Z': Z, 'columns': columns, 'rows': rows,
+            'Y': Y, 'X': X, 'overlap': overlap, 'jitter': jitter,
+            'seed': seed, 'metadata_mb': metadata_mb}
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent=4)
+    return path
+
+
+def write_synthetic_experiment(directory: str, num_cycles: int = 3,
+                               **kwargs):
+    """
+    Writes a synthetic experiment: the czi files 'data-CYC01.sczi', ...,
+    channelnames.txt and options.yaml (with the output directory
+    directory/out). kwargs are passed to write_synthetic_czi().
+    Returns the path to options.yaml.
+    """
+    os.makedirs(os.path.join(directory, 'out'), exist_ok=True)
+    czidir = os.path.join(directory, 'data-CYC{:02}' + SYNTHETIC_EXT)
+    for i_cyc in range(1, num_cycles + 1):
+        write_synthetic_czi(czidir.format(i_cyc), seed=i_cyc, **kwargs)
+    C = kwargs.get('C', 4)
+    channelnames = os.path.join(directory, 'channelnames.txt')
+    with open(channelnames, 'w') as f:
+        for i_cyc in range(1, num_cycles + 1):
+            for c in range(C):
+                f.write(f'marker{i_cyc}_{c + 1}\n')
+    options = generate_std_options_file(directory, save=False)
+    options.update({'1_czidir': czidir,
+                    '1_outdir': os.path.join(directory, 'out'),
+                    '1_channelnames_dir': channelnames,
+                    '1_resume': False,
+                    '1_overwrite_exposure_times': True,
+                    'wavelengths': emission_wavelengths(C)})
+    options_path = os.path.join(directory, 'options.yaml')
+    with open(options_path, 'w', encoding='utf-8') as yaml_file:
+        yaml.dump(options, yaml_file)
+    return options_path
+
+
+def _rng(*key):
+    return np.random.default_rng(zlib.crc32(repr(key).encode()))
+
+
+class SyntheticCziFile:
+    """
+    Synthetic czi file with the API of aicspylibczi.CziFile, which is used
+    by czi2codex (see the top of this file).
+    Parameters:
+    -----------
+    czi_path: str
+        path to the synthetic czi file (json)
+    """
+    dims = 'STCZMYX'
+
+    def __init__(self, czi_path: str):
+        with open(czi_path, 'r') as f:
+            self.spec = json.load(f)
+        s = self.spec
+        self.size = (s['S'], 1, s['C'], s['Z'], s['columns'] * s['rows'],
+                     s['Y'], s['X'])
+        self._meta = None
+        self._structures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            s = self.spec
+            self._meta = etree.fromstring(synthetic_metadata(
+                s['C'], s['S'], s['columns'], s['rows'], s['metadata_mb']))
+        return self._meta
+
+    def dims_shape(self):
+        return [{dim: (0, n) for dim, n in zip(self.dims, self.size)}]
+
+    def is_mosaic(self):
+        return True
+
+    def read_subblock_rect(self, S: int = 0, T: int = 0, C: int = 0,
+                           Z: int = 0, M: int = 0):
+        """(x, y, w, h) of a tile: position in the grid (row by row) with
+        random jitter, the same for all channels and Z-planes."""
+        s = self.spec
+        step_x = s['X'] - int(s['X'] * s['overlap'])
+        step_y = s['Y'] - int(s['Y'] * s['overlap'])
+        dx, dy = (_rng(s['seed'], S, M).integers(-s['jitter'],
+                                                  s['jitter'] + 1, 2)
+                  if s['jitter'] else (0, 0))
+        return (S * SCENE_OFFSET + M % s['columns'] * step_x + int(dx),
+                M // s['columns'] * step_y + int(dy), s['X'], s['Y'])
+
+    def read_subblock_metadata(self, unified_xml: bool = False, S: int = 0,
+                               T: int = 0, C: int = 0, Z: int = 0,
+                               M: int = 0):
+        x, y, _, _ = self.read_subblock_rect(S=S, C=C, Z=Z, M=M)
+        return etree.fromstring(
+            f'<METADATA><Tags><StageXPosition>{x}</StageXPosition>'
+            f'<StageYPosition>{y}</StageYPosition>'
+            f'<FocusPosition>{Z * 1.5}</FocusPosition></Tags></METADATA>')
+
+    def _structure(self, C: int, Z: int):
+        """Smooth random structures of a channel and Z-plane (tile size,
+        uint16), the same for all tiles (shifted per tile)."""
+        with self._lock:
+            if (C, Z) not in self._structures:
+                s = self.spec
+                coarse = _rng(s['seed'], 'structure', C).random(
+                    (s['Y'] // 16 + 1, s['X'] // 16 + 1), np.float32)
+                fine = np.repeat(np.repeat(coarse, 16, axis=0), 16,
+                                 axis=1)[:s['Y'], :s['X']]
+                # box blur along both axes (cumulative sums)
+                for axis in (0, 1):
+                    c = np.cumsum(fine, axis=axis, dtype=np.float32)
+                    fine = (c - np.roll(c, 16, axis=axis)) / 16
+                # out of focus planes are darker
+                focus = 1.0 - abs(Z - s['Z'] // 2) / max(s['Z'], 1)
+                self._structures[C, Z] = (np.clip(fine, 0, 1) ** 3 *
+                                          (4000 * focus) + 100).astype(
+                                              np.uint16)
+            return self._structures[C, Z]
+
+    def read_image(self, S: int = 0, T: int = 0, C: int = 0, Z: int = 0,
+                   M: int = 0):
+        """Returns the pixels of one subblock (uint16, shape
+        (1, 1, 1, 1, 1, Y, X)) and its dims."""
+        s = self.spec
+        rng = _rng(s['seed'], S, C, Z, M)
+        shift = rng.integers(0, max(s['Y'], s['X']), 2)
+        data = np.roll(self._structure(C, Z), tuple(shift), axis=(0, 1))
+        data += rng.integers(0, 64, data.shape, np.uint16)
+        dims = [('S', 1), ('T', 1), ('C', 1), ('Z', 1), ('M', 1),
+                ('Y', s['Y']), ('X', s['X'])]
+        return data.reshape((1, 1, 1, 1, 1) + data.shape), dims
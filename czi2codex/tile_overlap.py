@@ -0,0 +1,142 @@
+# vectorized computation of the tile overlaps of all tiles of all cycles.
+# The tile rects (x, y, w, h) of every cycle are stacked into one array of
+# shape (cycles, M, 4), reshaped to the tile grid and the overlaps between all
+# horizontal and vertical neighbours are computed at once.
+import os
+import json
+import warnings
+import numpy as np
+
+
+class TileOverlaps:
+    """
+    Overlaps (in pixel) between neighbouring tiles of a grid.
+    overlap_x: np.ndarray, shape (cycles, rows, columns - 1)
+        overlap between tile (row, col) and (row, col + 1)
+    overlap_y: np.ndarray, shape (cycles, rows - 1, columns)
+        overlap between tile (row, col) and (row + 1, col)
+    tile_width, tile_height: int
+        size of the tiles (of the first tile of the first cycle)
+    tolerance: int
+        overlaps differing more than this from the median are outliers
+    """
+
+    def __init__(self, overlap_x, overlap_y, tile_width, tile_height,
+                 tolerance: int = 2):
+        self.overlap_x = overlap_x
+        self.overlap_y = overlap_y
+        self.tile_width = int(tile_width)
+        self.tile_height = int(tile_height)
+        self.tolerance = tolerance
+
+    @property
+    def x(self):
+        """robust overlap in x (median over all tiles and cycles), pixel"""
+        return _median(self.overlap_x)
+
+    @property
+    def y(self):
+        """robust overlap in y (median over all tiles and cycles), pixel"""
+        return _median(self.overlap_y)
+
+    @property
+    def fraction_x(self):
+        """overlap in x as fraction of the tile width (rounded to 0.1)"""
+        return round(self.x / self.tile_width, 1)
+
+    @property
+    def fraction_y(self):
+        """overlap in y as fraction of the tile height (rounded to 0.1)"""
+        return round(self.y / self.tile_height, 1)
+
+    def outliers(self, axis: str):
+        """Returns a list of (cycle, row, column, overlap) of all tile pairs,
+        whose overlap differs from the median by more than the tolerance.
+        Cycles start from 1, rows and columns from 0."""
+        overlap = self.overlap_x if axis == 'x' else self.overlap_y
+        if overlap.size == 0:
+            return []
+        median = _median(overlap)
+        idx = np.argwhere(np.abs(overlap - median) > self.tolerance)
+        return [(int(c) + 1, int(r), int(col), int(overlap[c, r, col]))
+                for c, r, col in idx]
+
+    def stats(self, axis: str):
+        """Statistics of the overlaps in x or y direction."""
+        overlap = self.overlap_x if axis == 'x' else self.overlap_y
+        if overlap.size == 0:
+            return {'count': 0}
+        per_cycle = overlap.reshape(overlap.shape[0], -1)
+        return {'count': int(overlap.size),
+                'mean': float(overlap.mean()),
+                'median': _median(overlap),
+                'min': int(overlap.min()),
+                'max': int(overlap.max()),
+                'std': float(overlap.std()),
+                'median_per_cycle': [float(v) for v in
+                                     np.median(per_cycle, axis=1)],
+                'outliers': self.outliers(axis)}
+
+    def report(self):
+        """Validation report (dictionary) of the tile overlaps."""
+        return {'tileWidth': self.tile_width,
+                'tileHeight': self.tile_height,
+                'tolerance': self.tolerance,
+                'tileOverlapX': self.fraction_x,
+                'tileOverlapY': self.fraction_y,
+                'x': self.stats('x'),
+                'y': self.stats('y')}
+
+
+def _median(overlap):
+    if overlap.size == 0:
+        return 0.0
+    return float(np.median(overlap))
+
+
+def compute_tile_overlaps(rects, region_width: int, tolerance: int = 2):
+    """
+    Computes the overlaps between all neighbouring tiles of all cycles in one
+    pass (tiling mode 'grid', tiles ordered row by row).
+    Parameters:
+    -----------
+    rects: array-like, shape (cycles, M, 4) or (M, 4)
+        tile rects (x, y, w, h), e.g. [record.tiles for record in records]
+    region_width: int
+        number of tiles per row (columns of the tile region)
+    tolerance: int
+        overlaps differing more than this from the median are outliers
+    Returns:
+    --------
+    TileOverlaps
+    """
+    rects = np.asarray(rects, dtype=np.int64)
+    if rects.ndim == 2:
+        rects = rects[np.newaxis]
+    n_cycles, M, _ = rects.shape
+    if M % region_width != 0:
+        raise ValueError(f'The number of tiles ({M}) is not a multiple of the '
+                         f'region width ({region_width}).')
+    grid = rects.reshape(n_cycles, M // region_width, region_width, 4)
+    x, y, w, h = np.moveaxis(grid, -1, 0)
+    overlap_x = x[:, :, :-1] + w[:, :, :-1] - x[:, :, 1:]
+    overlap_y = y[:, :-1, :] + h[:, :-1, :] - y[:, 1:, :]
+    return TileOverlaps(overlap_x, overlap_y, w[0, 0, 0], h[0, 0, 0],
+                        tolerance)
+
+
+def write_overlap_report(overlaps: TileOverlaps, outdir: str,
+                         filename: str = 'tile_overlap_report.json'):
+    """Saves the validation report of the tile overlaps and warns about
+    outliers. Returns the path to the report."""
+    report = overlaps.report()
+    n_outliers = len(report['x'].get('outliers', [])) + \
+        len(report['y'].get('outliers', []))
+    if n_outliers:
+        warnings.warn(f'{n_outliers} tile overlaps differ by more than '
+                      f'{overlaps.tolerance} pixel from the median overlap. '
+                      f'Please check {filename}.')
+    report_path = os.path.join(outdir, filename)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    return report_path
@@ -0,0 +1,280 @@
+# bounded producer/consumer pipeline for writing tiles: the reader (calling
+# thread) decodes tiles from the czi file, a pool of encoder threads
+# compresses them to tiff-bytes and a writer thread flushes them to disk.
+# zlib-compression and file writes release the GIL, so the three stages
+# overlap even in a single process.
+import io
+import inspect
+import queue
+import threading
+import numpy as np
+import tifffile
+from .memory_budget import MemoryBudget, BudgetAborted
+
+_DONE = object()
+# returned by encode(), if the tile is kept by the encoder (e.g. a plane of a
+# tif stack, which is written when the stack is complete)
+RETAINED = object()
+
+
+class PipelineAborted(Exception):
+    """Raised in the reader, if one of the pipeline threads failed."""
+
+
+# codecs, which can be chosen for the tif-files ('none': uncompressed).
+# zlib is always available, the others need the 'imagecodecs' package.
+TIFF_CODECS = ('none', 'zlib', 'zstd', 'lzw', 'lz4', 'lzma')
+
+# tifffile >= 2022.7 takes the compression level as separate argument
+_HAS_COMPRESSIONARGS = 'compressionargs' in inspect.signature(
+    tifffile.TiffWriter.write).parameters
+
+
+def tiff_write_kwargs(compression: str = 'zlib', level: int = None,
+                      predictor: bool = False, tile=None):
+    """
+    Keyword arguments for tifffile.imwrite.
+    Parameters:
+    -----------
+    compression: str
+        codec, one of TIFF_CODECS (None or 'none': uncompressed)
+    level: int
+        compression level of the codec, None: default of the codec
+    predictor: bool
+        use horizontal differencing before compression
+    tile: tuple
+        (height, width) of tif-tiles (tiled tif), None: striped tif
+    """
+    kwargs = {'compression': None}
+    if compression is not None and compression != 'none':
+        if compression not in TIFF_CODECS:
+            raise ValueError(f"unknown tif compression '{compression}', "
+                             f"expected one of {TIFF_CODECS}")
+        kwargs['compression'] = compression
+        if level is not None:
+            if _HAS_COMPRESSIONARGS:
+                kwargs['compressionargs'] = {'level': level}
+            else:
+                kwargs['compression'] = (compression, level)
+        if predictor:
+            kwargs['predictor'] = True
+    if tile:
+        kwargs['tile'] = tuple(tile)
+    return kwargs
+
+
+def check_tiff_codec(**write_kwargs):
+    """Raises a ValueError, if tifffile can not write with the given
+    settings (e.g. codec not available)."""
+    try:
+        encode_tiff(np.zeros((32, 32), np.uint16), **write_kwargs)
+    except Exception as e:
+        raise ValueError(f'tif-files can not be written with {write_kwargs}: '
+                         f'{e}. Codecs other than zlib need the '
+                         f"'imagecodecs' package.") from e
+
+
+def encode_tiff(data, compression='zlib', **write_kwargs):
+    """Compresses a tile and returns the bytes of the complete tif-file (as
+    memoryview of the encoding buffer, which avoids copying the file).
+    write_kwargs are passed to tifffile.imwrite, see tiff_write_kwargs()."""
+    buf = io.BytesIO()
+    tifffile.imwrite(buf, data, compression=compression, **write_kwargs)
+    return buf.getbuffer()
+
+
+def write_file(filename: str, payload: bytes):
+    """Writes an encoded tile to disk."""
+    with open(filename, 'wb') as f:
+        f.write(payload)
+
+
+class TilePipeline:
+    """
+    Overlaps czi-decoding, tiff-compression and disk writes of tiles.
+    Usage:
+        with TilePipeline(encode, write) as pipeline:
+            for filename, data in tiles:
+                pipeline.put(filename, data)
+    Parameters:
+    -----------
+    encode: callable
+        encode(filename, data) -> payload, called in the encoder threads.
+        RETAINED: the tile is kept until a payload of its group is written
+    write: callable
+        write(filename, payload), called in the writer thread
+    encoder_threads: int
+        number of encoder threads. If 0, encode and write are called directly
+        in put() (no threads)
+    read_queue_size: int
+        maximal number of decoded tiles waiting for compression
+    write_queue_size: int
+        maximal number of compressed tiles waiting to be written
+    memory_budget: int
+        maximal number of bytes of (raw) tiles in flight, put() blocks until
+        written tiles free enough memory. None: only bounded by the queues
+    The memory in use is bounded by roughly
+    (read_queue_size + encoder_threads) * raw tile size +
+    (write_queue_size + 1) * compressed tile size + retained tiles,
+    and by memory_budget + one raw tile. Retained tiles stay counted in the
+    memory budget until the payload of their group is written; if they take
+    the whole budget, the next tile is granted beyond it (otherwise their
+    group could not be completed), so the bound is then memory_budget +
+    one group (e.g. one tif stack, if the tiles of a stack are put one after
+    another).
+    """
+
+    def __init__(self, encode, write, *, encoder_threads: int = 2,
+                 read_queue_size: int = 8, write_queue_size: int = 8,
+                 memory_budget: int = None):
+        self.encode = encode
+        self.write = write
+        self.encoder_threads = max(0, int(encoder_threads))
+        self._read_q = queue.Queue(maxsize=max(1, int(read_queue_size)))
+        self._write_q = queue.Queue(maxsize=max(1, int(write_queue_size)))
+        self._stop = threading.Event()
+        self._error = None
+        self._encoders = []
+        self._writer = None
+        self._closed = False
+        self.budget = MemoryBudget(memory_budget)
+        # group -> bytes of its tiles, which are not released yet, and the
+        # part of them held by RETAINED tiles
+        self._group_bytes = {}
+        self._group_held = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if self.encoder_threads > 0:
+            self._encoders = [threading.Thread(target=self._encode_loop,
+                                               name=f'tile-encoder-{i}',
+                                               daemon=True)
+                              for i in range(self.encoder_threads)]
+            self._writer = threading.Thread(target=self._write_loop,
+                                            name='tile-writer', daemon=True)
+            for t in self._encoders + [self._writer]:
+                t.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._stop.set()
+            self._join()
+            if isinstance(exc, PipelineAborted) and self._error is not None:
+                raise self._error from None
+            return False
+        self.close()
+        return False
+
+    def put(self, filename: str, data, group=None, nbytes: int = None):
+        """Hands a decoded tile over to the encoder threads. Blocks, if the
+        read queue is full or the memory budget is used up.
+        group: tiles, which are written with one payload (e.g. the file of a
+        tif stack), default: filename. nbytes: memory counted for the tile,
+        default: data.nbytes"""
+        if self.encoder_threads == 0:
+            payload = self.encode(filename, data)
+            if payload is not RETAINED:
+                self.write(filename, payload)
+            return
+        if nbytes is None:
+            nbytes = getattr(data, 'nbytes', 0)
+        try:
+            self.budget.acquire(nbytes, abort=self._stop)
+        except BudgetAborted:
+            raise PipelineAborted('tile pipeline stopped') from None
+        group = filename if group is None else group
+        self._put(self._read_q, (filename, data, group, nbytes))
+
+    def close(self):
+        """Waits until all tiles are written. Raises the first error of the
+        pipeline threads."""
+        if self._closed:
+            return
+        self._closed = True
+        if self.encoder_threads > 0:
+            try:
+                for _ in self._encoders:
+                    self._put(self._read_q, _DONE)
+                for t in self._encoders:
+                    t.join()
+                self._put(self._write_q, _DONE)
+            except PipelineAborted:
+                pass
+            self._join()
+        if self._error is not None:
+            raise self._error
+
+    def _join(self):
+        for t in self._encoders + ([self._writer] if self._writer else []):
+            t.join()
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _put(self, q, item):
+        while True:
+            if self._stop.is_set():
+                raise PipelineAborted('tile pipeline stopped')
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while True:
+            if self._stop.is_set():
+                raise PipelineAborted('tile pipeline stopped')
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _encode_loop(self):
+        try:
+            while True:
+                item = self._get(self._read_q)
+                if item is _DONE:
+                    return
+                filename, data, group, nbytes = item
+                # counted before encode: the payload of the group can be
+                # written as soon as encode() has taken the tile
+                with self._lock:
+                    self._group_bytes[group] = \
+                        self._group_bytes.get(group, 0) + nbytes
+                payload = self.encode(filename, data)
+                del data, item
+                if payload is RETAINED:
+                    with self._lock:
+                        # unless the group was written meanwhile
+                        if group in self._group_bytes:
+                            self._group_held[group] = \
+                                self._group_held.get(group, 0) + nbytes
+                            self.budget.hold(nbytes)
+                    continue
+                self._put(self._write_q, (filename, payload, group))
+        except PipelineAborted:
+            return
+        except BaseException as e:
+            self._fail(e)
+
+    def _write_loop(self):
+        try:
+            while True:
+                item = self._get(self._write_q)
+                if item is _DONE:
+                    return
+                filename, payload, group = item
+                self.write(filename, payload)
+                del payload, item
+                with self._lock:
+                    nbytes = self._group_bytes.pop(group)
+                    held = self._group_held.pop(group, 0)
+                self.budget.release(nbytes, held)
+        except PipelineAborted:
+            return
+        except BaseException as e:
+            self._fail(e)
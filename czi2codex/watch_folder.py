@@ -0,0 +1,248 @@
+# watch-folder mode: converts the cycles while the microscope is still
+# acquiring. The czi directory is polled; a cycle file is converted as soon as
+# it is complete (its size and modification time did not change for a while),
+# its row of exposure_times.txt is added, and experiment.json is written once
+# the expected number of cycles has arrived. The regions of the cycles, which
+# are complete at the same time, are converted by '1_workers' worker
+# processes.
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from .czi2tif_codex import (_run_cycle, _dispatch_units,
+                            check_conversion_settings)
+from .flat_field import save_flat_field
+from .generate_metadata_json import meta_to_json, process_user_options
+from .czi_cache import CziMetadataCache, CziRecord
+from .output_backends import get_output_backend, save_experiment_attrs
+from .run_manifest import read_exposure_times, write_exposure_times_file
+from .run_report import RunReport
+from .run_czi2codex import check_paths, conversion_kwargs
+from .selection import selected_tile_grid
+
+
+class CycleWatcher:
+    """
+    Detects complete czi files of the cycles.
+    A file is regarded complete, if its size and modification time did not
+    change for stable_time seconds (the microscope software writes the
+    subblock directory at the end and closes the file).
+    Parameters:
+    -----------
+    czidir: str
+        directory of czi-files, with filename-template for the
+        different cycles (e.g. '/dir/to/czifiles/filename_CYC{:02}.czi')
+    num_cycles: int
+        expected number of cycles
+    stable_time: float
+        seconds without change of a file, until it is regarded complete
+    """
+
+    def __init__(self, czidir: str, num_cycles: int,
+                 stable_time: float = 30.0):
+        self.czidir = czidir
+        self.num_cycles = num_cycles
+        self.stable_time = stable_time
+        self.completed = set()
+        # cycle: ((size, mtime), time since when the file is unchanged)
+        self._seen = {}
+
+    def czi_path(self, i_cyc: int):
+        czi_filename, czi_ext = os.path.splitext(
+            os.path.basename(self.czidir))
+        return os.path.join(os.path.dirname(self.czidir),
+                            czi_filename.format(i_cyc) + czi_ext)
+
+    @property
+    def done(self):
+        return len(self.completed) == self.num_cycles
+
+    def poll(self):
+        """Returns a list of (cycle, czi path) of the cycles, which became
+        complete since the last poll, sorted by cycle."""
+        now = time.monotonic()
+        ready = []
+        for i_cyc in range(1, self.num_cycles + 1):
+            if i_cyc in self.completed:
+                continue
+            path = self.czi_path(i_cyc)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            previous = self._seen.get(i_cyc)
+            if previous is None or previous[0] != state:
+                self._seen[i_cyc] = (state, now)
+            elif st.st_size > 0 and now - previous[1] >= self.stable_time:
+                self.completed.add(i_cyc)
+                ready.append((i_cyc, path))
+        return ready
+
+
+def watch_folder(options_dir: str, num_cycles: int = None,
+                 poll_interval: float = 10.0, stable_time: float = 30.0,
+                 timeout: float = None, workers: int = None):
+    """
+    Converts the cycles as the microscope writes them. Runs until the
+    expected number of cycles has been converted and experiment.json is
+    written.
+    Parameters:
+    -----------
+    options_dir: str
+        directory of options.yaml file,
+        (e.g. '/dir/to/czifiles/options.yaml')
+    num_cycles: int
+        expected number of cycles. If not given, it is read from
+        "1_num_cycles:" in options.yaml
+    poll_interval: float
+        seconds between two scans of the czi directory
+    stable_time: float
+        seconds without change of a czi file, until it is converted
+    timeout: float
+        give up (TimeoutError), if the cycles did not arrive within this many
+        seconds. None: wait forever
+    workers: int
+        number of worker processes, which convert the regions of the cycles
+        complete at the same time in parallel. If not given, it is read from
+        "1_workers:" in options.yaml (None there: all cpu cores)
+    The conversion settings are checked before the folder is watched, and the
+    tile selection of every cycle before it is converted.
+    exposure_times.txt is rebuilt from the run manifest after every cycle,
+    therefore it is complete, whatever the order of the arriving cycles.
+    """
+    user_input = process_user_options(options_dir)
+    czidir = user_input['1_czidir']
+    outdir = user_input['1_outdir']
+    template = user_input['1_out_template']
+    if num_cycles is None:
+        num_cycles = user_input['1_num_cycles']
+    if not num_cycles:
+        raise ValueError('The expected number of cycles is needed in the '
+                         'watch-folder mode, please define "1_num_cycles:" '
+                         'in options.yaml or use --cycles.')
+    if workers is None:
+        workers = user_input['1_workers']
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, int(workers))
+    check_paths(user_input)
+    kwargs = conversion_kwargs(user_input)
+    # fail before the first cycle arrives, if the codec, the backend or the
+    # z-projection is not available
+    check_conversion_settings(**kwargs)
+    get_output_backend(kwargs['output_backend']).prepare(outdir)
+    # each worker process gets its share of the memory budget
+    if kwargs['memory_budget_mb'] is not None:
+        kwargs['memory_budget_mb'] /= workers
+
+    cache = CziMetadataCache()
+    report = RunReport(dict(kwargs, template=template, watch=True,
+                            workers=workers))
+    watcher = CycleWatcher(czidir, num_cycles, stable_time)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 \
+        else None
+    start = time.monotonic()
+    print('.......................................')
+    print(f'Watching {os.path.dirname(czidir)} for {num_cycles} cycles '
+          f'({workers} worker processes).')
+    try:
+        while True:
+            # all regions of the cycles, which are complete
+            units = []
+            for i_cyc, czi_path in watcher.poll():
+                selection = kwargs['selection']
+                if selection is not None and selection.cycles is not None \
+                        and i_cyc not in selection.cycles:
+                    print(f'Cycle = {i_cyc}: not selected')
+                    continue
+                record = cache.get(czi_path)
+                # fail before anything is written, if the selected tiles are
+                # no complete tile grid
+                selected_tile_grid(record.scene_tiles, selection)
+                print(f'Cycle = {i_cyc}: converting {czi_path}')
+                units.extend((i_cyc, czi_path, scene)
+                             for scene in range(record.size[0]))
+            if executor is None:
+                results = (_run_cycle(i_cyc, czi_path, outdir, template,
+                                      kwargs, cache, scene)
+                           for i_cyc, czi_path, scene in units)
+            else:
+                results = _dispatch_units(executor, units, outdir, template,
+                                          lambda: kwargs, lambda: workers)
+            for (i_cyc, czi_path, scene), result in zip(units, results):
+                if executor is not None:
+                    state, _, cycle_stats, wall_time = result
+                    cache.add(CziRecord.from_state(state))
+                else:
+                    _, cycle_stats, wall_time = result
+                report.add_cycle(i_cyc, cycle_stats, wall_time,
+                                 region=scene + 1)
+                if scene < cache.get(czi_path).size[0] - 1:
+                    continue
+                # all regions of the cycle are converted
+                if kwargs['flat_field']:
+                    save_flat_field(outdir, i_cyc)
+                report.log(f'cycle {i_cyc} converted')
+                write_exposure_times_file(outdir, read_exposure_times(
+                    outdir, sorted(watcher.completed)))
+            if watcher.done:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                report.write(outdir)
+                raise TimeoutError(f'Only {len(watcher.completed)} of '
+                                   f'{num_cycles} cycles arrived within '
+                                   f'{timeout} s.')
+            time.sleep(poll_interval)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print(f"...finished generation of .tif files and exposure.txt file! ...\n"
+          f"...Saved in {outdir}")
+    meta = cache.get(watcher.czi_path(num_cycles)).meta
+    dict_json = meta_to_json(meta, czidir, outdir,
+                             user_input['1_channelnames_dir'], options_dir,
+                             cache=cache, report=report)
+    save_experiment_attrs(kwargs['output_backend'], outdir, dict_json)
+    print(f'...Run report saved in {report.write(outdir)}')
+
+
+def main(argv: list = None, prog: str = None):
+    """Command line interface (also 'czi2codex watch', see cli.py).
+    argv: arguments (default: sys.argv[1:]), prog: name in the usage."""
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Watch the czi directory and '
+                                                 'convert the cycles to codex-'
+                                                 'format as soon as they are '
+                                                 'written. Input: Directory '
+                                                 'to options.yaml')
+    parser.add_argument("options_dir", help="Directory to options.yaml file."
+                                            " (e.g. '/dir/to/optionfile/"
+                                            "options.yaml')",
+                        type=str)
+    parser.add_argument("--cycles", help="Expected number of cycles. "
+                                         "Overrides '1_num_cycles' in "
+                                         "options.yaml.",
+                        type=int, default=None)
+    parser.add_argument("--poll", help="Seconds between two scans of the czi "
+                                       "directory.",
+                        type=float, default=10.0)
+    parser.add_argument("--stable", help="Seconds without change of a czi "
+                                         "file, until it is converted.",
+                        type=float, default=30.0)
+    parser.add_argument("--timeout", help="Give up after this many seconds.",
+                        type=float, default=None)
+    parser.add_argument("--workers", help="Number of worker processes. "
+                                          "Overrides '1_workers' in "
+                                          "options.yaml.",
+                        type=int, default=None)
+
+    args = parser.parse_args(argv)
+    watch_folder(options_dir=args.options_dir, num_cycles=args.cycles,
+                 poll_interval=args.poll, stable_time=args.stable,
+                 timeout=args.timeout, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# reduction of the Z-planes of every (tile, channel) to a single plane while
+# the planes stream in: maximum intensity projection ('max') or extended depth
+# of field ('edf', every pixel is taken from the plane in which it is most in
+# focus). The reduction wraps the output backend, so only the reduced planes
+# are written (as Z-plane 1).
+import threading
+import numpy as np
+
+Z_PROJECTIONS = ('max', 'edf')
+# bytes per pixel of the focus measure kept next to an 'edf' projection
+SCORE_BYTES = 4
+
+
+def focus_measure(plane, radius: int = 2):
+    """
+    Per-pixel focus measure of a plane: energy of the laplacian, averaged in a
+    (2 * radius + 1)^2 window (vectorized, with an integral image).
+    Returns an np.ndarray (float32) of the shape of the plane.
+    """
+    p = np.pad(plane.astype(np.float32), 1, mode='edge')
+    laplacian = (p[:-2, 1:-1] + p[2:, 1:-1] + p[1:-1, :-2] + p[1:-1, 2:] -
+                 4 * p[1:-1, 1:-1])
+    energy = np.pad(laplacian * laplacian, radius, mode='edge')
+    integral = np.zeros((energy.shape[0] + 1, energy.shape[1] + 1),
+                        np.float64)
+    np.cumsum(np.cumsum(energy, axis=0), axis=1, out=integral[1:, 1:])
+    w = 2 * radius + 1
+    window = (integral[w:, w:] - integral[:-w, w:] - integral[w:, :-w] +
+              integral[:-w, :-w])
+    return (window / (w * w)).astype(np.float32)
+
+
+class ZAccumulator:
+    """
+    Running projection of the Z-planes of one tile and channel; the planes
+    can be added in any order.
+    Parameters:
+    -----------
+    method: str
+        'max' or 'edf'
+    """
+
+    def __init__(self, method: str):
+        self.method = method
+        self.count = 0
+        self.projection = None
+        # focus measure of the pixels in the projection ('edf')
+        self._score = None
+        self.lock = threading.Lock()
+
+    def add(self, plane, score=None):
+        """Adds a plane. For 'edf', score is its focus_measure(). The first
+        plane is reused as projection (no copy)."""
+        if self.projection is None:
+            self.projection = plane
+            self._score = score
+        elif self.method == 'max':
+            np.maximum(self.projection, plane, out=self.projection)
+        else:
+            better = score > self._score
+            np.copyto(self.projection, plane, where=better)
+            np.copyto(self._score, score, where=better)
+        self.count += 1
+
+
+class ZProjectionBackend:
+    """
+    Wraps an output backend (see output_backends.py): the Z-planes of every
+    tile and channel are reduced in the encoder threads, the projection is
+    encoded and written as Z-plane 1 by the wrapped backend, whose shape must
+    have Z = 1. The planes of an incomplete projection stay counted in the
+    memory budget of the tile pipeline until its file is written (with
+    'edf' also the focus measure, see SCORE_BYTES).
+    Parameters:
+    -----------
+    backend:
+        wrapped output backend
+    method: str
+        'max' (maximum intensity projection) or 'edf' (extended depth of
+        field, focus measure: local energy of the laplacian)
+    Z: int
+        number of Z-planes of the czi file
+    """
+
+    def __init__(self, backend, method: str, Z: int):
+        if method not in Z_PROJECTIONS:
+            raise ValueError(f"unknown z-projection '{method}', expected one "
+                             f"of {Z_PROJECTIONS}")
+        self.backend = backend
+        self.method = method
+        self.Z = Z
+        self.verify_size = backend.verify_size
+        self.num_pages = backend.num_pages
+        # the running projections (and edf focus measures) are kept until
+        # all Z-planes of their tile and channel are added
+        self.retains_planes = True
+        self._accumulators = {}
+        self._lock = threading.Lock()
+
+    def tile_key(self, m: int, c: int, z: int):
+        return self.backend.tile_key(m, c, 0)
+
+    def manifest_coords(self, m: int, c: int, z: int):
+        return self.backend.manifest_coords(m, c, 0)
+
+    def encode(self, key: str, data, m: int, c: int, z: int):
+        # the focus measure is computed in parallel by the encoder threads
+        score = focus_measure(data) if self.method == 'edf' else None
+        with self._lock:
+            accumulator = self._accumulators.get((m, c))
+            if accumulator is None:
+                accumulator = ZAccumulator(self.method)
+                self._accumulators[(m, c)] = accumulator
+        with accumulator.lock:
+            accumulator.add(data, score)
+            if accumulator.count < self.Z:
+                return None
+        with self._lock:
+            del self._accumulators[(m, c)]
+        return self.backend.encode(key, accumulator.projection, m, c, 0)
+
+    def write(self, key: str, payload):
+        self.backend.write(key, payload)
+
+    def close(self, **attrs):
+        if self._accumulators:
+            raise Exception(f'{len(self._accumulators)} incomplete '
+                            f'z-projections')
+        self.backend.close(z_projection=self.method, **attrs)
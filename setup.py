@@ -17,5 +17,11 @@ setup(
         'pyyaml',
         'xmltodict',
         'lxml'
-    ]
+    ],
+    extras_require={
+        'zarr': ['zarr']
+    },
+    entry_points={
+        'console_scripts': ['czi2codex=czi2codex.cli:main']
+    }
 )
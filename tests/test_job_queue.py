@@ -0,0 +1,132 @@
+# Tests of the job queue (czi2codex/job_queue.py) on synthetic czi files
+# (czi2codex/synthetic_czi.py, no aicspylibczi needed): local workers convert
+# the same tifs and exposure_times.txt as a conversion without the queue, and
+# the unit of a worker, which is killed in the middle of it, is taken over by
+# another worker, and a new plan queues the done units of changed settings
+# again.
+import glob
+import os
+import subprocess
+import sys
+import time
+import yaml
+import pytest
+
+from czi2codex.job_queue import (plan_queue, run_worker, assemble, run_local,
+                                 queue_status, QUEUE_DIR)
+from czi2codex.run_czi2codex import czi2codex_all
+from czi2codex.run_manifest import MANIFEST_DIR
+from czi2codex.synthetic_czi import write_synthetic_experiment
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    """Synthetic experiment of 2 cycles with 3 x 2 tiles, the options.yaml
+    of the queue and of a reference conversion without the queue."""
+    # the worker processes import czi2codex from the repository
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    options = write_synthetic_experiment(str(tmp_path), 2, C=2, Z=4, Y=256,
+                                         X=256)
+    with open(options, 'r') as f:
+        user_input = yaml.safe_load(f)
+    reference_dir = tmp_path / 'reference'
+    reference_dir.mkdir()
+    user_input['1_outdir'] = str(tmp_path / 'reference_out')
+    os.makedirs(user_input['1_outdir'])
+    reference = str(reference_dir / 'options.yaml')
+    with open(reference, 'w') as f:
+        yaml.dump(user_input, f)
+    return options, reference
+
+
+def _outdir(options: str):
+    with open(options, 'r') as f:
+        return yaml.safe_load(f)['1_outdir']
+
+
+def _outputs(outdir: str):
+    """Contents of the tifs and exposure_times.txt of an output
+    directory."""
+    paths = sorted(glob.glob(os.path.join(outdir, 'cyc*', '*.tif')))
+    paths.append(os.path.join(outdir, 'exposure_times.txt'))
+    outputs = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            outputs[os.path.relpath(path, outdir)] = f.read()
+    return outputs
+
+
+def test_run_local(experiment):
+    options, reference = experiment
+    run_local(options, workers=2, tiles_per_unit=4)
+    czi2codex_all(reference)
+
+    outdir = _outdir(options)
+    status = queue_status(outdir)
+    assert len(status['done']) == 4 and not status['failed']
+    outputs = _outputs(outdir)
+    # 2 cycles x 6 tiles x 2 channels x 4 Z-planes
+    assert len(outputs) == 2 * 6 * 2 * 4 + 1
+    assert outputs == _outputs(_outdir(reference))
+    assert os.path.exists(os.path.join(outdir, 'experiment.json'))
+
+
+def test_worker_killed_mid_unit(experiment):
+    options, reference = experiment
+    outdir = _outdir(options)
+    plan = plan_queue(options, tiles_per_unit=0)
+    first_unit = plan['units'][0]['id']
+
+    # a worker is killed, as soon as it has written tiles of its first unit
+    worker = subprocess.Popen([sys.executable, '-m', 'czi2codex', 'queue',
+                               'worker', options, '--heartbeat', '0.1'],
+                              stdout=subprocess.DEVNULL, cwd=ROOT)
+    journals = os.path.join(outdir, MANIFEST_DIR, 'cyc001_reg001*.jsonl')
+    deadline = time.time() + 60
+    while time.time() < deadline and worker.poll() is None:
+        if any('"tile"' in open(path).read()
+               for path in glob.glob(journals)):
+            break
+        time.sleep(0.005)
+    worker.kill()
+    worker.wait()
+    units_dir = os.path.join(outdir, QUEUE_DIR, 'units')
+    assert os.path.exists(os.path.join(units_dir, first_unit + '.lock'))
+    assert not os.path.exists(os.path.join(units_dir, first_unit + '.done'))
+
+    # without heartbeat, the lock of the dead worker is broken and its unit
+    # is converted (resumed from the run manifest) by the next worker
+    time.sleep(1.0)
+    converted = run_worker(options, poll=0.1, stale=0.5, heartbeat=0.1)
+    assert first_unit in converted
+    assert not glob.glob(os.path.join(units_dir, '*.lock'))
+    assemble(options)
+    czi2codex_all(reference)
+    assert _outputs(outdir) == _outputs(_outdir(reference))
+
+
+def test_replan_after_settings_changed(experiment):
+    options, reference = experiment
+    with open(options, 'r') as f:
+        user_input = yaml.safe_load(f)
+
+    def set_compression(compression):
+        user_input['1_compression'] = compression
+        with open(options, 'w') as f:
+            yaml.dump(user_input, f)
+
+    set_compression('none')
+    plan = plan_queue(options, tiles_per_unit=0)
+    assert len(run_worker(options)) == len(plan['units'])
+    # done units of other settings are converted again, unchanged ones not
+    set_compression('zlib')
+    plan_queue(options, tiles_per_unit=0)
+    assert len(run_worker(options)) == len(plan['units'])
+    plan_queue(options, tiles_per_unit=0)
+    assert run_worker(options) == []
+    assemble(options)
+    czi2codex_all(reference)
+    assert _outputs(_outdir(options)) == _outputs(_outdir(reference))